@@ -1,12 +1,35 @@
+import sys
+from importlib import import_module
+
 __version__ = "0.4.4"
 
 from deriva.qt.common.async_task import async_execute, AsyncTask, Request
-from deriva.qt.common.log_widget import QPlainTextEditLogger
-from deriva.qt.common.table_widget import TableWidget
-from deriva.qt.common.json_editor import JSONEditor
+from deriva.qt.common.session_pool import SessionPool
+from deriva.qt.common.credential_store import CredentialStore
+
+# The GUI classes pull in QtWidgets and QtWebEngine, so they are only imported on first access. This keeps headless
+# entry points, which need nothing beyond QtCore, small.
+_GUI_EXPORTS = {
+    "QPlainTextEditLogger": "deriva.qt.common.log_widget",
+    "TableWidget": "deriva.qt.common.table_widget",
+    "JSONEditor": "deriva.qt.common.json_editor",
+    "AuthWindow": "deriva.qt.auth_agent.ui.auth_window",
+    "EmbeddedAuthWindow": "deriva.qt.auth_agent.ui.embedded_auth_window",
+    "UploadWindow": "deriva.qt.upload_gui.ui.upload_window",
+    "DerivaUploadGUI": "deriva.qt.upload_gui.deriva_upload_gui",
+}
+
+
+def __getattr__(name):
+    module = _GUI_EXPORTS.get(name)
+    if module is None:
+        raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+    value = getattr(import_module(module), name)
+    globals()[name] = value
+    return value
 
-from deriva.qt.auth_agent.ui.auth_window import AuthWindow
-from deriva.qt.auth_agent.ui.embedded_auth_window import EmbeddedAuthWindow
 
-from deriva.qt.upload_gui.ui.upload_window import UploadWindow
-from deriva.qt.upload_gui.deriva_upload_gui import DerivaUploadGUI
+# module level __getattr__ is only honored from Python 3.7 onward
+if sys.version_info < (3, 7):
+    for _name in _GUI_EXPORTS:
+        __getattr__(_name)
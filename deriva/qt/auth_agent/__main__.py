@@ -1,12 +1,15 @@
 import sys
+import logging
 import traceback
 from PyQt5 import QtCore
-from PyQt5.QtWidgets import QApplication, QStyleFactory, QMessageBox
-from deriva.core import read_config, format_exception, BaseCLI
-from deriva.qt import AuthWindow, __version__ as VERSION
+from deriva.core import read_config, format_exception, BaseCLI, DEFAULT_CREDENTIAL_FILE
+from deriva.qt import __version__ as VERSION
+from deriva.qt.auth_agent.impl.config import DEFAULT_CONFIG, DEFAULT_CONFIG_FILE
+from deriva.qt.auth_agent.impl.token_broker import DEFAULT_BROKER_SOCKET
 
 
 def excepthook(etype, value, tb):
+    from PyQt5.QtWidgets import QMessageBox
     traceback.print_tb(tb)
     sys.stderr.write(format_exception(value))
     msg = QMessageBox()
@@ -18,25 +21,86 @@ def excepthook(etype, value, tb):
     msg.exec_()
 
 
-def main():
+def headless_main(args):
+    # QtCore only: no widget or web engine modules are loaded in this process
+    from deriva.qt.auth_agent.impl.headless_agent import HeadlessAuthAgent
+    app = QtCore.QCoreApplication(sys.argv)
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
+                        level=logging.DEBUG if args.debug else logging.INFO)
+    agent = HeadlessAuthAgent(args.config_file,
+                              args.credential_file,
+                              token_broker_socket=args.token_broker_socket if args.token_broker else None,
+                              login_on_demand=args.login_on_demand)
+    if not agent.start():
+        return 1
+    app.aboutToQuit.connect(agent.stop)
+    return app.exec_()
+
+
+def gui_main(args):
+    from PyQt5.QtWidgets import QApplication, QStyleFactory
+    from deriva.qt import AuthWindow, EmbeddedAuthWindow
     sys.excepthook = excepthook
 
     QApplication.setDesktopSettingsAware(False)
     QApplication.setStyle(QStyleFactory.create("Fusion"))
     app = QApplication(sys.argv)
     app.setAttribute(QtCore.Qt.AA_UseHighDpiPixmaps)
+    config = read_config(args.config_file, create_default=False) if args.config_file else None
+
+    if args.login_once:
+        # used by the headless agent: log in to a single host, leave the new credential in the credential file and
+        # exit without logging out, so that the headless agent can take over refreshing the session
+        servers = (config if config else read_config(DEFAULT_CONFIG_FILE, create_default=True,
+                                                     default=DEFAULT_CONFIG)).get("servers", [])
+        server = next((s for s in servers if s and s.get("host") == args.host), {"host": args.host})
+        window = EmbeddedAuthWindow(server,
+                                    args.credential_file if args.credential_file else DEFAULT_CREDENTIAL_FILE,
+                                    cookie_persistence=args.cookie_persistence,
+                                    authentication_success_callback=lambda **kwargs: app.quit())
+        window.show()
+        window.login()
+        return app.exec_()
+
+    authWindow = AuthWindow(config,
+                            args.credential_file,
+                            cookie_persistence=args.cookie_persistence,
+                            token_broker_socket=args.token_broker_socket if args.token_broker else None)
+    authWindow.show()
+    ret = app.exec_()
+    return ret
+
+
+def main():
     sys.stderr.write("\n")
     cli = BaseCLI("DERIVA Authentication Agent",
                   "For more information see: https://github.com/informatics-isi-edu/deriva-qt", VERSION)
     cli.parser.add_argument(
         "--cookie-persistence", action="store_true",
         help="Enable cookie and local storage persistence for QtWebEngine.")
+    cli.parser.add_argument(
+        "--token-broker", action="store_true",
+        help="Serve current credentials to local clients over a user-private socket.")
+    cli.parser.add_argument(
+        "--token-broker-socket", metavar="<path>", default=DEFAULT_BROKER_SOCKET,
+        help="Socket path (or pipe name on Windows) for the token broker. Default: %s" % DEFAULT_BROKER_SOCKET)
+    cli.parser.add_argument(
+        "--headless", action="store_true",
+        help="Run without a user interface, refreshing the sessions of all configured servers from stored "
+             "credentials.")
+    cli.parser.add_argument(
+        "--login-on-demand", action="store_true",
+        help="In headless mode, launch an interactive login window when a server requires authentication.")
+    cli.parser.add_argument(
+        "--login-once", action="store_true",
+        help="Log in to the server given by --host, store the credential, and exit.")
     args = cli.parse_cli()
-    config = read_config(args.config_file, create_default=False) if args.config_file else None
-    authWindow = AuthWindow(config, args.credential_file, cookie_persistence=args.cookie_persistence)
-    authWindow.show()
-    ret = app.exec_()
-    return ret
+    if args.login_once and not args.host:
+        cli.parser.error("--login-once requires --host")
+
+    if args.headless:
+        return headless_main(args)
+    return gui_main(args)
 
 
 if __name__ == '__main__':
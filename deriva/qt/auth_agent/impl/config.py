@@ -0,0 +1,17 @@
+import os
+from PyQt5.QtCore import QUrl
+
+DEFAULT_CONFIG = {
+  "servers": []
+}
+
+DEFAULT_CONFIG_FILE = os.path.join(os.path.expanduser(os.path.normpath("~/.deriva")), "auth-agent-config.json")
+
+
+def get_server_url(server):
+    url = QUrl()
+    url.setScheme(server.get("protocol", "https"))
+    url.setHost(server.get("host", ""))
+    if server.get("port") is not None:
+        url.setPort(int(server["port"]))
+    return url
@@ -0,0 +1,183 @@
+import os
+import sys
+import time
+import logging
+import platform
+from PyQt5.QtCore import QObject, QProcess, QFileSystemWatcher, QTimer
+from deriva.core import read_config, format_exception, DEFAULT_CREDENTIAL_FILE
+from deriva.qt import async_execute, SessionPool, CredentialStore, __version__ as VERSION
+from deriva.qt.auth_agent.impl.config import DEFAULT_CONFIG, DEFAULT_CONFIG_FILE, get_server_url
+from deriva.qt.auth_agent.impl.session_refresh import SessionRefreshScheduler, set_session_cookie, get_session
+from deriva.qt.auth_agent.impl.token_broker import TokenBroker
+
+# the credential file is usually rewritten several times in quick succession, wait for it to settle before re-reading
+DEFAULT_CREDENTIAL_SETTLE_DELAY = 1000
+
+
+# Keeps the sessions of all configured hosts alive from stored credentials, running on a QCoreApplication without any
+# widget or web engine. Hosts whose stored credential is missing or no longer valid require an interactive login: if
+# enabled, that login runs in a separate, short-lived "deriva-auth --login-once" process that writes the credential
+# file and exits, so that the web engine never becomes resident in this process.
+class HeadlessAuthAgent(QObject):
+
+    def __init__(self,
+                 config_file=None,
+                 credential_file=None,
+                 token_broker_socket=None,
+                 login_on_demand=False,
+                 parent=None):
+        super(HeadlessAuthAgent, self).__init__(parent)
+        self.config_file = config_file if config_file else DEFAULT_CONFIG_FILE
+        self.config = read_config(self.config_file, create_default=True, default=DEFAULT_CONFIG)
+        self.credential_file = credential_file if credential_file else DEFAULT_CREDENTIAL_FILE
+        self.credential_store = CredentialStore.instance(self.credential_file)
+        self.login_on_demand = login_on_demand
+        self.servers = dict()
+        self.authenticated = set()
+        self.pending = set()
+        self.login_queue = list()
+        self.login_process = None
+
+        self.scheduler = SessionRefreshScheduler.instance()
+        self.scheduler.session_refreshed_signal.connect(self.onSessionRefreshed)
+        self.scheduler.session_expired_signal.connect(self.onSessionExpired)
+
+        self.token_broker = None
+        if token_broker_socket:
+            token_broker = TokenBroker(token_broker_socket, self)
+            if token_broker.start():
+                self.token_broker = token_broker
+
+        self.credential_watcher = QFileSystemWatcher(self)
+        self.credential_watcher.fileChanged.connect(self.onCredentialFileChanged)
+        self.credential_timer = QTimer(self)
+        self.credential_timer.setSingleShot(True)
+        self.credential_timer.timeout.connect(lambda: self.restoreSessions(prompt=False))
+
+        info = "%s v%s [Python %s, %s]" % (
+            self.__class__.__name__, VERSION, platform.python_version(), platform.platform(aliased=True))
+        logging.info("Initializing headless authorization agent: %s" % info)
+
+    def start(self):
+        for server in self.config.get("servers", []):
+            if not (server and server.get("host")):
+                continue
+            self.servers[get_server_url(server).toString()] = server
+        if not self.servers:
+            logging.warning("No servers configured, nothing to do.")
+            return False
+        self.watchCredentialFile()
+        self.restoreSessions()
+        return True
+
+    def stop(self):
+        self.scheduler.session_refreshed_signal.disconnect(self.onSessionRefreshed)
+        self.scheduler.session_expired_signal.disconnect(self.onSessionExpired)
+        for key in list(self.authenticated):
+            self.scheduler.unregister(key)
+        if self.token_broker:
+            self.token_broker.stop()
+
+    def watchCredentialFile(self):
+        if os.path.isfile(self.credential_file) and self.credential_file not in self.credential_watcher.files():
+            self.credential_watcher.addPath(self.credential_file)
+
+    def onCredentialFileChanged(self, path):
+        # files replaced by rename drop out of the watch list and need to be re-added
+        self.watchCredentialFile()
+        self.credential_timer.start(DEFAULT_CREDENTIAL_SETTLE_DELAY)
+
+    def restoreSessions(self, prompt=True):
+        try:
+            credentials = self.credential_store.read()
+        except Exception as e:
+            logging.warning("Unable to read credential file [%s]: %s" % (self.credential_file, format_exception(e)))
+            credentials = dict()
+        for key, server in self.servers.items():
+            if key in self.authenticated or key in self.pending:
+                continue
+            host = server["host"]
+            credential = credentials.get(host, credentials.get(host.lower()))
+            session = SessionPool.getSession(key)
+            if not set_session_cookie(session, host, credential.get("cookie") if credential else None):
+                if prompt:
+                    self.loginRequired(key, "no stored credential")
+                continue
+            self.pending.add(key)
+            async_execute(get_session,
+                          [session, key + "/authn/session"],
+                          (key, prompt),
+                          self.onSessionResult,
+                          self.onSessionError)
+
+    def onSessionResult(self, uid, result):
+        key, prompt = uid
+        self.pending.discard(key)
+        status, content = result
+        if content is None:
+            if prompt:
+                self.loginRequired(key, "server responded %s" % status)
+            else:
+                logging.info("Stored credential for [%s] is not valid (server responded %s)." % (key, status))
+            return
+        seconds_remaining = content.get("seconds_remaining", 0)
+        self.authenticated.add(key)
+        self.scheduler.register(key, key + "/authn/session", SessionPool.getSession(key), seconds_remaining)
+        logging.info("Restored session for [%s]: expires in %d seconds." % (key, seconds_remaining))
+        self.publish(key, time.time() + seconds_remaining)
+
+    def onSessionError(self, uid, error):
+        key, prompt = uid
+        self.pending.discard(key)
+        # most likely a transient network failure, so leave the host to the next credential file change
+        logging.warning("Unable to validate stored session for [%s]: %s" % (key, format_exception(error)))
+
+    def onSessionRefreshed(self, key, session):
+        if key in self.authenticated:
+            self.publish(key, time.time() + session.get("seconds_remaining", 0))
+
+    def onSessionExpired(self, key, detail):
+        if key not in self.authenticated:
+            return
+        self.authenticated.discard(key)
+        if self.token_broker:
+            self.token_broker.remove(self.servers[key]["host"])
+        self.loginRequired(key, detail)
+
+    def publish(self, key, expires):
+        if not self.token_broker:
+            return
+        host = self.servers[key]["host"]
+        try:
+            credential = self.credential_store.get(host)
+        except Exception:
+            credential = None
+        self.token_broker.update(host, credential, expires)
+
+    def loginRequired(self, key, reason):
+        logging.warning("Interactive login required for [%s]: %s." % (key, reason))
+        if not self.login_on_demand:
+            return
+        if key not in self.login_queue:
+            self.login_queue.append(key)
+        self.startInteractiveLogin()
+
+    def startInteractiveLogin(self):
+        if self.login_process is not None or not self.login_queue:
+            return
+        key = self.login_queue.pop(0)
+        args = ["-m", "deriva.qt.auth_agent", "--login-once", "--host", self.servers[key]["host"],
+                "--config-file", self.config_file, "--credential-file", self.credential_file]
+        logging.info("Starting interactive login for [%s]" % key)
+        self.login_process = QProcess(self)
+        self.login_process.finished.connect(self.onInteractiveLoginFinished)
+        self.login_process.start(sys.executable, args)
+
+    def onInteractiveLoginFinished(self, exit_code, exit_status):
+        logging.debug("Interactive login process exited with code: %s" % exit_code)
+        self.login_process.deleteLater()
+        self.login_process = None
+        # hosts the user did not log in to are not prompted for again until their next expiry or agent restart
+        self.watchCredentialFile()
+        self.restoreSessions(prompt=False)
+        self.startInteractiveLogin()
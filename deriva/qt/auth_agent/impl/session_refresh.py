@@ -0,0 +1,166 @@
+import time
+import random
+import logging
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from deriva.core import format_exception
+from deriva.qt import async_execute
+
+# fraction of the refresh interval that is randomly added or subtracted so that many sessions do not refresh in step
+DEFAULT_REFRESH_JITTER = 0.1
+# refreshes that fall due within this many seconds of each other are dispatched together as one batch
+DEFAULT_BATCH_WINDOW = 5
+DEFAULT_MIN_INTERVAL = 10
+DEFAULT_REFRESH_TIMEOUT = 30
+DEFAULT_RETRY_BACKOFF = 15
+DEFAULT_MAX_RETRY_BACKOFF = 600
+# server responses that mean the session no longer exists, so retrying is pointless
+SESSION_INVALID_STATUS = (401, 403, 404)
+
+# logging.trace is only defined by older deriva releases; on newer ones, trace output goes to the debug level
+log_trace = getattr(logging, "trace", logging.debug)
+
+
+class SessionRefreshScheduler(QObject):
+    session_refreshed_signal = pyqtSignal(str, object)
+    session_expired_signal = pyqtSignal(str, str)
+
+    _instance = None
+
+    def __init__(self, parent=None):
+        super(SessionRefreshScheduler, self).__init__(parent)
+        self.entries = dict()
+        self.batches = dict()
+        self.rid = 0
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._onTimerFired)
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = SessionRefreshScheduler()
+        return cls._instance
+
+    def register(self, key, url, session, seconds_remaining):
+        entry = self.entries.get(key, dict())
+        entry.update({"url": url,
+                      "session": session,
+                      "failures": 0,
+                      "expires": time.time() + seconds_remaining,
+                      "due": self._nextDue(seconds_remaining)})
+        entry.setdefault("in_flight", False)
+        self.entries[key] = entry
+        logging.debug("Session refresh for [%s] scheduled in %d seconds." % (key, entry["due"] - time.time()))
+        self._reschedule()
+
+    def unregister(self, key):
+        if self.entries.pop(key, None) is not None:
+            self._reschedule()
+
+    def isRegistered(self, key):
+        return key in self.entries
+
+    def expires(self, key):
+        entry = self.entries.get(key)
+        return entry["expires"] if entry else None
+
+    @staticmethod
+    def _nextDue(seconds_remaining):
+        interval = max(seconds_remaining // 2, DEFAULT_MIN_INTERVAL)
+        jitter = interval * DEFAULT_REFRESH_JITTER
+        return time.time() + interval + random.uniform(-jitter, jitter)
+
+    def _nextRetry(self, entry):
+        backoff = min(DEFAULT_RETRY_BACKOFF * (2 ** (entry["failures"] - 1)), DEFAULT_MAX_RETRY_BACKOFF)
+        backoff += random.uniform(0, backoff * DEFAULT_REFRESH_JITTER)
+        # never wait past the point where the session would expire anyway, leave room for one last attempt
+        return min(time.time() + backoff, max(time.time(), entry["expires"] - DEFAULT_REFRESH_TIMEOUT))
+
+    def _reschedule(self):
+        pending = [entry["due"] for entry in self.entries.values() if not entry["in_flight"]]
+        if not pending:
+            self._timer.stop()
+            return
+        delay = max(0.0, min(pending) - time.time())
+        self._timer.start(int(delay * 1000))
+
+    def _onTimerFired(self):
+        cutoff = time.time() + DEFAULT_BATCH_WINDOW
+        batch = list()
+        for key, entry in self.entries.items():
+            if entry["in_flight"] or entry["due"] > cutoff:
+                continue
+            entry["in_flight"] = True
+            batch.append((key, entry["url"], entry["session"]))
+        if batch:
+            self.rid += 1
+            self.batches[self.rid] = [key for key, url, session in batch]
+            logging.debug("Dispatching session refresh batch for: %s" % ", ".join(self.batches[self.rid]))
+            async_execute(self._refreshSessions, [batch], self.rid, self._onRefreshResult, self._onRefreshError)
+        self._reschedule()
+
+    @staticmethod
+    def _refreshSessions(batch):
+        results = dict()
+        for key, url, session in batch:
+            try:
+                resp = session.put(url, timeout=DEFAULT_REFRESH_TIMEOUT)
+                if resp.ok:
+                    results[key] = (True, resp.status_code, resp.json())
+                else:
+                    results[key] = (False, resp.status_code,
+                                    "%s %s: %s" % (resp.status_code, resp.reason, resp.content.decode()))
+            except Exception as e:
+                results[key] = (False, None, format_exception(e))
+        return results
+
+    def _onRefreshResult(self, rid, results):
+        self.batches.pop(rid, None)
+        for key, (success, status, content) in results.items():
+            entry = self.entries.get(key)
+            if not entry:
+                # unregistered (i.e., logged out) while the refresh was in flight
+                continue
+            entry["in_flight"] = False
+            if success:
+                seconds_remaining = content.get("seconds_remaining", 0)
+                entry["failures"] = 0
+                entry["expires"] = time.time() + seconds_remaining
+                entry["due"] = self._nextDue(seconds_remaining)
+                log_trace("webauthn session:\n%s\n", content)
+                logging.info("Session refreshed for: %s" % key)
+                self.session_refreshed_signal.emit(key, content)
+            elif status in SESSION_INVALID_STATUS or time.time() >= entry["expires"]:
+                logging.warning("Session for: %s is no longer valid. Server responded: %s" % (key, content))
+                del self.entries[key]
+                self.session_expired_signal.emit(key, content)
+            else:
+                entry["failures"] += 1
+                entry["due"] = self._nextRetry(entry)
+                logging.warning("Unable to refresh session for: %s (attempt %d, retry in %d seconds). %s" %
+                                (key, entry["failures"], entry["due"] - time.time(), content))
+        self._reschedule()
+
+    def _onRefreshError(self, rid, error):
+        for key in self.batches.pop(rid, []):
+            entry = self.entries.get(key)
+            if entry:
+                entry["in_flight"] = False
+                entry["failures"] += 1
+                entry["due"] = self._nextRetry(entry)
+        logging.warning("Session refresh batch failed: %s" % format_exception(error))
+        self._reschedule()
+
+
+def set_session_cookie(session, host, cookie):
+    # the cookie is in the "name=value" form stored in the credential file
+    if not cookie or "=" not in cookie:
+        return False
+    cookie_name, cookie_value = cookie.split("=", 1)
+    session.cookies.set(cookie_name, cookie_value, domain=host, path='/')
+    return True
+
+
+def get_session(session, url, timeout=DEFAULT_REFRESH_TIMEOUT):
+    resp = session.get(url, timeout=timeout)
+    return resp.status_code, resp.json() if resp.ok else None
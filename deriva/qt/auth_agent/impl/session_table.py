@@ -0,0 +1,54 @@
+import time
+from PyQt5.QtCore import QObject, QUrl
+from deriva.qt.auth_agent.impl.session_refresh import SessionRefreshScheduler
+
+
+# In-memory record of the sessions held by the agent, keyed by host. It is fed by the credential updates of the auth
+# widgets and kept current by the refresh scheduler, so it stays accurate for hosts whose widget has been discarded and
+# can answer "who is logged in" without touching any widget.
+class SessionTable(QObject):
+
+    def __init__(self, parent=None):
+        super(SessionTable, self).__init__(parent)
+        self.entries = dict()
+        scheduler = SessionRefreshScheduler.instance()
+        scheduler.session_refreshed_signal.connect(self.onSessionRefreshed)
+        scheduler.session_expired_signal.connect(self.onSessionExpired)
+
+    def update(self, host, update):
+        if update is None:
+            self.entries.pop(host, None)
+            return
+        entry = self.entries.setdefault(host, {"host": host})
+        entry.update(update)
+
+    def get(self, host):
+        return self.entries.get(host)
+
+    def remove(self, host):
+        return self.entries.pop(host, None)
+
+    def authenticated(self, host=None):
+        now = time.time()
+        if host is not None:
+            entry = self.entries.get(host)
+            return entry is not None and entry.get("expires", 0) > now
+        return any(entry.get("expires", 0) > now for entry in self.entries.values())
+
+    def getAuthenticatedHosts(self):
+        now = time.time()
+        return [host for host, entry in self.entries.items() if entry.get("expires", 0) > now]
+
+    def onSessionRefreshed(self, key, session):
+        entry = self.entries.get(QUrl(key).host())
+        if entry is None:
+            return
+        entry["session"] = session
+        entry["expires"] = time.time() + session.get("seconds_remaining", 0) + 1
+
+    def onSessionExpired(self, key, detail):
+        entry = self.entries.get(QUrl(key).host())
+        if entry is None:
+            return
+        entry["session"] = None
+        entry["expires"] = time.time()
@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import logging
+from PyQt5.QtCore import QObject
+from PyQt5.QtNetwork import QLocalServer, QLocalSocket
+from deriva.core import format_exception
+
+# on POSIX systems QLocalServer listens on a Unix domain socket at this path, on Windows it uses a named pipe instead
+DEFAULT_BROKER_SOCKET = "deriva-auth-agent" if "win32" in sys.platform else \
+    os.path.join(os.path.expanduser(os.path.normpath("~/.deriva")), "auth-agent.sock")
+MAX_REQUEST_SIZE = 64 * 1024
+# milliseconds to wait for a connection to an existing broker before its socket is considered stale
+DEFAULT_CONNECT_TIMEOUT = 500
+
+
+# Serves the current credential for each authenticated host from memory over a local socket, so that batch jobs do not
+# have to poll and parse the credential file. The protocol is line-delimited JSON, one request object per line:
+#   {"op": "get", "host": "<host>"}             -> {"status": "ok", "host": ..., "credential": {...}, "expires": ...}
+#   {"op": "hosts"}                             -> {"status": "ok", "hosts": [...]}
+#   {"op": "subscribe", "hosts": ["<host>"]}    -> {"status": "ok"}, followed by pushed events for those hosts (all
+#                                                  hosts if the list is empty or omitted):
+#                                                  {"event": "refresh"|"logout", "host": ..., ...}
+#   {"op": "ping"}                              -> {"status": "ok"}
+class TokenBroker(QObject):
+
+    def __init__(self, socket_path=DEFAULT_BROKER_SOCKET, parent=None):
+        super(TokenBroker, self).__init__(parent)
+        self.socket_path = socket_path
+        self.credentials = dict()
+        self.responses = dict()
+        self.buffers = dict()
+        self.subscribers = dict()
+        self.server = QLocalServer(self)
+        # restrict the socket to the current user; the broker is never exposed on the network
+        self.server.setSocketOptions(QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self._onNewConnection)
+
+    def start(self):
+        # another agent may already be serving on this socket; it must not be taken over
+        if self.isRunning(self.socket_path):
+            logging.error("Unable to start token broker on [%s]: a token broker is already running there." %
+                          self.socket_path)
+            return False
+        # otherwise, remove a stale socket left behind by an agent that did not shut down cleanly
+        QLocalServer.removeServer(self.socket_path)
+        if not self.server.listen(self.socket_path):
+            logging.error("Unable to start token broker on [%s]: %s" % (self.socket_path, self.server.errorString()))
+            return False
+        logging.info("Token broker listening on: %s" % self.server.fullServerName())
+        return True
+
+    @staticmethod
+    def isRunning(socket_path, timeout=DEFAULT_CONNECT_TIMEOUT):
+        sock = QLocalSocket()
+        sock.connectToServer(socket_path)
+        connected = sock.waitForConnected(timeout)
+        if connected:
+            sock.disconnectFromServer()
+        sock.abort()
+        return connected
+
+    def stop(self):
+        for sock in list(self.buffers.keys()):
+            sock.disconnectFromServer()
+        self.server.close()
+
+    def update(self, host, credential, expires=None):
+        entry = self.credentials.get(host, dict())
+        if credential is not None:
+            entry["credential"] = dict(credential)
+        if expires is not None:
+            entry["expires"] = expires
+        if "credential" not in entry:
+            return
+        entry["host"] = host
+        self.credentials[host] = entry
+        # responses are encoded once per update rather than once per request
+        self.responses[host] = self._encode(dict(entry, status="ok"))
+        self._publish(host, self._encode(dict(entry, event="refresh")))
+
+    def remove(self, host):
+        if self.credentials.pop(host, None) is None:
+            return
+        self.responses.pop(host, None)
+        self._publish(host, self._encode({"event": "logout", "host": host}))
+
+    @staticmethod
+    def _encode(obj):
+        return json.dumps(obj).encode("utf-8") + b"\n"
+
+    def _publish(self, host, message):
+        for sock, hosts in self.subscribers.items():
+            if not hosts or host in hosts:
+                sock.write(message)
+
+    def _onNewConnection(self):
+        while self.server.hasPendingConnections():
+            sock = self.server.nextPendingConnection()
+            self.buffers[sock] = bytearray()
+            sock.readyRead.connect(lambda s=sock: self._onReadyRead(s))
+            sock.disconnected.connect(lambda s=sock: self._onDisconnected(s))
+
+    def _onDisconnected(self, sock):
+        self.buffers.pop(sock, None)
+        self.subscribers.pop(sock, None)
+        sock.deleteLater()
+
+    def _onReadyRead(self, sock):
+        buf = self.buffers.get(sock)
+        if buf is None:
+            return
+        buf.extend(bytes(sock.readAll()))
+        # pipelined requests that arrive together are answered with a single write
+        replies = list()
+        while True:
+            index = buf.find(b"\n")
+            if index < 0:
+                break
+            line = bytes(buf[:index])
+            del buf[:index + 1]
+            if line.strip():
+                replies.append(self._handleRequest(sock, line))
+        if len(buf) > MAX_REQUEST_SIZE:
+            logging.warning("Token broker client sent an oversized request, disconnecting.")
+            sock.disconnectFromServer()
+            return
+        if replies:
+            sock.write(b"".join(replies))
+
+    def _handleRequest(self, sock, line):
+        try:
+            request = json.loads(line.decode("utf-8"))
+            op = request.get("op")
+            if op == "get":
+                host = request.get("host")
+                response = self.responses.get(host)
+                if response is None:
+                    return self._encode({"status": "not_found", "host": host})
+                return response
+            elif op == "hosts":
+                return self._encode({"status": "ok", "hosts": sorted(self.credentials.keys())})
+            elif op == "subscribe":
+                self.subscribers[sock] = set(request.get("hosts") or [])
+                return self._encode({"status": "ok"})
+            elif op == "ping":
+                return self._encode({"status": "ok", "time": time.time()})
+            return self._encode({"status": "error", "error": "Unknown operation: %s" % op})
+        except Exception as e:
+            return self._encode({"status": "error", "error": format_exception(e)})
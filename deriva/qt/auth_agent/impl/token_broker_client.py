@@ -0,0 +1,170 @@
+import io
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+
+# This module intentionally depends only on the standard library so that batch jobs can talk to the auth agent's
+# token broker without Qt; see deriva.qt.auth_agent.impl.token_broker for the protocol. As with the broker, the socket is
+# a Unix domain socket on POSIX systems and a named pipe on Windows.
+DEFAULT_BROKER_SOCKET = "deriva-auth-agent" if "win32" in sys.platform else \
+    os.path.join(os.path.expanduser(os.path.normpath("~/.deriva")), "auth-agent.sock")
+WINDOWS_PIPE_PREFIX = "\\\\.\\pipe\\"
+
+
+class TokenBrokerClient(object):
+
+    def __init__(self, socket_path=DEFAULT_BROKER_SOCKET, timeout=10):
+        self.sock = None
+        self.pipe = None
+        if "win32" in sys.platform:
+            # the timeout does not apply to a named pipe, which is read and written with blocking calls
+            if not socket_path.startswith(WINDOWS_PIPE_PREFIX):
+                socket_path = WINDOWS_PIPE_PREFIX + socket_path
+            self.pipe = open(socket_path, "r+b", buffering=0)
+            self.reader = io.BufferedReader(self.pipe)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(socket_path)
+            self.reader = self.sock.makefile("rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.close()
+
+    def close(self):
+        self.reader.close()
+        if self.sock is not None:
+            self.sock.close()
+        if self.pipe is not None:
+            self.pipe.close()
+
+    def _send(self, data):
+        if self.sock is not None:
+            self.sock.sendall(data)
+            return
+        view = memoryview(data)
+        while view:
+            view = view[self.pipe.write(view):]
+
+    def _readResponse(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Token broker closed the connection.")
+        return json.loads(line.decode("utf-8"))
+
+    def request(self, **kwargs):
+        self._send(json.dumps(kwargs).encode("utf-8") + b"\n")
+        return self._readResponse()
+
+    def pipeline(self, requests):
+        self._send(b"".join(json.dumps(r).encode("utf-8") + b"\n" for r in requests))
+        return [self._readResponse() for _ in requests]
+
+    def get_credential(self, host):
+        response = self.request(op="get", host=host)
+        return response.get("credential") if response.get("status") == "ok" else None
+
+    def get_hosts(self):
+        return self.request(op="hosts").get("hosts", [])
+
+    def subscribe(self, hosts=None):
+        # once subscribed, the connection is dedicated to event delivery: the generator blocks until the next event
+        self.request(op="subscribe", hosts=hosts or [])
+        if self.sock is not None:
+            self.sock.settimeout(None)
+        while True:
+            yield self._readResponse()
+
+
+def benchmark(socket_path, host, clients=4, requests_per_client=10000, depth=1):
+    results = list()
+    lock = threading.Lock()
+
+    def worker():
+        latencies = list()
+        with TokenBrokerClient(socket_path) as client:
+            batch = [{"op": "get", "host": host}] * depth
+            remaining = requests_per_client
+            while remaining > 0:
+                count = min(depth, remaining)
+                start = time.perf_counter()
+                if count == 1:
+                    client.request(**batch[0])
+                else:
+                    client.pipeline(batch[:count])
+                latencies.append((time.perf_counter() - start) / count)
+                remaining -= count
+        with lock:
+            results.extend(latencies)
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    total = clients * requests_per_client
+    results.sort()
+
+    def percentile(p):
+        return results[min(len(results) - 1, int(len(results) * p))] * 1000.0 if results else 0.0
+
+    return {"clients": clients,
+            "requests": total,
+            "pipeline_depth": depth,
+            "elapsed_seconds": round(elapsed, 3),
+            "requests_per_second": round(total / elapsed, 1) if elapsed else 0.0,
+            "latency_ms_p50": round(percentile(0.50), 3),
+            "latency_ms_p99": round(percentile(0.99), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DERIVA Authentication Agent token broker client")
+    parser.add_argument("--socket", default=DEFAULT_BROKER_SOCKET,
+                        help="Path to the token broker socket (the pipe name on Windows).")
+    parser.add_argument("--host", help="Host to request the current credential for.")
+    parser.add_argument("--subscribe", action="store_true", help="Print credential refresh events as they arrive.")
+    parser.add_argument("--benchmark", action="store_true", help="Measure broker request throughput and latency.")
+    parser.add_argument("--clients", type=int, default=4, help="Number of concurrent benchmark connections.")
+    parser.add_argument("--requests", type=int, default=10000, help="Number of requests per benchmark connection.")
+    parser.add_argument("--depth", type=int, default=1, help="Number of pipelined requests per round trip.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        host = args.host
+        if not host:
+            with TokenBrokerClient(args.socket) as client:
+                hosts = client.get_hosts()
+            host = hosts[0] if hosts else "localhost"
+        print(json.dumps(benchmark(args.socket, host, args.clients, args.requests, max(1, args.depth)), indent=2))
+        return 0
+
+    with TokenBrokerClient(args.socket) as client:
+        if args.subscribe:
+            try:
+                for event in client.subscribe([args.host] if args.host else None):
+                    print(json.dumps(event))
+                    sys.stdout.flush()
+            except KeyboardInterrupt:
+                pass
+        elif args.host:
+            credential = client.get_credential(args.host)
+            if credential is None:
+                sys.stderr.write("No credential available for host: %s\n" % args.host)
+                return 1
+            print(json.dumps(credential, indent=2))
+        else:
+            print(json.dumps(client.get_hosts(), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
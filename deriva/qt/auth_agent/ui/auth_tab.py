@@ -0,0 +1,114 @@
+import logging
+from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel
+from deriva.core import format_exception
+from deriva.qt import SessionPool
+from deriva.qt.auth_agent.impl.config import get_server_url
+from deriva.qt.auth_agent.impl.session_refresh import SessionRefreshScheduler
+from deriva.qt.auth_agent.ui.auth_widget import AuthWidget, delete_session
+
+
+# A tab page for a single server. The AuthWidget (and with it the web engine) is only created when the tab is shown or
+# a login is requested, and an authenticated widget can be discarded again while the tab is in the background. The
+# session itself is owned by the refresh scheduler and the window's session table, so it survives the widget.
+class AuthTab(QWidget):
+    credential_update_signal = pyqtSignal(str, object)
+
+    def __init__(self, parent, config, credential_file, cookie_persistence, success_callback, sessions):
+        super(AuthTab, self).__init__(parent)
+        self.config = config
+        self.credential_file = credential_file
+        self.cookie_persistence = cookie_persistence
+        self.success_callback = success_callback
+        self.sessions = sessions
+        self.auth_url = get_server_url(config)
+        self.host = self.auth_url.host()
+        self.authWidget = None
+
+        self.tabLayout = QVBoxLayout(self)
+        self.tabLayout.setContentsMargins(0, 0, 0, 0)
+        self.placeholder = QLabel(self)
+        self.placeholder.setAlignment(Qt.AlignCenter)
+        self.tabLayout.addWidget(self.placeholder)
+
+    def isMaterialized(self):
+        return self.authWidget is not None
+
+    def materialize(self):
+        if self.authWidget is not None:
+            return self.authWidget
+        widget = AuthWidget(self, self.config, self.credential_file, self.cookie_persistence)
+        widget.setSuccessCallback(self.success_callback)
+        widget.setObjectName("authWidget")
+        widget.credential_update_signal.connect(self.credential_update_signal)
+        entry = self.sessions.get(self.host)
+        if entry and self.sessions.authenticated(self.host):
+            widget.restore(entry)
+        self.placeholder.hide()
+        self.tabLayout.addWidget(widget)
+        self.authWidget = widget
+        return widget
+
+    def discard(self):
+        widget = self.authWidget
+        if widget is None or not (widget.authenticated() and self.sessions.authenticated(self.host)):
+            return False
+        self.authWidget = None
+        widget.discard()
+        self.tabLayout.removeWidget(widget)
+        widget.deleteLater()
+        self.placeholder.setText("Authenticated: %s" % self.host)
+        self.placeholder.show()
+        logging.debug("Discarded inactive tab for host: %s" % self.host)
+        return True
+
+    def token(self):
+        if self.authWidget is not None:
+            return self.authWidget.token
+        entry = self.sessions.get(self.host)
+        return entry.get("token") if entry else None
+
+    def authenticated(self):
+        if self.authWidget is not None:
+            return self.authWidget.authenticated()
+        return self.sessions.authenticated(self.host)
+
+    def login(self):
+        self.materialize().login()
+
+    def logout(self, delete_cookies=False):
+        if not self.canLogout():
+            return
+        self.logoutPrepare(delete_cookies)
+        try:
+            self.deleteSession()
+        except Exception as e:
+            logging.warning("Logout error: %s" % format_exception(e))
+        self.logoutFinish()
+
+    def canLogout(self):
+        if self.authWidget is not None:
+            return self.authWidget.canLogout()
+        return self.sessions.authenticated(self.host)
+
+    def logoutPrepare(self, delete_cookies=False):
+        if self.authWidget is not None:
+            self.authWidget.logoutPrepare(delete_cookies)
+        else:
+            logging.info("Logging out of host: %s" % self.auth_url.toString())
+
+    def deleteSession(self, timeout=None):
+        # may run on a pool thread
+        widget = self.authWidget
+        if widget is not None:
+            return widget.deleteSession(timeout)
+        return delete_session(self.auth_url.toString(), SessionPool.getSession(self.auth_url.toString()), timeout)
+
+    def logoutFinish(self):
+        if self.authWidget is not None:
+            self.authWidget.logoutFinish()
+            return
+        SessionPool.getSession(self.auth_url.toString()).cookies.clear()
+        SessionRefreshScheduler.instance().unregister(self.auth_url.toString())
+        self.placeholder.setText("")
+        self.credential_update_signal.emit(self.host, None)
@@ -1,24 +1,16 @@
-import os
 import json
 import logging
-import requests
 import time
 import platform
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from PyQt5.QtCore import Qt, QTimer, QUrl
+import requests
+from PyQt5.QtCore import Qt, QObject, QTimer, QUrl, pyqtSignal
 from PyQt5.QtWidgets import qApp
 from PyQt5.QtNetwork import QNetworkCookie
 from PyQt5.QtWebEngineWidgets import QWebEngineView, QWebEnginePage, QWebEngineProfile
-from deriva.core import read_config, read_credential, write_credential, format_exception, DEFAULT_SESSION_CONFIG, \
-    DEFAULT_CREDENTIAL
-from deriva.qt import __version__ as VERSION
-
-DEFAULT_CONFIG = {
-  "servers": []
-}
-
-DEFAULT_CONFIG_FILE = os.path.join(os.path.expanduser(os.path.normpath("~/.deriva")), "auth-agent-config.json")
+from deriva.core import read_config, format_exception, DEFAULT_CREDENTIAL
+from deriva.qt import SessionPool, CredentialStore, __version__ as VERSION
+from deriva.qt.auth_agent.impl.config import DEFAULT_CONFIG, DEFAULT_CONFIG_FILE, get_server_url
+from deriva.qt.auth_agent.impl.session_refresh import SessionRefreshScheduler, log_trace
 
 DEFAULT_HTML = '<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><title>DERIVA Auth Agent</title></head>' \
                '<body style="text-align: center; vertical-align: middle;">' \
@@ -32,6 +24,50 @@ ERROR_HTML = '<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><title>
 SUCCESS_HTML = '<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><title>Authentication Success</title></head>' \
                '<body style="text-align: center; vertical-align: middle;">Authentication successful.</body></html>'
 
+DEFAULT_PROFILE_POOL_SIZE = 2
+
+
+# Each off-the-record QWebEngineProfile gets its own network context in the browser process, so rather than creating
+# (and leaking) a new one for every login, a few are kept for reuse. Profiles are wiped when they are returned.
+class ProfilePool(object):
+    _profiles = list()
+    max_size = DEFAULT_PROFILE_POOL_SIZE
+
+    @classmethod
+    def acquire(cls):
+        if cls._profiles:
+            return cls._profiles.pop()
+        # parented to the application rather than to a widget, so that a pooled profile outlives the widget that
+        # first used it
+        return QWebEngineProfile(qApp)
+
+    @classmethod
+    def release(cls, profile):
+        profile.cookieStore().deleteAllCookies()
+        profile.clearHttpCache()
+        profile.clearAllVisitedLinks()
+        if len(cls._profiles) < cls.max_size:
+            cls._profiles.append(profile)
+        else:
+            # any page using the profile must already have been scheduled for deletion, so that it goes first
+            profile.deleteLater()
+
+    @classmethod
+    def clear(cls):
+        while cls._profiles:
+            cls._profiles.pop().deleteLater()
+
+
+def delete_session(url, session, timeout=None):
+    url = url + "/authn/session"
+    if timeout is None:
+        return session.delete(url).status_code
+    # a single attempt that bypasses the retry policy of the pooled session, so that the caller can bound the total
+    # time spent; this may run on a pool thread, so it must not touch any widget state
+    with requests.session() as single_session:
+        single_session.cookies.update(session.cookies)
+        return single_session.delete(url, timeout=timeout).status_code
+
 
 class AuthWidget(QWebEngineView):
     config = None
@@ -45,14 +81,23 @@ class AuthWidget(QWebEngineView):
     authn_expires = time.time()
     cookie_persistence = False
     _success_callback = None
-    _session = requests.session()
+    _session = None
     token = None
+    credential_update_signal = pyqtSignal(str, object)
 
     def __init__(self, parent, config=None, credential_file=None, cookie_persistence=False):
         super(AuthWidget, self).__init__(parent)
         self.cookie_persistence = cookie_persistence
-        self._timer = QTimer(self)
-        self._timer.timeout.connect(self._onTimerFired)
+        self.credential = dict(DEFAULT_CREDENTIAL)
+        self._scheduler = SessionRefreshScheduler.instance()
+        self._scheduler.session_refreshed_signal.connect(self._onSessionRefreshed)
+        self._scheduler.session_expired_signal.connect(self._onSessionExpired)
+        # pages are not parented to the view itself, since some QtWebEngine versions delete a page owned by the view as
+        # soon as another page is set; the lightweight status page lets the authentication page be released as soon as
+        # it is no longer needed
+        self._page_owner = QObject(self)
+        self.status_page = QWebEnginePage(self._page_owner)
+        self.setPage(self.status_page)
         self.configure(config, credential_file)
         info = "%s v%s [Python %s, %s]" % (
             self.__class__.__name__, VERSION, platform.python_version(), platform.platform(aliased=True))
@@ -66,20 +111,9 @@ class AuthWidget(QWebEngineView):
         if not host:
             self.setHtml(ERROR_HTML % "Could not locate hostname parameter in configuration.")
             return
-        self.auth_url = QUrl()
-        self.auth_url.setScheme(config.get("protocol", "https"))
-        self.auth_url.setHost(host)
-        if config.get("port") is not None:
-            self.auth_url.setPort(config["port"])
+        self.auth_url = get_server_url(self.config)
         self.authn_cookie_name = self.config.get("cookie_name", "webauthn")
-
-        retries = Retry(connect=DEFAULT_SESSION_CONFIG['retry_connect'],
-                        read=DEFAULT_SESSION_CONFIG['retry_read'],
-                        backoff_factor=DEFAULT_SESSION_CONFIG['retry_backoff_factor'],
-                        status_forcelist=DEFAULT_SESSION_CONFIG['retry_status_forcelist'])
-
-        self._session.mount(self.auth_url.toString() + '/',
-                            HTTPAdapter(max_retries=retries))
+        self._session = SessionPool.getSession(self.auth_url.toString())
 
     def authenticated(self):
         if self.authn_session is None:
@@ -99,8 +133,8 @@ class AuthWidget(QWebEngineView):
         qApp.setOverrideCursor(Qt.WaitCursor)
         self._cleanup()
         self.setHtml(DEFAULT_HTML)
-        self.authn_session_page = \
-            QWebEnginePage(QWebEngineProfile(self), self) if not self.cookie_persistence else QWebEnginePage(self)
+        self.authn_session_page = QWebEnginePage(
+            QWebEngineProfile.defaultProfile() if self.cookie_persistence else ProfilePool.acquire(), self._page_owner)
         self.authn_session_page.loadProgress.connect(self._onLoadProgress)
         self.authn_session_page.loadFinished.connect(self._onLoadFinished)
         self.authn_session_page.profile().cookieStore().cookieAdded.connect(self._onCookieAdded)
@@ -108,18 +142,48 @@ class AuthWidget(QWebEngineView):
         self.authn_session_page.setUrl(QUrl(self.auth_url.toString() + "/authn/preauth"))
 
     def logout(self, delete_cookies=False):
-        if not (self.auth_url and (self.auth_url.host() and self.auth_url.scheme())):
-            return
-        if not self.authenticated():
+        if not self.canLogout():
             return
+        self.logoutPrepare(delete_cookies)
         try:
-            logging.info("Logging out of host: %s" % self.auth_url.toString())
-            if delete_cookies and self.cookie_persistence:
-                self.authn_session_page.profile().cookieStore().deleteAllCookies()
-            self._session.delete(self.auth_url.toString() + "/authn/session")
+            self.deleteSession()
         except Exception as e:
             logging.warning("Logout error: %s" % format_exception(e))
+        self.logoutFinish()
+
+    def canLogout(self):
+        if not (self.auth_url and (self.auth_url.host() and self.auth_url.scheme())):
+            return False
+        return self.authenticated()
+
+    def logoutPrepare(self, delete_cookies=False):
+        logging.info("Logging out of host: %s" % self.auth_url.toString())
+        if delete_cookies and self.cookie_persistence:
+            QWebEngineProfile.defaultProfile().cookieStore().deleteAllCookies()
+
+    def deleteSession(self, timeout=None):
+        return delete_session(self.auth_url.toString(), self._session, timeout)
+
+    def logoutFinish(self):
+        self._session.cookies.clear()
         self._cleanup()
+        self.credential_update_signal.emit(self.auth_url.host(), None)
+
+    def restore(self, entry):
+        # take over a session that is still being refreshed in the background, e.g. after the widget that performed the
+        # login was discarded
+        self.credential = dict(entry.get("credential") or DEFAULT_CREDENTIAL)
+        self.token = entry.get("token")
+        self.authn_session = entry.get("session")
+        self.authn_expires = entry.get("expires", time.time())
+        self.setHtml(SUCCESS_HTML)
+
+    def discard(self):
+        # release the web engine resources held by this widget without logging out: the session remains registered
+        # with the refresh scheduler, which is keyed by server URL rather than by widget
+        self._scheduler.session_refreshed_signal.disconnect(self._onSessionRefreshed)
+        self._scheduler.session_expired_signal.disconnect(self._onSessionExpired)
+        self._releaseSessionPage()
 
     def setSuccessCallback(self, callback=None):
         self._success_callback = callback
@@ -132,34 +196,43 @@ class AuthWidget(QWebEngineView):
         if self._success_callback:
             self._success_callback(host=self.auth_url.host(), credential=self.credential)
 
-    def _onTimerFired(self):
-        if not self.authenticated():
-            self.authn_session = None
+    def _sessionKey(self):
+        return self.auth_url.toString() if self.auth_url else None
+
+    def _onSessionRefreshed(self, key, session):
+        if key != self._sessionKey():
             return
-        resp = self._session.put(self.auth_url.toString() + "/authn/session")
-        seconds_remaining = self.authn_session['seconds_remaining']
-        self.authn_expires = time.time() + seconds_remaining + 1
-        if resp.ok:
-            logging.trace("webauthn session:\n%s\n", resp.json())
-            logging.info("Session refreshed for: %s" % self.auth_url.host())
-        else:
-            logging.warning(
-                "Unable to refresh session for: %s. Server responded: %s" %
-                (self.auth_url.host(),
-                 str.format("%s %s: %s" % (resp.status_code, resp.reason, resp.content.decode()))))
+        self.authn_session = session
+        self.authn_expires = time.time() + session['seconds_remaining'] + 1
+
+    def _onSessionExpired(self, key, detail):
+        if key != self._sessionKey():
+            return
+        self.authn_session = None
+        self.authn_expires = time.time()
 
     def _onSessionContent(self, content):
         try:
-            self.setHtml(SUCCESS_HTML)
             self.authn_session = json.loads(content)
+            # authentication is complete, so the page (and its renderer process) is no longer needed
+            self._releaseSessionPage()
+            self.setHtml(SUCCESS_HTML)
             seconds_remaining = self.authn_session['seconds_remaining']
-            if not self._timer.isActive():
-                interval = seconds_remaining // 2
-                logging.info("Authentication successful for [%s]: credential refresh in %d seconds." %
-                             (self.auth_url.toString(), interval))
-                self._timer.start(interval * 1000)
+            if not self._scheduler.isRegistered(self._sessionKey()):
+                logging.info("Authentication successful for [%s]: credential refresh in about %d seconds." %
+                             (self.auth_url.toString(), seconds_remaining // 2))
+            self._scheduler.register(self._sessionKey(),
+                                     self.auth_url.toString() + "/authn/session",
+                                     self._session,
+                                     seconds_remaining)
             self.authn_expires = time.time() + seconds_remaining + 1
-            logging.trace("webauthn session:\n%s\n", json.dumps(self.authn_session, indent=2))
+            log_trace("webauthn session:\n%s\n", json.dumps(self.authn_session, indent=2))
+            SessionPool.warmup(self.auth_url.toString())
+            self.credential_update_signal.emit(self.auth_url.host(),
+                                               {"credential": dict(self.credential),
+                                                "expires": self.authn_expires,
+                                                "session": self.authn_session,
+                                                "token": self.token})
             qApp.restoreOverrideCursor()
             QTimer.singleShot(100, self._execSuccessCallback)
         except (ValueError, Exception) as e:
@@ -172,7 +245,7 @@ class AuthWidget(QWebEngineView):
                 logging.debug("no preauth content")
                 return
             preauth = json.loads(content)
-            logging.trace("webauthn preauth:\n%s\n", json.dumps(preauth, indent=2))
+            log_trace("webauthn preauth:\n%s\n", json.dumps(preauth, indent=2))
             qApp.setOverrideCursor(Qt.WaitCursor)
             self.authn_session_page.setUrl(QUrl(preauth["redirect_url"]))
         except (ValueError, Exception) as e:
@@ -200,15 +273,11 @@ class AuthWidget(QWebEngineView):
         cookie_name = str(cookie.name(), encoding='utf-8')
         cookie_val = str(cookie.value(), encoding='utf-8')
         if (cookie_name == self.authn_cookie_name) and (cookie.domain() == self.config.get("host")):
-            logging.trace("%s cookie added:\n\n%s\n\n" % (self.authn_cookie_name, cookie_str))
+            log_trace("%s cookie added:\n\n%s\n\n" % (self.authn_cookie_name, cookie_str))
             self.credential["cookie"] = "%s=%s" % (self.authn_cookie_name, cookie_val)
             host = self.auth_url.host()
-            cred_entry = dict()
-            cred_entry[host] = self.credential
             if self.credential_file:
-                creds = read_credential(self.credential_file, create_default=True)
-                creds.update(cred_entry)
-                write_credential(self.credential_file, creds)
+                CredentialStore.instance(self.credential_file).update(host, self.credential)
             self.token = cookie_val
             self._session.cookies.set(self.authn_cookie_name, cookie_val, domain=host, path='/')
             self.authn_session_page.setUrl(QUrl(self.auth_url.toString() + "/authn/session"))
@@ -217,16 +286,27 @@ class AuthWidget(QWebEngineView):
         cookie_str = str(cookie.toRawForm(QNetworkCookie.NameAndValueOnly), encoding='utf-8')
         cookie_name = str(cookie.name(), encoding='utf-8')
         if cookie_name == self.authn_cookie_name and cookie.domain() == self.url().host():
-            logging.trace("%s cookie removed:\n\n%s\n\n" % (self.authn_cookie_name, cookie_str))
+            log_trace("%s cookie removed:\n\n%s\n\n" % (self.authn_cookie_name, cookie_str))
 
     def _cleanup(self):
-        self._timer.stop()
+        self._scheduler.unregister(self._sessionKey())
         self.token = None
         self.authn_session = None
         self.authn_expires = time.time()
-        if self.authn_session_page:
-            self.authn_session_page.loadProgress.disconnect(self._onLoadProgress)
-            self.authn_session_page.loadFinished.disconnect(self._onLoadFinished)
-            self.authn_session_page.profile().cookieStore().cookieAdded.disconnect(self._onCookieAdded)
-            self.authn_session_page.profile().cookieStore().cookieRemoved.disconnect(self._onCookieRemoved)
-            del self.authn_session_page
+        self._releaseSessionPage()
+
+    def _releaseSessionPage(self):
+        page = self.authn_session_page
+        if page is None:
+            return
+        self.authn_session_page = None
+        page.loadProgress.disconnect(self._onLoadProgress)
+        page.loadFinished.disconnect(self._onLoadFinished)
+        profile = page.profile()
+        profile.cookieStore().cookieAdded.disconnect(self._onCookieAdded)
+        profile.cookieStore().cookieRemoved.disconnect(self._onCookieRemoved)
+        if self.page() is page:
+            self.setPage(self.status_page)
+        page.deleteLater()
+        if not self.cookie_persistence:
+            ProfilePool.release(profile)
@@ -1,17 +1,31 @@
 import logging
 import sys
 import re
+import time
 
 from pkg_resources import parse_version
-from PyQt5.QtCore import Qt, QEvent, QMetaObject, pyqtSlot, qVersion
+from PyQt5.QtCore import Qt, QEvent, QMetaObject, QThreadPool, QTimer, QUrl, pyqtSlot, qVersion
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QWidget, QMainWindow, QMessageBox, QStatusBar, QVBoxLayout, QSystemTrayIcon, QStyle, qApp, \
     QTabWidget, QAction, QToolBar, QSizePolicy, QHBoxLayout, QLabel, QComboBox, QSplitter
 from deriva.core import read_config, write_config, DEFAULT_CREDENTIAL_FILE
-from deriva.qt import QPlainTextEditLogger, __version__ as VERSION
-from deriva.qt.auth_agent.ui.auth_widget import AuthWidget, DEFAULT_CONFIG, DEFAULT_CONFIG_FILE
+from deriva.core import format_exception
+from deriva.qt import QPlainTextEditLogger, SessionPool, CredentialStore, async_execute, __version__ as VERSION
+from deriva.qt.auth_agent.ui.auth_tab import AuthTab
+from deriva.qt.auth_agent.impl.config import DEFAULT_CONFIG, DEFAULT_CONFIG_FILE, get_server_url
+from deriva.qt.auth_agent.impl.session_refresh import SessionRefreshScheduler, set_session_cookie, get_session
+from deriva.qt.auth_agent.impl.session_table import SessionTable
+from deriva.qt.auth_agent.impl.token_broker import TokenBroker
 from deriva.qt.auth_agent.resources import resources
 
+# upper bound (in seconds) on the time spent logging out of all hosts when the application quits
+DEFAULT_LOGOUT_DEADLINE = 5
+# time (in milliseconds) an authenticated tab may stay in the background before its web view is discarded
+DEFAULT_TAB_DISCARD_DELAY = 30000
+# stored credentials of all configured servers are checked concurrently at startup, with this many requests at most
+DEFAULT_RESTORE_MAX_THREADS = 32
+DEFAULT_RESTORE_TIMEOUT = 10
+
 
 class AuthWindow(QMainWindow):
 
@@ -21,7 +35,8 @@ class AuthWindow(QMainWindow):
                  config,
                  credential_file=None,
                  cookie_persistence=False,
-                 authentication_success_callback=None):
+                 authentication_success_callback=None,
+                 token_broker_socket=None):
         super(AuthWindow, self).__init__()
         self.config = config
         self.credential_file = credential_file if credential_file else DEFAULT_CREDENTIAL_FILE
@@ -38,27 +53,203 @@ class AuthWindow(QMainWindow):
 
         if not self.config:
             self.config = read_config(DEFAULT_CONFIG_FILE, create_default=True, default=DEFAULT_CONFIG)
+        self.sessions = SessionTable(self)
+        self.restore_pending = dict()
+        self.restore_start = 0
+        self.login_queue = list()
+        self.login_host = None
+        self.discard_timer = QTimer(self)
+        self.discard_timer.setSingleShot(True)
+        self.discard_timer.timeout.connect(self.discardTabs)
         self.ui = AuthWindowUI(self)
+        self.token_broker = None
+        if token_broker_socket:
+            self.startTokenBroker(token_broker_socket)
         self.hide()
         self.populateServerList()
         self.show()
-        self.on_actionLogin_triggered()
+        self.restoreSessions()
         qApp.aboutToQuit.connect(self.logout)
+        qApp.aboutToQuit.connect(self.stopTokenBroker)
 
     def authenticated(self):
-        authenticated = False
+        return self.sessions.authenticated()
+
+    def restoreSessions(self):
+        # check the stored credential of every configured server at once: servers that are still logged in get a tab
+        # right away (without a web view until it is shown), those whose credential has expired are queued for an
+        # interactive login, one at a time
+        try:
+            credentials = CredentialStore.instance(self.credential_file).read()
+        except Exception as e:
+            logging.warning("Unable to read credential file [%s]: %s" % (self.credential_file, format_exception(e)))
+            credentials = dict()
+        current = self.ui.serverComboBox.currentText()
+        self.restore_start = time.time()
+        # keep a reference, so that the pool outlives this method while requests are still running
+        thread_pool = self._restore_thread_pool = QThreadPool()
+        for i in range(self.ui.serverComboBox.count()):
+            host = self.ui.serverComboBox.itemText(i)
+            server = self.ui.serverComboBox.itemData(i, Qt.UserRole)
+            if not (host and server):
+                continue
+            url = get_server_url(server).toString()
+            credential = credentials.get(host, credentials.get(host.lower()))
+            session = SessionPool.getSession(url)
+            if not set_session_cookie(session, host, credential.get("cookie") if credential else None):
+                if host == current:
+                    self.queueLogin(host)
+                continue
+            self.restore_pending[host] = (server, credential)
+            async_execute(get_session,
+                          [session, url + "/authn/session", DEFAULT_RESTORE_TIMEOUT],
+                          host,
+                          self.onRestoreResult,
+                          self.onRestoreError,
+                          thread_pool=thread_pool)
+        thread_pool.setMaxThreadCount(max(1, min(len(self.restore_pending), DEFAULT_RESTORE_MAX_THREADS)))
+        if self.restore_pending:
+            logging.info("Checking stored credentials for %d server(s)." % len(self.restore_pending))
+
+    def onRestoreResult(self, host, result):
+        server, credential = self.restore_pending.pop(host, (None, None))
+        if server is None:
+            return
+        status, content = result
+        if content is None:
+            logging.info("Stored credential for [%s] is no longer valid (server responded %s)." % (host, status))
+            self.queueLogin(host)
+        else:
+            url = get_server_url(server).toString()
+            seconds_remaining = content.get("seconds_remaining", 0)
+            SessionRefreshScheduler.instance().register(
+                url, url + "/authn/session", SessionPool.getSession(url), seconds_remaining)
+            self.onCredentialUpdate(host, {"credential": dict(credential),
+                                           "expires": time.time() + seconds_remaining + 1,
+                                           "session": content,
+                                           "token": credential["cookie"].split("=", 1)[1]})
+            logging.info("Restored session for [%s]: expires in %d seconds." % (host, seconds_remaining))
+            if self.findAuthTab(host) == -1:
+                index = self.addAuthTab(server,
+                                        self.credential_file,
+                                        self.cookie_persistence,
+                                        self.authentication_success_callback)
+                if host == self.ui.serverComboBox.currentText():
+                    self.ui.tabWidget.setCurrentIndex(index)
+            self.updateSystrayTooltip()
+        self.onRestoreFinished()
+
+    def onRestoreError(self, host, error):
+        server, credential = self.restore_pending.pop(host, (None, None))
+        if server is None:
+            return
+        # most likely a network problem rather than an expired credential, so only prompt for the current server
+        logging.warning("Unable to validate stored credential for [%s]: %s" % (host, format_exception(error)))
+        if host == self.ui.serverComboBox.currentText():
+            self.queueLogin(host)
+        self.onRestoreFinished()
+
+    def onRestoreFinished(self):
+        if not self.restore_pending:
+            logging.debug("Stored credential check completed in %.2f seconds." % (time.time() - self.restore_start))
+
+    def queueLogin(self, host):
+        if host not in self.login_queue and host != self.login_host:
+            self.login_queue.append(host)
+        self.startQueuedLogin()
+
+    def startQueuedLogin(self):
+        if self.login_host is not None or not self.login_queue:
+            return
+        host = self.login_queue.pop(0)
+        index = self.ui.serverComboBox.findText(host, Qt.MatchFixedString)
+        if index == -1:
+            self.startQueuedLogin()
+            return
+        self.login_host = host
+        self.ui.serverComboBox.setCurrentIndex(index)
+        self.on_actionLogin_triggered()
+
+    def finishQueuedLogin(self, host):
+        if host != self.login_host:
+            return
+        self.login_host = None
+        self.startQueuedLogin()
+
+    def findAuthTab(self, host):
         for i in range(self.ui.tabWidget.count()):
-            widget = self.ui.tabWidget.widget(i)
-            if isinstance(widget, AuthWidget):
-                if widget.authenticated():
-                    authenticated = True
-        return authenticated
+            if host == self.ui.tabWidget.tabText(i):
+                return i
+        return -1
 
-    def logout(self):
+    def logout(self, deadline=DEFAULT_LOGOUT_DEADLINE):
+        widgets = list()
         for i in range(self.ui.tabWidget.count()):
             widget = self.ui.tabWidget.widget(i)
-            if isinstance(widget, AuthWidget):
-                widget.logout()
+            if isinstance(widget, AuthTab) and widget.canLogout():
+                widgets.append(widget)
+        if not widgets:
+            return
+
+        # issue all of the session deletes at once on a dedicated pool, so that quitting takes at most one bounded
+        # timeout regardless of how many hosts are logged in
+        start = time.time()
+        # keep a reference, otherwise the pool destructor would block on any request still running past the deadline
+        thread_pool = self._logout_thread_pool = QThreadPool()
+        thread_pool.setMaxThreadCount(len(widgets))
+        for widget in widgets:
+            widget.logoutPrepare()
+            async_execute(self._deleteSession,
+                          [widget.deleteSession, widget.auth_url.toString(), (deadline / 2.0, deadline / 2.0)],
+                          widget.auth_url.toString(),
+                          self._onLogoutResult,
+                          thread_pool=thread_pool)
+        if not thread_pool.waitForDone(int(deadline * 1000)):
+            logging.warning("Logout did not complete for all hosts within %d seconds." % deadline)
+        for widget in widgets:
+            widget.logoutFinish()
+        logging.debug("Logged out of %d host(s) in %.2f seconds." % (len(widgets), time.time() - start))
+
+    @staticmethod
+    def _deleteSession(delete_session, host, timeout):
+        # runs on a pool thread while the main thread is blocked waiting for the deadline, so log from here
+        try:
+            status = delete_session(timeout)
+            logging.debug("Logout of host %s completed with status: %s" % (host, status))
+            return status
+        except Exception as e:
+            logging.warning("Logout error for host %s: %s" % (host, format_exception(e)))
+
+    def _onLogoutResult(self, host, status):
+        pass
+
+    def startTokenBroker(self, socket_path):
+        token_broker = TokenBroker(socket_path, self)
+        if not token_broker.start():
+            return
+        self.token_broker = token_broker
+        SessionRefreshScheduler.instance().session_refreshed_signal.connect(self.onSessionRefreshed)
+
+    def stopTokenBroker(self):
+        if self.token_broker:
+            self.token_broker.stop()
+            self.token_broker = None
+
+    def onCredentialUpdate(self, host, update):
+        self.sessions.update(host, update)
+        if update is not None:
+            self.discard_timer.start(DEFAULT_TAB_DISCARD_DELAY)
+            self.finishQueuedLogin(host)
+        if not self.token_broker:
+            return
+        if update is None:
+            self.token_broker.remove(host)
+        else:
+            self.token_broker.update(host, update.get("credential"), update.get("expires"))
+
+    def onSessionRefreshed(self, key, session):
+        if self.token_broker:
+            self.token_broker.update(QUrl(key).host(), None, time.time() + session.get("seconds_remaining", 0))
 
     def successCallback(self, **kwargs):
         host = kwargs.get("host")
@@ -83,21 +274,33 @@ class AuthWindow(QMainWindow):
         return self.config
 
     def getAuthenticatedServers(self):
-        servers = list()
-        for i in range(self.ui.tabWidget.count()):
-            widget = self.ui.tabWidget.widget(i)
-            if isinstance(widget, AuthWidget):
-                if widget.authenticated():
-                    servers.append(self.ui.tabWidget.tabText(i))
-        return servers
+        return self.sessions.getAuthenticatedHosts()
 
     def addAuthTab(self, config, credential_file, cookie_persistence, success_callback):
-        authWidget = AuthWidget(self, config, credential_file, cookie_persistence)
-        authWidget.setSuccessCallback(success_callback)
-        authWidget.setObjectName("authWidget")
-        index = self.ui.tabWidget.addTab(authWidget, authWidget.auth_url.host())
+        authTab = AuthTab(self, config, credential_file, cookie_persistence, success_callback, self.sessions)
+        authTab.setObjectName("authTab")
+        authTab.credential_update_signal.connect(self.onCredentialUpdate)
+        index = self.ui.tabWidget.addTab(authTab, authTab.host)
         return index
 
+    def removeAuthTab(self, index):
+        widget = self.ui.tabWidget.widget(index)
+        if isinstance(widget, AuthTab):
+            widget.logout()
+        self.ui.tabWidget.removeTab(index)
+        if widget is not None:
+            widget.deleteLater()
+            # a queued login that was abandoned by closing its tab must not hold up the rest of the queue
+            self.finishQueuedLogin(getattr(widget, "host", None))
+
+    def discardTabs(self):
+        # when the window is hidden or minimized, the current tab counts as a background tab as well
+        current = None if (self.isHidden() or self.isMinimized()) else self.ui.tabWidget.currentWidget()
+        for i in range(self.ui.tabWidget.count()):
+            widget = self.ui.tabWidget.widget(i)
+            if isinstance(widget, AuthTab) and widget is not current:
+                widget.discard()
+
     def updateSystrayTooltip(self):
         tooltip = "DERIVA Authenticated:\n%s" % "\n".join(self.getAuthenticatedServers())
         self.systemTrayIcon.setToolTip(tooltip)
@@ -110,11 +313,10 @@ class AuthWindow(QMainWindow):
         if (ind != -1) and (ind != cur):
             self.ui.serverComboBox.setCurrentIndex(ind)
         widget = self.ui.tabWidget.widget(index)
-        authenticated = False
-        if isinstance(widget, AuthWidget):
-            if widget.authenticated():
-                authenticated = True
-        if host and authenticated:
+        if isinstance(widget, AuthTab):
+            widget.materialize()
+        self.discard_timer.start(DEFAULT_TAB_DISCARD_DELAY)
+        if host and self.sessions.authenticated(host):
             self.statusBar().showMessage("Authenticated: %s" % host)
             self.ui.actionShowToken.setEnabled(True)
         else:
@@ -123,11 +325,7 @@ class AuthWindow(QMainWindow):
 
     @pyqtSlot(int)
     def onTabClosed(self, index):
-        widget = self.ui.tabWidget.widget(index)
-        if isinstance(widget, AuthWidget):
-            widget.logout()
-            del widget
-        self.ui.tabWidget.removeTab(index)
+        self.removeAuthTab(index)
         self.updateSystrayTooltip()
 
     @pyqtSlot(int)
@@ -167,7 +365,7 @@ class AuthWindow(QMainWindow):
                                 self.authentication_success_callback)
         self.ui.tabWidget.setTabEnabled(index, False)
         widget = self.ui.tabWidget.widget(index)
-        if isinstance(widget, AuthWidget):
+        if isinstance(widget, AuthTab):
             widget.login()
         self.ui.tabWidget.setTabEnabled(index, True)
         self.ui.tabWidget.setCurrentIndex(index)
@@ -182,11 +380,7 @@ class AuthWindow(QMainWindow):
         self.ui.serverComboBox.removeItem(index)
         for i in range(self.ui.tabWidget.count()):
             if host == self.ui.tabWidget.tabText(i):
-                widget = self.ui.tabWidget.widget(i)
-                if isinstance(widget, AuthWidget):
-                    widget.logout()
-                    del widget
-                self.ui.tabWidget.removeTab(i)
+                self.removeAuthTab(i)
 
         config = self.getConfiguredServers()
         write_config(DEFAULT_CONFIG_FILE, config)
@@ -195,8 +389,8 @@ class AuthWindow(QMainWindow):
     def on_actionShowToken_triggered(self):
         token = None
         widget = self.ui.tabWidget.currentWidget()
-        if isinstance(widget, AuthWidget):
-            token = widget.token
+        if isinstance(widget, AuthTab):
+            token = widget.token()
         if not token:
             return
         host = self.ui.serverComboBox.currentText()
@@ -220,7 +414,7 @@ class AuthWindow(QMainWindow):
         for i in range(self.ui.tabWidget.count()):
             if host == self.ui.tabWidget.tabText(i):
                 widget = self.ui.tabWidget.widget(i)
-                if isinstance(widget, AuthWidget):
+                if isinstance(widget, AuthTab):
                     widget.login()
                     return
 
@@ -231,7 +425,7 @@ class AuthWindow(QMainWindow):
                                 self.authentication_success_callback)
         self.ui.tabWidget.setTabEnabled(index, False)
         widget = self.ui.tabWidget.widget(index)
-        if isinstance(widget, AuthWidget):
+        if isinstance(widget, AuthTab):
             widget.login()
         self.ui.tabWidget.setTabEnabled(index, True)
         self.ui.tabWidget.setCurrentIndex(index)
@@ -241,11 +435,7 @@ class AuthWindow(QMainWindow):
         host = self.ui.serverComboBox.currentText()
         for i in range(self.ui.tabWidget.count()):
             if host == self.ui.tabWidget.tabText(i):
-                widget = self.ui.tabWidget.widget(i)
-                if isinstance(widget, AuthWidget):
-                    widget.logout()
-                    del widget
-                self.ui.tabWidget.removeTab(i)
+                self.removeAuthTab(i)
         self.updateSystrayTooltip()
 
     @pyqtSlot()
@@ -280,9 +470,17 @@ class AuthWindow(QMainWindow):
                     self.systemTrayIcon.showMessage(title, msg, self.window_icon)
                 else:
                     self.systemTrayIcon.showMessage(title, msg)
+                self.discard_timer.start(DEFAULT_TAB_DISCARD_DELAY)
 
         super(AuthWindow, self).changeEvent(event)
 
+    def showEvent(self, event):
+        # the current tab may have been discarded while the window was hidden
+        widget = self.ui.tabWidget.currentWidget()
+        if isinstance(widget, AuthTab):
+            widget.materialize()
+        super(AuthWindow, self).showEvent(event)
+
     def closeEvent(self, event):
         if not self.authenticated():
             return
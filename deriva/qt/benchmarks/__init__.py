@@ -0,0 +1,41 @@
+import os
+import sys
+import json
+import logging
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def get_memory_usage(include_children=True):
+    # resident set size in bytes of this process and, if psutil is available, of its child processes as well; the web
+    # engine renders pages in separate QtWebEngineProcess children, so without psutil only part of the picture is seen
+    if psutil is not None:
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        if include_children:
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+        return rss
+    if os.path.isfile("/proc/self/statm"):
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # peak rather than current usage, in bytes on macOS and kilobytes elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def write_results(results, output_file=None):
+    output = json.dumps(results, indent=2)
+    if output_file:
+        with open(output_file, "w") as f:
+            f.write(output)
+        logging.info("Benchmark results written to: %s" % output_file)
+    else:
+        sys.stdout.write(output + "\n")
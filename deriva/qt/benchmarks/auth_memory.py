@@ -0,0 +1,93 @@
+import sys
+import time
+import logging
+import argparse
+from PyQt5.QtCore import QObject, QTimer
+from PyQt5.QtWidgets import QApplication
+from deriva.qt import EmbeddedAuthWindow
+from deriva.qt.benchmarks import get_memory_usage, write_results
+
+
+# Repeatedly logs in to and out of a single server and samples the memory usage of the process (and of the web engine
+# processes) after every login and logout. The server must complete the login without user interaction, e.g. because
+# the identity provider session is already established or because it is a test server.
+class AuthMemoryBenchmark(QObject):
+
+    def __init__(self, server, iterations, cookie_persistence=False, settle=1000):
+        super(AuthMemoryBenchmark, self).__init__()
+        self.iterations = iterations
+        self.settle = settle
+        self.samples = list()
+        self.iteration = 0
+        self.started = 0
+        self.window = EmbeddedAuthWindow(server,
+                                         cookie_persistence=cookie_persistence,
+                                         authentication_success_callback=self.onLoginSuccess)
+
+    def sample(self, event, **kwargs):
+        sample = {"iteration": self.iteration, "event": event, "rss": get_memory_usage()}
+        sample.update(kwargs)
+        self.samples.append(sample)
+        logging.info("Iteration %d %s: %.1f MiB" % (self.iteration, event, sample["rss"] / (1024.0 * 1024.0)))
+
+    def start(self):
+        self.sample("baseline")
+        self.login()
+
+    def login(self):
+        self.iteration += 1
+        self.started = time.time()
+        self.window.login()
+
+    def onLoginSuccess(self, **kwargs):
+        login_seconds = round(time.time() - self.started, 3)
+        # give deferred deletes and the web engine a moment to release pages before sampling
+        QTimer.singleShot(self.settle, lambda: self.onLoginSettled(login_seconds))
+
+    def onLoginSettled(self, login_seconds):
+        self.sample("login", seconds=login_seconds)
+        self.window.logout(delete_cookies=True)
+        QTimer.singleShot(self.settle, self.onLogoutSettled)
+
+    def onLogoutSettled(self):
+        self.sample("logout")
+        if self.iteration < self.iterations:
+            self.login()
+        else:
+            QApplication.instance().quit()
+
+    def results(self):
+        logouts = [s["rss"] for s in self.samples if s["event"] == "logout"]
+        growth = (logouts[-1] - logouts[0]) / float(len(logouts) - 1) if len(logouts) > 1 else 0.0
+        return {"iterations": self.iteration,
+                "baseline_rss": self.samples[0]["rss"] if self.samples else 0,
+                "peak_rss": max(s["rss"] for s in self.samples) if self.samples else 0,
+                "rss_growth_per_iteration": int(growth),
+                "samples": self.samples}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure auth agent memory usage across a login/logout loop")
+    parser.add_argument("--host", required=True, help="Host to log in to.")
+    parser.add_argument("--protocol", default="https", help="Protocol to use, default: https")
+    parser.add_argument("--port", type=int, help="Port to use, default: protocol default.")
+    parser.add_argument("--iterations", type=int, default=10, help="Number of login/logout cycles.")
+    parser.add_argument("--settle", type=int, default=1000, help="Milliseconds to wait before each sample.")
+    parser.add_argument("--cookie-persistence", action="store_true", help="Use the persistent default profile.")
+    parser.add_argument("--output-file", help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    app = QApplication(sys.argv)
+    server = {"host": args.host, "protocol": args.protocol}
+    if args.port:
+        server["port"] = args.port
+    benchmark = AuthMemoryBenchmark(server, max(1, args.iterations), args.cookie_persistence, args.settle)
+    QTimer.singleShot(0, benchmark.start)
+    app.exec_()
+    write_results(benchmark.results(), args.output_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
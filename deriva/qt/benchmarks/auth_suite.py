@@ -0,0 +1,164 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from PyQt5.QtCore import QObject, QTimer
+from PyQt5.QtWidgets import QApplication
+from deriva.qt import EmbeddedAuthWindow
+from deriva.qt.benchmarks import get_memory_usage, write_results
+from deriva.qt.benchmarks.webauthn_server import WebauthnServer
+
+DEFAULT_SIZES = "1,10,50"
+DEFAULT_LIFETIME = 60
+DEFAULT_REFRESH_WINDOW = 60
+DEFAULT_LOGIN_TIMEOUT = 30
+
+
+# Runs the auth agent's login flow against local stand-in webauthn servers and reports, for each number of hosts held
+# at once: login latency, the cost of keeping the sessions refreshed, and memory per host. Each host is served by its
+# own stand-in server on a separate loopback address (127.0.0.1, 127.0.0.2, ...), since the agent keys sessions,
+# cookies and credentials by host name; this relies on the whole 127.0.0.0/8 range being routed to loopback, as it is on
+# Linux but not by default on macOS.
+class AuthBenchmarkSuite(QObject):
+
+    def __init__(self, sizes, latency=0.0, lifetime=DEFAULT_LIFETIME, refresh_window=DEFAULT_REFRESH_WINDOW,
+                 settle=1000):
+        super(AuthBenchmarkSuite, self).__init__()
+        self.sizes = list(sizes)
+        self.latency = latency
+        self.lifetime = lifetime
+        self.refresh_window = refresh_window
+        self.settle = settle
+        self.temp_dir = tempfile.mkdtemp(prefix="deriva-auth-benchmark-")
+        self.credential_file = os.path.join(self.temp_dir, "credential.json")
+        self.results = list()
+        self.result = None
+        self.servers = list()
+        self.windows = list()
+        self.pending = list()
+        self.login_host = None
+        self.login_started = 0
+        self.baseline_rss = 0
+        self.refresh_started = 0
+        self.refresh_cpu = 0
+        self.login_timer = QTimer(self)
+        self.login_timer.setSingleShot(True)
+        self.login_timer.timeout.connect(self.onLoginTimeout)
+
+    def start(self):
+        self.nextSize()
+
+    def finish(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        QApplication.instance().quit()
+
+    def nextSize(self):
+        if not self.sizes:
+            self.finish()
+            return
+        count = self.sizes.pop(0)
+        logging.info("Benchmarking with %d host(s)" % count)
+        self.servers = [WebauthnServer("127.0.0.%d" % (i + 1), 0, self.latency, self.lifetime).start()
+                        for i in range(count)]
+        self.result = {"hosts": count, "login_seconds": list(), "login_failures": 0}
+        self.baseline_rss = get_memory_usage()
+        self.pending = list(self.servers)
+        self.loginNext()
+
+    def loginNext(self):
+        if not self.pending:
+            QTimer.singleShot(self.settle, self.onLoggedIn)
+            return
+        server = self.pending.pop(0)
+        config = {"host": server.host, "port": server.port, "protocol": "http"}
+        window = EmbeddedAuthWindow(config, self.credential_file, authentication_success_callback=lambda **kwargs: None)
+        # measured up to the credential update, which precedes the widget's deferred success callback
+        window.ui.authWidget.credential_update_signal.connect(self.onCredentialUpdate)
+        self.windows.append(window)
+        self.login_host = server.host
+        self.login_started = time.perf_counter()
+        self.login_timer.start(DEFAULT_LOGIN_TIMEOUT * 1000)
+        window.login()
+
+    def onCredentialUpdate(self, host, update):
+        if update is None or host != self.login_host:
+            return
+        self.login_timer.stop()
+        self.login_host = None
+        self.result["login_seconds"].append(time.perf_counter() - self.login_started)
+        QTimer.singleShot(0, self.loginNext)
+
+    def onLoginTimeout(self):
+        logging.warning("Login to [%s] did not complete within %d seconds." % (self.login_host, DEFAULT_LOGIN_TIMEOUT))
+        self.login_host = None
+        self.result["login_failures"] += 1
+        self.loginNext()
+
+    def onLoggedIn(self):
+        count = self.result["hosts"]
+        rss = get_memory_usage()
+        self.result["rss_baseline"] = self.baseline_rss
+        self.result["rss_logged_in"] = rss
+        self.result["rss_per_host"] = int((rss - self.baseline_rss) / float(count))
+        latencies = sorted(self.result.pop("login_seconds"))
+        if latencies:
+            self.result["login_seconds_mean"] = round(sum(latencies) / len(latencies), 3)
+            self.result["login_seconds_p50"] = round(latencies[len(latencies) // 2], 3)
+            self.result["login_seconds_max"] = round(latencies[-1], 3)
+        for server in self.servers:
+            server.resetStats()
+        self.refresh_started = time.time()
+        self.refresh_cpu = time.process_time()
+        logging.info("Measuring session refresh overhead for %d seconds" % self.refresh_window)
+        QTimer.singleShot(self.refresh_window * 1000, self.onRefreshWindowElapsed)
+
+    def onRefreshWindowElapsed(self):
+        elapsed = time.time() - self.refresh_started
+        cpu = time.process_time() - self.refresh_cpu
+        refreshes = sum(server.stats()["requests"].get("PUT /authn/session", 0) for server in self.servers)
+        self.result["refresh_window_seconds"] = round(elapsed, 1)
+        self.result["refresh_requests"] = refreshes
+        self.result["refresh_cpu_seconds"] = round(cpu, 3)
+        self.result["refresh_cpu_ms_per_request"] = round(cpu * 1000.0 / refreshes, 3) if refreshes else None
+        for window in self.windows:
+            window.logout()
+            window.hide()
+            window.deleteLater()
+        self.windows = list()
+        for server in self.servers:
+            server.stop()
+        self.servers = list()
+        self.results.append(self.result)
+        logging.info("Results for %d host(s): %s" % (self.result["hosts"], self.result))
+        QTimer.singleShot(self.settle, self.nextSize)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the auth agent against local stand-in webauthn servers")
+    parser.add_argument("--hosts", default=DEFAULT_SIZES,
+                        help="Comma-separated numbers of hosts to hold at once, default: %s" % DEFAULT_SIZES)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every server response.")
+    parser.add_argument("--lifetime", type=int, default=DEFAULT_LIFETIME,
+                        help="Session lifetime in seconds, default: %d" % DEFAULT_LIFETIME)
+    parser.add_argument("--refresh-window", type=int, default=DEFAULT_REFRESH_WINDOW,
+                        help="Seconds to measure session refresh overhead for, default: %d" % DEFAULT_REFRESH_WINDOW)
+    parser.add_argument("--output-file", help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    # no display is needed
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QApplication(sys.argv)
+    suite = AuthBenchmarkSuite([int(size) for size in args.hosts.split(",") if size.strip()],
+                               args.latency, args.lifetime, args.refresh_window)
+    QTimer.singleShot(0, suite.start)
+    app.exec_()
+    write_results(suite.results, args.output_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from deriva.core import Megabyte
+from deriva.qt.benchmarks import write_results
+from deriva.qt.upload_gui.impl.chunk_reader import ChunkReader, BufferPool
+
+STRATEGIES = ("read", "pool", "mmap")
+
+
+def read_io_counter():
+    # bytes this process has read through read system calls (Linux only); pages of a memory-mapped file are not counted
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def send(fd, data):
+    view = memoryview(data)
+    sent = 0
+    while sent < len(view):
+        sent += os.write(fd, view[sent:])
+    view.release()
+
+
+def read_chunks(file_path, chunk_size, strategy, pool):
+    # yields each chunk as it would be hashed and sent: the baseline reads a new bytes object per chunk, as the object
+    # store client does; the others use the upload's chunk reader
+    if strategy == "read":
+        with open(file_path, "rb") as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                yield data
+        return
+    with ChunkReader(file_path, chunk_size, pool, mmap_threshold=1 if strategy == "mmap" else None) as reader:
+        chunks = reader.size // chunk_size + (1 if reader.size % chunk_size else 0)
+        for index in range(chunks):
+            with reader.chunk(index) as view:
+                yield view
+
+
+# Runs the chunk path of an upload (read, hash and send each chunk) over a local file, sending to a child process
+# through a pipe in place of the network, and reports per byte uploaded: the bytes newly allocated by Python along the
+# way (traced with tracemalloc, peak per chunk) and the bytes copied in by read system calls, together with throughput
+# and CPU time. Run it on a file larger than memory, or drop the page cache in between, to include disk reads.
+def run(file_path, chunk_size, strategy, pool):
+    sink = subprocess.Popen([sys.executable, "-c", "import sys\nwhile sys.stdin.buffer.read(1 << 20): pass"],
+                            stdin=subprocess.PIPE)
+    fd = sink.stdin.fileno()
+    total = 0
+    allocated = 0
+    rchar = read_io_counter()
+    cpu = time.process_time()
+    start = time.time()
+    tracemalloc.start()
+    try:
+        chunks = read_chunks(file_path, chunk_size, strategy, pool)
+        while True:
+            # memory already traced (such as pooled buffers) is not counted again for each chunk
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            data = next(chunks, None)
+            if data is None:
+                break
+            hashlib.md5(data).digest()
+            send(fd, data)
+            total += len(data)
+            del data
+            allocated += tracemalloc.get_traced_memory()[1] - baseline
+        # taken before the sink is reaped, since the counters of a child are added to its parent's when it is
+        read_bytes = read_io_counter() - rchar if rchar is not None else None
+    finally:
+        tracemalloc.stop()
+        sink.stdin.close()
+        sink.wait()
+    elapsed = time.time() - start
+    return {"bytes": total,
+            "elapsed": round(elapsed, 3),
+            "throughput_mb_per_second": round(total / Megabyte / elapsed, 1) if elapsed else None,
+            "cpu_seconds": round(time.process_time() - cpu, 3),
+            "allocated_bytes_per_byte": round(allocated / total, 4) if total else None,
+            "read_copied_bytes_per_byte": round(read_bytes / total, 4) if total and read_bytes is not None else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the bytes allocated and copied per byte uploaded by the "
+                                                 "upload chunk path, with fresh, pooled or memory-mapped buffers")
+    parser.add_argument("--file", help="File to read; by default a temporary file of --size-mb is created.")
+    parser.add_argument("--size-mb", type=int, default=512, help="Size of the temporary file in MB.")
+    parser.add_argument("--chunk-mb", type=int, default=10, help="Chunk size in MB.")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES),
+                        help="Comma-separated strategies to run: %s." % ", ".join(STRATEGIES))
+    parser.add_argument("--output-file", help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    file_path = args.file
+    temp_file = None
+    if not file_path:
+        fd, temp_file = tempfile.mkstemp(prefix="deriva-upload-benchmark-")
+        with os.fdopen(fd, "wb") as f:
+            block = os.urandom(Megabyte)
+            for i in range(args.size_mb):
+                f.write(block)
+        file_path = temp_file
+    chunk_size = args.chunk_mb * Megabyte
+    results = {"parameters": vars(args), "strategies": dict()}
+    try:
+        for strategy in [s.strip() for s in args.strategies.split(",") if s.strip()]:
+            if strategy not in STRATEGIES:
+                parser.error("Unknown strategy: %s" % strategy)
+            result = run(file_path, chunk_size, strategy, BufferPool(1))
+            results["strategies"][strategy] = result
+            logging.info("%-5s %8.1f MB/s  cpu %7.2fs  allocated %.4f B/B  read copies %s B/B" % (
+                strategy, result["throughput_mb_per_second"] or 0, result["cpu_seconds"],
+                result["allocated_bytes_per_byte"], result["read_copied_bytes_per_byte"]))
+    finally:
+        if temp_file:
+            os.remove(temp_file)
+    write_results(results, args.output_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import sys
+import heapq
+import random
+import logging
+import argparse
+from collections import namedtuple
+from deriva.qt.benchmarks import write_results
+from deriva.qt.upload_gui.impl.upload_order import UPLOAD_ORDER_POLICIES
+from deriva.qt.upload_gui.impl.upload_pipeline import DEFAULT_HASH_QUEUE_SIZE
+
+MB = 1024 * 1024
+SimulatedStat = namedtuple("SimulatedStat", ["st_size", "st_dev", "st_ino"])
+
+
+def generate_files(count, directories, distribution, median, sigma, seed):
+    # file sizes in bytes, spread over directories; within a directory the inode numbers follow the order the files were
+    # written in, while the scan order (like a directory listing on most file systems) does not
+    rng = random.Random(seed)
+    stats = dict()
+    scanned = list()
+    for d in range(directories):
+        paths = list()
+        for i in range(count // directories + (1 if d < count % directories else 0)):
+            if distribution == "lognormal":
+                size = rng.lognormvariate(0, sigma) * median
+            elif distribution == "pareto":
+                size = rng.paretovariate(1.0 / sigma) * median / 2 ** sigma
+            else:
+                size = median
+            path = "/simulated/dir%04d/file%06d" % (d, i)
+            stats[path] = SimulatedStat(int(size), 1, d * 1000000 + i)
+            paths.append(path)
+        rng.shuffle(paths)
+        scanned.extend(paths)
+    return stats, [(0, {}, {}, path) for path in scanned]
+
+
+# Computes the completion time of an upload job through the hash, transfer and registration stages of the upload
+# pipeline, given the order of its files. Hashing reads a file from disk, paying a seek unless the file is the next one
+# on disk after the previous; transfers run on a number of parallel slots (one in the current uploader); registration
+# takes a fixed time per file, on one thread, in the order transfers finish. The hash queue is bounded as in the
+# pipeline, the registration queue is taken to be unbounded.
+def simulate(entries, stats, disk_rate, seek_time, network_rate, transfer_overhead, register_time, transfers,
+             hash_queue_size=DEFAULT_HASH_QUEUE_SIZE):
+    previous = None
+    hash_free = 0.0
+    seeks = 0
+    taken = list()
+    slots = [0.0] * transfers
+    finished = list()
+    transfer_busy = 0.0
+    for n, entry in enumerate(entries):
+        st = stats[entry[3]]
+        seek = 0.0
+        if previous is None or (previous.st_dev, previous.st_ino + 1) != (st.st_dev, st.st_ino):
+            seek = seek_time
+            seeks += 1
+        previous = st
+        hashed = hash_free + seek + st.st_size / disk_rate
+        # the hash stage blocks until the transfer stage has taken the file queued hash_queue_size files earlier
+        queued = max(hashed, taken[n - hash_queue_size] if n >= hash_queue_size else 0.0)
+        hash_free = queued
+        slot = heapq.heappop(slots)
+        start = max(queued, slot)
+        duration = transfer_overhead + st.st_size / network_rate
+        transfer_busy += duration
+        taken.append(start)
+        heapq.heappush(slots, start + duration)
+        finished.append(start + duration)
+    register_free = 0.0
+    for end in sorted(finished):
+        register_free = max(register_free, end) + register_time
+    makespan = register_free
+    last_start = max(taken) if taken else 0.0
+    return {"makespan": round(makespan, 3),
+            "tail": round(makespan - last_start, 3),
+            "seeks": seeks,
+            "transfer_utilization": round(transfer_busy / (makespan * transfers), 3) if makespan else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the makespan of an upload job under each upload order "
+                                                 "policy, for a given file size distribution")
+    parser.add_argument("--files", type=int, default=1000, help="Number of files.")
+    parser.add_argument("--directories", type=int, default=20, help="Number of directories the files are spread over.")
+    parser.add_argument("--distribution", choices=["lognormal", "pareto", "fixed"], default="lognormal",
+                        help="File size distribution.")
+    parser.add_argument("--median-mb", type=float, default=8.0, help="Median file size in MB.")
+    parser.add_argument("--sigma", type=float, default=2.0,
+                        help="Spread of the size distribution (lognormal sigma, or the inverse of the pareto shape).")
+    parser.add_argument("--disk-mbps", type=float, default=150.0, help="Sequential disk read rate in MB/s.")
+    parser.add_argument("--seek-ms", type=float, default=8.0, help="Disk seek time in milliseconds.")
+    parser.add_argument("--network-mbps", type=float, default=100.0, help="Transfer rate per transfer slot in MB/s.")
+    parser.add_argument("--transfer-overhead-ms", type=float, default=150.0,
+                        help="Fixed cost of a transfer in milliseconds (object store round trips).")
+    parser.add_argument("--register-ms", type=float, default=100.0, help="Catalog registration time per file in ms.")
+    parser.add_argument("--transfers", type=int, default=1, help="Number of parallel transfer slots.")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed.")
+    parser.add_argument("--output-file", help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    stats, scanned = generate_files(args.files, max(args.directories, 1), args.distribution, args.median_mb * MB,
+                                    args.sigma, args.seed)
+    results = {"parameters": vars(args),
+               "total_mb": round(sum(st.st_size for st in stats.values()) / MB, 1),
+               "largest_mb": round(max(st.st_size for st in stats.values()) / MB, 1),
+               "policies": dict()}
+    for policy, (label, order) in UPLOAD_ORDER_POLICIES.items():
+        entries = order(scanned, stats.get) if order else scanned
+        result = simulate(entries, stats, args.disk_mbps * MB, args.seek_ms / 1000.0, args.network_mbps * MB,
+                          args.transfer_overhead_ms / 1000.0, args.register_ms / 1000.0, max(args.transfers, 1))
+        results["policies"][policy] = result
+        logging.info("%-30s makespan %9.1fs  tail %8.1fs  seeks %6d  transfer utilization %5.1f%%" % (
+            label, result["makespan"], result["tail"], result["seeks"], 100.0 * result["transfer_utilization"]))
+    write_results(results, args.output_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
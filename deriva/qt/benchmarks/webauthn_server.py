@@ -0,0 +1,201 @@
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+import urllib.parse
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+DEFAULT_COOKIE_NAME = "webauthn"
+DEFAULT_SESSION_LIFETIME = 1800
+
+LOGIN_HTML = '<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><title>Login</title></head>' \
+             '<body>Logged in to the webauthn stand-in server.</body></html>'
+
+
+# A minimal stand-in for the webauthn endpoints of a DERIVA server, enough to drive the auth agent's login flow end to
+# end without an identity provider:
+#   GET  /authn/preauth              -> {"redirect_url": "<server>/authn/login"}
+#   GET  /authn/login                -> sets the session cookie, as an identity provider login would
+#   GET  /authn/session              -> the session, or 404 if there is none
+#   PUT  /authn/session              -> extends the session
+#   DELETE /authn/session            -> ends the session
+#   GET  /_stats                     -> request counts per method and path (not part of webauthn)
+# It is meant for tests and benchmarks only: there are no identities and every login succeeds.
+class WebauthnRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+    def _send(self, status, body=None, content_type="application/json", headers=None):
+        payload = b""
+        if body is not None:
+            payload = (json.dumps(body) if content_type == "application/json" else body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or []):
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def _sessionId(self):
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        morsel = cookie.get(self.server.cookie_name)
+        return morsel.value if morsel else None
+
+    def _handle(self):
+        path = urllib.parse.urlsplit(self.path).path
+        self.server.count(self.command, path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        handler = getattr(self, "_%s_%s" % (self.command.lower(), path.strip("/").replace("/", "_")), None)
+        if handler is None:
+            self._send(404, {"error": "not found: %s %s" % (self.command, path)})
+            return
+        handler()
+
+    do_GET = do_PUT = do_DELETE = do_HEAD = _handle
+
+    def _get_authn_preauth(self):
+        self._send(200, {"redirect_url": "%s/authn/login" % self.server.url})
+
+    def _get_authn_login(self):
+        sid = self.server.createSession()
+        cookie = "%s=%s; Path=/; HttpOnly" % (self.server.cookie_name, sid)
+        self._send(200, LOGIN_HTML, content_type="text/html", headers=[("Set-Cookie", cookie)])
+
+    def _get_authn_session(self):
+        session = self.server.getSession(self._sessionId())
+        if session is None:
+            self._send(404, {"error": "no session"})
+        else:
+            self._send(200, session)
+
+    _head_authn_session = _get_authn_session
+
+    def _put_authn_session(self):
+        session = self.server.extendSession(self._sessionId())
+        if session is None:
+            self._send(404, {"error": "no session"})
+        else:
+            self._send(200, session)
+
+    def _delete_authn_session(self):
+        self.server.deleteSession(self._sessionId())
+        self._send(200, {"logout_url": "/"})
+
+    def _get__stats(self):
+        self._send(200, self.server.stats())
+
+
+class WebauthnServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, lifetime=DEFAULT_SESSION_LIFETIME,
+                 cookie_name=DEFAULT_COOKIE_NAME):
+        HTTPServer.__init__(self, (host, port), WebauthnRequestHandler)
+        self.host = host
+        self.port = self.server_address[1]
+        self.url = "http://%s:%d" % (host, self.port)
+        self.latency = latency
+        self.lifetime = lifetime
+        self.cookie_name = cookie_name
+        self.sessions = dict()
+        self.counts = dict()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="webauthn-%d" % self.port, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, method, path):
+        with self.lock:
+            key = "%s %s" % (method, path)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {"requests": dict(self.counts), "sessions": len(self.sessions)}
+
+    def resetStats(self):
+        with self.lock:
+            self.counts.clear()
+
+    def createSession(self):
+        sid = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.sessions[sid] = {"since": now, "expires": now + self.lifetime}
+        return sid
+
+    def _render(self, sid, entry):
+        now = time.time()
+        return {"client": {"id": "stand-in-user-%s" % sid[:8], "display_name": "stand-in user"},
+                "attributes": [],
+                "since": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(entry["since"])),
+                "expires": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(entry["expires"])),
+                "seconds_remaining": max(0, int(entry["expires"] - now)),
+                "vary_headers": ["cookie"]}
+
+    def getSession(self, sid):
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None:
+                return None
+            if entry["expires"] <= time.time():
+                del self.sessions[sid]
+                return None
+            return self._render(sid, entry)
+
+    def extendSession(self, sid):
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None or entry["expires"] <= time.time():
+                self.sessions.pop(sid, None)
+                return None
+            entry["expires"] = time.time() + self.lifetime
+            return self._render(sid, entry)
+
+    def deleteSession(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in webauthn server for testing the DERIVA auth agent")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on, default: 127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on, default: 8080")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response.")
+    parser.add_argument("--lifetime", type=int, default=DEFAULT_SESSION_LIFETIME,
+                        help="Session lifetime in seconds, default: %d" % DEFAULT_SESSION_LIFETIME)
+    parser.add_argument("--cookie-name", default=DEFAULT_COOKIE_NAME, help="Session cookie name.")
+    parser.add_argument("--debug", action="store_true", help="Log every request.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
+                        level=logging.DEBUG if args.debug else logging.INFO)
+    server = WebauthnServer(args.host, args.port, args.latency, args.lifetime, args.cookie_name)
+    logging.info("Stand-in webauthn server listening on: %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
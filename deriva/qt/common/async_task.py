@@ -2,9 +2,11 @@ import sys
 from PyQt5.QtCore import Qt, QObject, QThreadPool, QRunnable, pyqtSignal
 
 
-def async_execute(method, args, uid, success_callback, error_callback=None):
+def async_execute(method, args, uid, success_callback, error_callback=None, thread_pool=None):
     request = Request(method, args, uid, success_callback, error_callback)
-    QThreadPool.globalInstance().start(request)
+    if thread_pool is None:
+        thread_pool = QThreadPool.globalInstance()
+    thread_pool.start(request)
     return request
 
 
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import logging
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from PyQt5.QtCore import QObject, QTimer, QCoreApplication
+from deriva.core import format_exception, DEFAULT_CREDENTIAL_FILE
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+# updates arriving within this many milliseconds of the first pending one are written together
+DEFAULT_WRITE_DELAY = 250
+# on Windows the target of a rename cannot be replaced while another process has it open for reading
+DEFAULT_REPLACE_RETRIES = 10
+DEFAULT_REPLACE_RETRY_DELAY = 0.05
+
+
+@contextmanager
+def locked(path):
+    # an advisory lock on a sidecar file rather than on the credential file itself, since that file is replaced (and
+    # its lock lost with it) on every write
+    with open(path + ".lock", "a+") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# Reads and writes the credential file shared by the auth agent and the command-line tools. Writes are debounced and
+# merged into the current contents of the file under an inter-process lock, then written to a temporary file that
+# atomically replaces the credential file, so readers never see a partially written file. Reads are served from a cache
+# that is validated against the file's stat, so repeated reads cost a stat rather than a parse.
+class CredentialStore(QObject):
+    _instances = dict()
+
+    def __init__(self, credential_file=None, write_delay=DEFAULT_WRITE_DELAY, parent=None):
+        super(CredentialStore, self).__init__(parent)
+        self.credential_file = os.path.abspath(credential_file if credential_file else DEFAULT_CREDENTIAL_FILE)
+        self.pending = OrderedDict()
+        self.cache = None
+        self.cache_key = None
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(write_delay)
+        self._timer.timeout.connect(self.flush)
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.flush)
+
+    @classmethod
+    def instance(cls, credential_file=None):
+        path = os.path.abspath(credential_file if credential_file else DEFAULT_CREDENTIAL_FILE)
+        store = cls._instances.get(path)
+        if store is None:
+            store = cls._instances[path] = CredentialStore(path)
+        return store
+
+    def _stat(self):
+        try:
+            st = os.stat(self.credential_file)
+            return st.st_mtime_ns, st.st_size, st.st_ino
+        except OSError:
+            return None
+
+    def _load(self):
+        key = self._stat()
+        if key is None:
+            return OrderedDict()
+        if key != self.cache_key:
+            with open(self.credential_file, encoding="utf-8") as cf:
+                self.cache = json.load(cf, object_pairs_hook=OrderedDict)
+            self.cache_key = key
+        return self.cache
+
+    def read(self):
+        # updates that are still waiting to be written are visible to readers in this process; the credentials are
+        # copies, so that changes made by a caller are not written back
+        credentials = OrderedDict((host, self._copy(credential)) for host, credential in self._load().items())
+        for host, credential in self.pending.items():
+            if credential is None:
+                credentials.pop(host, None)
+            else:
+                credentials[host] = self._copy(credential)
+        return credentials
+
+    def get(self, host):
+        for key in (host, host.lower()):
+            if key in self.pending:
+                return self._copy(self.pending[key])
+        credentials = self._load()
+        return self._copy(credentials.get(host, credentials.get(host.lower())))
+
+    @staticmethod
+    def _copy(credential):
+        return credential.copy() if isinstance(credential, dict) else credential
+
+    def update(self, host, credential):
+        self.pending[host] = dict(credential) if credential is not None else None
+        # not restarted by later updates, so that a steady stream of updates cannot postpone the write indefinitely
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def remove(self, host):
+        self.update(host, None)
+
+    def flush(self):
+        self._timer.stop()
+        if not self.pending:
+            return True
+        pending = self.pending
+        self.pending = OrderedDict()
+        try:
+            self._write(pending)
+            return True
+        except Exception as e:
+            logging.error("Unable to write credential file [%s]: %s" % (self.credential_file, format_exception(e)))
+            # keep the updates that did not make it, unless they have been superseded in the meantime
+            for host, credential in pending.items():
+                self.pending.setdefault(host, credential)
+            return False
+
+    def _write(self, updates):
+        credential_dir = os.path.dirname(self.credential_file)
+        os.makedirs(credential_dir, mode=0o750, exist_ok=True)
+        with locked(self.credential_file):
+            # merge into what is on disk now, which may include updates made by other processes
+            credentials = OrderedDict(self._load())
+            for host, credential in updates.items():
+                if credential is None:
+                    credentials.pop(host, None)
+                else:
+                    credentials[host] = credential
+            # mkstemp creates the file readable and writable by the owner only
+            fd, temp_path = tempfile.mkstemp(prefix=".credential-", suffix=".tmp", dir=credential_dir)
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as tf:
+                    tf.write(json.dumps(credentials, ensure_ascii=False, indent=2))
+                    tf.flush()
+                    os.fsync(tf.fileno())
+                self._replace(temp_path)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            self.cache = credentials
+            self.cache_key = self._stat()
+        logging.debug("Wrote %d credential update(s) to: %s" % (len(updates), self.credential_file))
+
+    def _replace(self, temp_path):
+        for attempt in range(DEFAULT_REPLACE_RETRIES):
+            try:
+                os.replace(temp_path, self.credential_file)
+                return
+            except PermissionError:
+                if attempt == DEFAULT_REPLACE_RETRIES - 1:
+                    raise
+                time.sleep(DEFAULT_REPLACE_RETRY_DELAY)
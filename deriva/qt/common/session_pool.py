@@ -0,0 +1,128 @@
+import json
+import logging
+import threading
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from deriva.core import format_exception, DEFAULT_SESSION_CONFIG
+from deriva.qt.common.async_task import async_execute
+
+# a pooled session only ever talks to one host, so a single connection pool per adapter is enough
+DEFAULT_POOL_CONNECTIONS = 1
+DEFAULT_POOL_MAXSIZE = 8
+DEFAULT_WARMUP_CONNECTIONS = 2
+DEFAULT_WARMUP_TIMEOUT = 10
+DEFAULT_WARMUP_PATH = "/authn/session"
+
+
+# Process-wide pool of requests sessions, one per host (scheme, host and port), so that cookies are never shared across
+# hosts and kept-alive connections opened by the auth agent can be reused by anything else talking to the same host.
+class SessionPool(object):
+    _sessions = dict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def getKey(url):
+        url = urllib.parse.urlsplit(url)
+        return "%s://%s" % (url.scheme.lower(), url.netloc.lower())
+
+    @staticmethod
+    def newSession(url, pool_maxsize=DEFAULT_POOL_MAXSIZE, session_config=DEFAULT_SESSION_CONFIG):
+        # as deriva.core.get_new_requests_session: every method is retried on the listed status codes
+        kwargs = dict(connect=session_config['retry_connect'],
+                      read=session_config['retry_read'],
+                      backoff_factor=session_config['retry_backoff_factor'],
+                      status_forcelist=session_config['retry_status_forcelist'],
+                      raise_on_status=True)
+        try:
+            retries = Retry(allowed_methods=False, **kwargs)
+        except TypeError:
+            # urllib3 < 1.26
+            retries = Retry(method_whitelist=False, **kwargs)
+        session = requests.session()
+        session.headers.update({"Connection": "keep-alive"})
+        session.mount(url + '/', HTTPAdapter(pool_connections=DEFAULT_POOL_CONNECTIONS,
+                                             pool_maxsize=pool_maxsize,
+                                             max_retries=retries))
+        return session
+
+    @classmethod
+    def getSession(cls, url, pool_maxsize=DEFAULT_POOL_MAXSIZE, session_config=None):
+        # sessions built from a server's own session config (retries, backoff, status codes to retry) are pooled
+        # separately from those built from the default config
+        key = cls.getKey(url)
+        config = cls.getConfig(session_config)
+        pool_key = key if config == DEFAULT_SESSION_CONFIG else (key, json.dumps(config, sort_keys=True))
+        with cls._lock:
+            session = cls._sessions.get(pool_key)
+            if session is None:
+                logging.debug("Creating pooled HTTP session for [%s] with pool size %d%s" %
+                              (key, pool_maxsize, "" if pool_key == key else " and custom session config"))
+                session = cls.newSession(key, pool_maxsize, config)
+                cls._sessions[pool_key] = session
+            return session
+
+    @staticmethod
+    def getConfig(session_config=None):
+        config = dict(DEFAULT_SESSION_CONFIG)
+        if session_config:
+            config.update(session_config)
+        return config
+
+    @classmethod
+    def hasSession(cls, url):
+        with cls._lock:
+            return cls.getKey(url) in cls._sessions
+
+    @classmethod
+    def release(cls, url):
+        key = cls.getKey(url)
+        with cls._lock:
+            pool_keys = [pool_key for pool_key in cls._sessions.keys()
+                         if pool_key == key or (isinstance(pool_key, tuple) and pool_key[0] == key)]
+            sessions = [cls._sessions.pop(pool_key) for pool_key in pool_keys]
+        for session in sessions:
+            session.close()
+
+    @classmethod
+    def warmup(cls, url, connections=DEFAULT_WARMUP_CONNECTIONS, path=DEFAULT_WARMUP_PATH, session_config=None):
+        # open (and TLS handshake) a few connections in the background so that the first real request, for example
+        # the first chunk of an upload, does not have to pay for connection setup. The connections are opened by the
+        # pooled session of the given session config, which is the one they can be reused by.
+        key = cls.getKey(url)
+        session = cls.getSession(key, session_config=session_config)
+        for i in range(connections):
+            async_execute(cls._warmupConnection, [session, key + path], i, cls._onWarmupResult)
+
+    @staticmethod
+    def _warmupConnection(session, url):
+        # runs on a pool thread; failures are not interesting enough to be reported back to the caller
+        try:
+            status_code = session.head(url, timeout=DEFAULT_WARMUP_TIMEOUT).status_code
+            logging.debug("Connection warm-up for [%s] completed with status: %s" % (url, status_code))
+            return status_code
+        except Exception as e:
+            logging.debug("Connection warm-up for [%s] failed: %s" % (url, format_exception(e)))
+
+    @staticmethod
+    def _onWarmupResult(uid, status_code):
+        pass
+
+    @classmethod
+    def adopt(cls, binding, url, session_config=None):
+        # swap the private session of a DerivaBinding (catalog, store) for the pooled session of the same host,
+        # carrying over cookies and any Authorization header so that existing credentials remain in effect. The
+        # session_config the binding was created with must be passed in, so that its retry policy is kept.
+        current = getattr(binding, "_session", None)
+        if current is None:
+            return False
+        session = cls.getSession(url, session_config=session_config)
+        if current is session:
+            return True
+        session.cookies.update(current.cookies)
+        authorization = current.headers.get("Authorization")
+        if authorization:
+            session.headers["Authorization"] = authorization
+        binding._session = session
+        return True
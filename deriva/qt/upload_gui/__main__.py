@@ -1,4 +1,5 @@
 import sys
+import multiprocessing
 from deriva.transfer import GenericUploader
 from deriva.qt import DerivaUploadGUI
 
@@ -13,4 +14,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # checksums are computed in worker processes, which a frozen executable has to be able to start
+    multiprocessing.freeze_support()
     sys.exit(main())
@@ -1,12 +1,11 @@
 import sys
+import logging
 import traceback
 
 from PyQt5 import QtCore
-from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QApplication, QStyleFactory, QMessageBox
-from deriva.core import format_exception, BaseCLI
+from deriva.core import format_exception, BaseCLI, Megabyte
 from deriva.transfer import DerivaUpload
-from deriva.qt import UploadWindow
+from deriva.qt.upload_gui.impl.bandwidth import parse_bandwidth_schedule
 
 
 class DerivaUploadGUI(BaseCLI):
@@ -27,7 +26,11 @@ class DerivaUploadGUI(BaseCLI):
                    hostname=None,
                    window_title=None,
                    window_icon=None,
-                   cookie_persistence=True):
+                   cookie_persistence=True,
+                   transfer_options=None):
+        from PyQt5.QtGui import QIcon
+        from PyQt5.QtWidgets import QApplication, QStyleFactory
+        from deriva.qt import UploadWindow
 
         QApplication.setDesktopSettingsAware(False)
         QApplication.setStyle(QStyleFactory.create("Fusion"))
@@ -40,14 +43,35 @@ class DerivaUploadGUI(BaseCLI):
                               credential_file,
                               hostname,
                               window_title=window_title,
-                              cookie_persistence=cookie_persistence)
+                              cookie_persistence=cookie_persistence,
+                              transfer_options=transfer_options)
         window.show()
         ret = app.exec_()
 
         return ret
 
+    @staticmethod
+    def upload_headless(uploader,
+                        directory,
+                        config_file=None,
+                        credential_file=None,
+                        hostname=None,
+                        purge_state=False,
+                        upload_order=None,
+                        transfer_options=None,
+                        verify=False,
+                        debug=False):
+        # QtCore only: no widget or web engine modules are loaded in this process
+        from deriva.qt.upload_gui.impl.headless_uploader import run_headless
+        from deriva.qt.upload_gui.impl.upload_order import UPLOAD_ORDER_SCAN
+        logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
+                            level=logging.DEBUG if debug else logging.INFO)
+        return run_headless(uploader, directory, config_file, credential_file, hostname, purge_state,
+                            upload_order if upload_order else UPLOAD_ORDER_SCAN, transfer_options, verify)
+
     @staticmethod
     def excepthook(etype, value, tb):
+        from PyQt5.QtWidgets import QMessageBox
         traceback.print_tb(tb)
         sys.stderr.write(format_exception(value))
         msg = QMessageBox()
@@ -59,12 +83,57 @@ class DerivaUploadGUI(BaseCLI):
         msg.exec_()
 
     def main(self):
-        sys.excepthook = DerivaUploadGUI.excepthook
         sys.stderr.write("\n")
         self.parser.add_argument(
             "--no-persistence", action="store_true",
             help="Disable cookie and local storage persistence for QtWebEngine.")
+        self.parser.add_argument(
+            "--headless", action="store_true",
+            help="Run without a user interface: upload the directory given by --directory using the stored "
+                 "credential for the server, writing progress to stdout as line-delimited JSON.")
+        self.parser.add_argument(
+            "--directory", metavar="<path>",
+            help="In headless mode, the directory to upload, or a zip or tar archive whose files are uploaded without "
+                 "extracting it.")
+        self.parser.add_argument(
+            "--purge-state", action="store_true",
+            help="In headless mode, discard saved transfer state and start any interrupted uploads over.")
+        self.parser.add_argument(
+            "--upload-order", choices=["scan", "largest", "smallest", "interleaved", "locality"], default="scan",
+            help="In headless mode, the order in which the files of each asset group are uploaded.")
+        self.parser.add_argument(
+            "--verify-uploads", action="store_true",
+            help="In headless mode, check the size and checksums of the uploaded objects on the server against the "
+                 "local files once the upload is done.")
+        self.parser.add_argument(
+            "--transfer-concurrency", type=int, metavar="<n>",
+            help="Pin the number of chunk requests in flight per file, instead of adapting it to the network.")
+        self.parser.add_argument(
+            "--chunk-size", type=int, metavar="<MB>",
+            help="Pin the chunk size of new upload jobs in megabytes, instead of adapting it to the network.")
+        self.parser.add_argument(
+            "--bandwidth-limit", type=parse_bandwidth_schedule, metavar="<schedule>",
+            help="Limit the upload rate, in MB/s: either a single rate, or comma-separated time of day windows, "
+                 "e.g. \"08:00-18:00=20\" for 20 MB/s during working hours and no limit otherwise.")
         args = self.parse_cli()
+        transfer_options = {"concurrency": args.transfer_concurrency,
+                            "chunk_size": args.chunk_size * Megabyte if args.chunk_size else None,
+                            "bandwidth_schedule": args.bandwidth_limit}
+        if args.headless:
+            if not args.directory:
+                self.parser.error("--headless requires --directory")
+            return self.upload_headless(self.uploader,
+                                        args.directory,
+                                        config_file=args.config_file,
+                                        credential_file=args.credential_file,
+                                        hostname=args.host,
+                                        purge_state=args.purge_state,
+                                        upload_order=args.upload_order,
+                                        transfer_options=transfer_options,
+                                        verify=args.verify_uploads,
+                                        debug=args.debug)
+
+        sys.excepthook = DerivaUploadGUI.excepthook
         if self.cookie_persistence:
             self.cookie_persistence = not args.no_persistence
 
@@ -74,5 +143,6 @@ class DerivaUploadGUI(BaseCLI):
                               hostname=args.host,
                               window_title="%s %s" % (self.parser.description, self.uploader.getVersion()),
                               window_icon=self.window_icon,
-                              cookie_persistence=self.cookie_persistence)
+                              cookie_persistence=self.cookie_persistence,
+                              transfer_options=transfer_options)
         return ret
@@ -0,0 +1,307 @@
+import io
+import os
+import time
+import struct
+import logging
+import tarfile
+import zipfile
+import threading
+import posixpath
+from collections import namedtuple, OrderedDict
+from deriva.transfer.upload.deriva_upload import UploadState, FileUploadState
+
+# a file inside an archive is named by the path of the archive and the path of the file within it, e.g.
+# "/data/run42.tar.gz!/images/frame_0001.tif", which is what the asset mappings of the configuration are matched against
+ARCHIVE_SEPARATOR = "!/"
+ZIP_EXTENSIONS = (".zip",)
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")
+
+# offset is where the bytes of the file start within the archive, if they are stored there as they are (uncompressed
+# tar, or "stored" zip members, for which it is -1 until it has been read from the member's local header); otherwise the
+# file has to be read by decompressing the archive or member
+ArchiveMember = namedtuple("ArchiveMember", ["name", "size", "mtime", "index", "offset", "info"])
+MemberStat = namedtuple("MemberStat", ["st_size", "st_mtime", "st_mtime_ns", "st_dev", "st_ino"])
+
+indexes = dict()
+index_lock = threading.Lock()
+# open archives, one per archive and thread, so that the files of a compressed archive that are read one after the
+# other by a thread are read with one pass over the archive
+streams = dict()
+stream_lock = threading.Lock()
+
+
+def is_archive(path):
+    name = path.lower()
+    return name.endswith(ZIP_EXTENSIONS + TAR_EXTENSIONS) and os.path.isfile(path)
+
+
+def split_member_path(path):
+    # returns the archive path and member name of a path within an archive, otherwise the path and None
+    index = path.find(ARCHIVE_SEPARATOR)
+    while index > 0:
+        if is_archive(path[:index]):
+            return path[:index], path[index + len(ARCHIVE_SEPARATOR):]
+        index = path.find(ARCHIVE_SEPARATOR, index + 1)
+    return path, None
+
+
+def is_member_path(path):
+    return ARCHIVE_SEPARATOR in path and split_member_path(path)[1] is not None
+
+
+def make_member_path(archive, name):
+    return archive + ARCHIVE_SEPARATOR + name
+
+
+def get_state_directory(root):
+    # the uploader keeps the transfer state of an archive in the directory the archive is in
+    return os.path.dirname(root) if is_archive(root) else root
+
+
+def normalize_member_name(name):
+    name = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    return None if name in ("", ".") or name.startswith("../") else name
+
+
+def list_zip(archive):
+    members = OrderedDict()
+    with zipfile.ZipFile(archive) as zf:
+        for index, info in enumerate(zf.infolist()):
+            name = normalize_member_name(info.filename)
+            if info.filename.endswith("/") or not name:
+                continue
+            stored = info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1
+            members[name] = ArchiveMember(name, info.file_size, time.mktime(info.date_time + (0, 0, -1)), index,
+                                          -1 if stored else None, info)
+    return members
+
+
+def list_tar(archive):
+    members = OrderedDict()
+    try:
+        tf = tarfile.open(archive, "r:")
+        compressed = False
+    except tarfile.ReadError:
+        tf = tarfile.open(archive, "r:*")
+        compressed = True
+    with tf:
+        for index, info in enumerate(tf):
+            name = normalize_member_name(info.name)
+            if not (info.isreg() and name):
+                continue
+            offset = None if compressed or info.issparse() else info.offset_data
+            members[name] = ArchiveMember(name, info.size, info.mtime, index, offset, info)
+        # the member list is not needed once the index has been built
+        tf.members = list()
+    return members
+
+
+def get_archive_index(archive):
+    st = os.stat(archive)
+    key = (st.st_size, st.st_mtime_ns)
+    with index_lock:
+        entry = indexes.get(archive)
+    if entry and entry[0] == key:
+        return entry[1]
+    start = time.time()
+    members = list_zip(archive) if archive.lower().endswith(ZIP_EXTENSIONS) else list_tar(archive)
+    logging.debug("Listed %d file(s) in archive [%s] in %.1fs" % (len(members), archive, time.time() - start))
+    with index_lock:
+        indexes[archive] = (key, members)
+    return members
+
+
+def get_member(path):
+    archive, name = split_member_path(path)
+    member = get_archive_index(archive).get(name) if name is not None else None
+    if member is None:
+        raise FileNotFoundError("No such file in archive: %s" % path)
+    return archive, member
+
+
+def get_member_location(path):
+    # (archive, offset, size) of a file stored in an archive as it is, which can be read in place; None otherwise
+    archive, member = get_member(path)
+    offset = member.offset
+    if offset == -1:
+        with open(archive, "rb") as fp:
+            fp.seek(member.info.header_offset)
+            signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(fp.read(ZIP_LOCAL_HEADER.size))
+        if signature != b"PK\x03\x04":
+            raise zipfile.BadZipFile("Bad local file header for %s" % path)
+        offset = member.info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
+        with index_lock:
+            key, members = indexes[archive]
+            members[member.name] = member._replace(offset=offset)
+    return (archive, offset, member.size) if offset is not None else None
+
+
+def get_file_stat(path):
+    if not is_member_path(path):
+        return os.stat(path)
+    archive, member = get_member(path)
+    st = os.stat(archive)
+    # the member's position in the archive stands in for the inode number, so that ordering files by disk locality
+    # reads an archive from start to end
+    return MemberStat(member.size, member.mtime, int(member.mtime * 1e9), st.st_dev, member.index + 1)
+
+
+def get_file_size(path):
+    return get_file_stat(path).st_size
+
+
+def get_stat_key(path):
+    # the size and modification time of a file, under which checksums computed for it are cached; None if it is gone
+    try:
+        st = get_file_stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def is_file(path):
+    try:
+        return os.path.isfile(path) if not is_member_path(path) else bool(get_member(path))
+    except (OSError, ValueError):
+        return False
+
+
+class MemberFile(io.RawIOBase):
+    # a read-only file of the bytes of a member stored in an archive as they are
+
+    def __init__(self, archive, offset, size):
+        super(MemberFile, self).__init__()
+        self.fp = open(archive, "rb")
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, min(offset, self.size))
+        return self.position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        length = min(len(view), self.size - self.position)
+        if length <= 0:
+            return 0
+        self.fp.seek(self.offset + self.position)
+        count = self.fp.readinto(view[:length])
+        self.position += count
+        return count
+
+    def close(self):
+        self.fp.close()
+        super(MemberFile, self).close()
+
+
+def open_stream(archive):
+    key = (archive, threading.current_thread().ident)
+    with stream_lock:
+        stream = streams.get(key)
+        if stream is None:
+            stream = zipfile.ZipFile(archive) if archive.lower().endswith(ZIP_EXTENSIONS) else \
+                tarfile.open(archive, "r:*")
+            streams[key] = stream
+    return stream
+
+
+def close_streams():
+    with stream_lock:
+        for stream in streams.values():
+            try:
+                stream.close()
+            except Exception:
+                pass
+        streams.clear()
+
+
+def open_file(path):
+    # opens a file, or a file in an archive, for reading. A compressed member is decompressed as it is read, from an
+    # archive that stays open for the calling thread: reading the members of a compressed tar file in their order in
+    # the archive takes one pass over it, while going back to an earlier member starts again from the beginning.
+    if not is_member_path(path):
+        return open(path, "rb")
+    location = get_member_location(path)
+    if location:
+        return MemberFile(*location)
+    archive, member = get_member(path)
+    stream = open_stream(archive)
+    return stream.open(member.info) if isinstance(stream, zipfile.ZipFile) else stream.extractfile(member.info)
+
+
+# Lets an upload job take its files from a zip or tar archive instead of a directory, without extracting it. Scanning an
+# archive lists its files as paths within the archive (see ARCHIVE_SEPARATOR), which are matched against the asset
+# mappings as if they had been extracted to a directory of the same name; the uploader's file size and the readers of
+# the upload code (checksums, transfer, table loads) take these paths as well, and read the bytes of a file straight
+# from the archive. Files of uncompressed tar files and uncompressed zip members are read in place, at their offset in
+# the archive, so they are read like regular files (in parallel chunks and on the checksum worker processes); files of a
+# compressed tar file are decompressed as they are read, which is fast when the files are taken in their order in the
+# archive (the "As scanned" upload order) and slow otherwise.
+class ArchiveSource(object):
+
+    def __init__(self, uploader):
+        self.uploader = uploader
+
+    @classmethod
+    def attach(cls, uploader):
+        source = cls(uploader)
+        source.scan_directory = uploader.scanDirectory
+        source.upload_files = uploader.uploadFiles
+        uploader.scanDirectory = source.scanDirectory
+        uploader.uploadFiles = source.uploadFiles
+        uploader.getFileSize = get_file_size
+        return source
+
+    def uploadFiles(self, status_callback=None, file_callback=None):
+        try:
+            return self.upload_files(status_callback, file_callback)
+        finally:
+            close_streams()
+
+    def scanDirectory(self, root, abort_on_invalid_input=False, purge_state=False):
+        if not is_archive(root):
+            return self.scan_directory(root, abort_on_invalid_input, purge_state)
+        uploader = self.uploader
+        root = os.path.abspath(root)
+        # the transfer journal keeps the state of an archive in the directory the archive is in
+        uploader.loadTransferState(root, purge=purge_state)
+
+        logging.info("Scanning files in archive [%s]..." % root)
+        file_list = OrderedDict()
+        for member in get_archive_index(root).values():
+            file_path = make_member_path(root, member.name)
+            asset_group, asset_mapping, groupdict = uploader.getAssetMapping(file_path)
+            if not asset_mapping:
+                logging.info("Skipping file: [%s] -- Invalid file type or directory location." % file_path)
+                uploader.skipped_files.add(file_path)
+                if abort_on_invalid_input:
+                    raise ValueError("Invalid input detected, aborting.")
+                continue
+            file_list.setdefault(asset_group, list()).append((asset_group, asset_mapping, groupdict, file_path))
+
+        # as in DerivaUpload.scanDirectory, the groups follow the declared order of the asset mappings
+        for group in sorted(file_list.keys()):
+            uploader.file_list[group] = file_list[group]
+            for file_entry in file_list[group]:
+                file_path = file_entry[3]
+                logging.info("Including file: [%s]." % file_path)
+                status = uploader.getTransferStateStatus(file_path)
+                if status:
+                    uploader.file_status[file_path] = FileUploadState(UploadState.Paused, status)._asdict()
+                else:
+                    uploader.file_status[file_path] = FileUploadState(UploadState.Pending, "Pending")._asdict()
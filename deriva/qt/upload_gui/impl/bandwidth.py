@@ -0,0 +1,150 @@
+import re
+import time
+import logging
+import datetime
+import threading
+from email.utils import parsedate_to_datetime
+from deriva.core import Megabyte
+from deriva.qt.upload_gui.impl.transfer_metrics import format_bytes
+
+# responses that ask the client to back off, and how long to back off for when they do not say
+BACKOFF_STATUS_CODES = (429, 503)
+DEFAULT_BACKOFF_INITIAL = 1.0
+DEFAULT_BACKOFF_MAX = 300.0
+# the bucket holds at most this many seconds' worth of transfer, so that an idle period does not allow a long burst
+DEFAULT_BUCKET_SECONDS = 1.0
+SCHEDULE_ENTRY_PATTERN = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)$")
+
+
+class ServerBusy(Exception):
+    pass
+
+
+def parse_rate(value):
+    # megabytes per second; zero or "unlimited" for no limit
+    value = value.strip().lower()
+    if value in ("unlimited", "none", ""):
+        return None
+    rate = float(value)
+    if rate < 0:
+        raise ValueError("Negative bandwidth limit: %s" % value)
+    return rate * Megabyte if rate else None
+
+
+def parse_bandwidth_schedule(spec):
+    # "<MB/s>" limits all of the time; "HH:MM-HH:MM=<MB/s>" limits during a time of day (which may span midnight), and
+    # entries are separated by commas. Outside of any window, a bare rate applies if one is given, otherwise there is no
+    # limit. For example "08:00-18:00=20" limits to 20 MB/s during working hours only.
+    schedule = list()
+    default = None
+    for entry in [entry.strip() for entry in spec.split(",") if entry.strip()]:
+        match = SCHEDULE_ENTRY_PATTERN.match(entry)
+        if not match:
+            try:
+                default = parse_rate(entry)
+            except ValueError:
+                raise ValueError("Invalid bandwidth limit: %s" % entry)
+            continue
+        start_hour, start_minute, end_hour, end_minute, rate = match.groups()
+        start = int(start_hour) * 60 + int(start_minute)
+        end = int(end_hour) * 60 + int(end_minute)
+        if start >= 24 * 60 or end > 24 * 60 or int(start_minute) >= 60 or int(end_minute) >= 60:
+            raise ValueError("Invalid time of day in bandwidth limit: %s" % entry)
+        schedule.append((start, end, parse_rate(rate)))
+    schedule.append((0, 24 * 60, default))
+    return schedule
+
+
+def get_retry_after(response):
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.datetime.now(when.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+# A token bucket shared by all of the transfer workers of an uploader, with its rate taken from a schedule of limits by
+# time of day. Workers take tokens for a whole request before sending it; a request larger than the bucket leaves it in
+# debt, and the next request waits until the debt has been paid off, so the long-run rate holds whatever the chunk size.
+class BandwidthLimiter(object):
+
+    def __init__(self, schedule=None):
+        self.schedule = schedule if schedule else list()
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.last = time.time()
+        self.rate = None
+
+    def getRate(self):
+        now = datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return None
+
+    def consume(self, nbytes):
+        if not self.schedule:
+            return
+        rate = self.getRate()
+        with self.lock:
+            if rate != self.rate:
+                logging.info("Bandwidth limit: %s" % ("%s/s" % format_bytes(rate) if rate else "unlimited"))
+                self.rate = rate
+                self.tokens = 0.0
+            now = time.time()
+            if rate:
+                self.tokens = min(rate * DEFAULT_BUCKET_SECONDS, self.tokens + (now - self.last) * rate) - nbytes
+                delay = -self.tokens / rate if self.tokens < 0 else 0.0
+            else:
+                delay = 0.0
+            self.last = now
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Backoff state shared by all of the transfer workers of an uploader: when the server answers any of them with 429 or
+# 503, every worker holds off until the time given by the Retry-After header or, without one, for an exponentially
+# increasing delay, rather than each of them retrying on its own schedule.
+class ServerBackoff(object):
+
+    def __init__(self, initial=DEFAULT_BACKOFF_INITIAL, maximum=DEFAULT_BACKOFF_MAX):
+        self.initial = initial
+        self.maximum = maximum
+        self.lock = threading.Lock()
+        self.until = 0.0
+        self.delay = 0.0
+
+    def trigger(self, retry_after=None):
+        with self.lock:
+            if retry_after is None:
+                self.delay = min(self.maximum, self.delay * 2 if self.delay else self.initial)
+                delay = self.delay
+            else:
+                delay = min(self.maximum, retry_after)
+            until = time.time() + delay
+            if until > self.until:
+                logging.warning("Server is busy, pausing all transfers for %.1f seconds%s." %
+                                (delay, " (Retry-After)" if retry_after is not None else ""))
+                self.until = until
+
+    def reset(self):
+        with self.lock:
+            if time.time() >= self.until:
+                self.delay = 0.0
+
+    def wait(self, cancelled=None):
+        # sleeps in short steps, so that a cancelled upload does not wait out the full delay
+        while True:
+            with self.lock:
+                remaining = self.until - time.time()
+            if remaining <= 0 or (cancelled and cancelled()):
+                return
+            time.sleep(min(remaining, 0.5))
@@ -0,0 +1,312 @@
+import sys
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from deriva.core import format_exception, urlquote
+from deriva.transfer.upload import DerivaUploadCatalogCreateError, DerivaUploadCatalogUpdateError
+from deriva.transfer.upload.deriva_upload import UploadState, FileUploadState
+from deriva.transfer.upload.processors.base_processor import PRE_PROCESSORS_KEY, POST_PROCESSORS_KEY
+from deriva.qt.upload_gui.impl.archive_source import open_file
+
+# asset types that are loaded into a catalog table, rather than uploaded to the object store with a catalog record;
+# DerivaUpload.uploadFile only sends "table" to _uploadTable
+TABLE_ASSET_TYPES = ("table",)
+# a batch is sent once it holds this many rows or bytes, or once its first row has waited this many seconds
+DEFAULT_BATCH_ROWS = 500
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+DEFAULT_BATCH_DELAY = 5.0
+# table files larger than this are loaded on their own, as before
+DEFAULT_BATCH_FILE_SIZE = 1024 * 1024
+
+
+# Accumulates the catalog writes of an upload job into batches, instead of one request per row. Record inserts and
+# updates made on behalf of asset files, and the rows of small table files, are queued per target (table, column list
+# and defaults) and sent together once a batch is full or old enough, and at the end of the job. Writes are only
+# deferred where nothing downstream depends on them: not for asset mappings with post-processors or with
+# "create_record_before_upload", and not for inserts whose server-assigned values feed back into the record. When a
+# batch fails, its rows are sent again one file at a time, so that an error is attributed to the file that caused it:
+# that file is marked failed in the upload list even though its transfer finished earlier. The uploader methods are
+# replaced on the instance, like the transfer journal does; uploadFiles wraps whichever implementation is in place
+# (e.g. the upload pipeline).
+class CatalogWriteBatcher(object):
+
+    def __init__(self,
+                 uploader,
+                 max_rows=DEFAULT_BATCH_ROWS,
+                 max_bytes=DEFAULT_BATCH_BYTES,
+                 max_delay=DEFAULT_BATCH_DELAY,
+                 max_file_size=DEFAULT_BATCH_FILE_SIZE):
+        self.uploader = uploader
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.max_file_size = max_file_size
+        self.batches = OrderedDict()
+        self.lock = threading.RLock()
+        # the file being processed, per thread: the upload pipeline registers one file while it transfers the next
+        self.local = threading.local()
+        self.upload_files = uploader.uploadFiles
+        self.status_callback = None
+        self.stopped = threading.Event()
+        self.timer = None
+        self.failed = set()
+        self.requests = 0
+        self.rows = 0
+
+    @classmethod
+    def attach(cls, uploader, **kwargs):
+        batcher = cls(uploader, **kwargs)
+        uploader.uploadFiles = batcher.uploadFiles
+        uploader.uploadFile = batcher.uploadFile
+        uploader._uploadTable = batcher.uploadTable
+        uploader._catalogRecordCreate = batcher.catalogRecordCreate
+        uploader._catalogRecordUpdate = batcher.catalogRecordUpdate
+        return batcher
+
+    def uploadFiles(self, status_callback=None, file_callback=None):
+        uploader = self.uploader
+        self.failed.clear()
+        self.status_callback = status_callback
+        # batches that have waited too long are sent by a timer thread, so that the transfer and its progress
+        # callbacks never wait on a catalog request
+        self.stopped.clear()
+        self.timer = threading.Thread(target=self.flushPeriodically, name="upload-catalog-batch")
+        self.timer.daemon = True
+        self.timer.start()
+        error = None
+        try:
+            self.upload_files(status_callback, file_callback)
+        except Exception as e:
+            error = e
+        finally:
+            self.stopped.set()
+            self.timer.join()
+            self.timer = None
+        # the rows queued so far belong to files that have already been reported as uploaded, so they are sent even
+        # if the job has been cancelled
+        self.flush()
+        if self.requests:
+            logging.info("Catalog writes: %d row(s) in %d request(s)." % (self.rows, self.requests))
+        if status_callback:
+            status_callback()
+        if error is not None:
+            raise error
+        if self.failed:
+            logging.warning("The following file(s) failed to upload due to errors:\n\n%s\n" % '\n'.join(
+                ["%s -- %s" % (key, uploader.file_status[key]["Status"]) for key in sorted(self.failed)]))
+            raise RuntimeError("One or more file(s) failed to upload due to errors.")
+
+    @property
+    def current(self):
+        return getattr(self.local, "current", None)
+
+    def uploadFile(self, file_path, asset_mapping, match_groupdict, callback=None):
+        logging.info("Processing file: [%s]" % file_path)
+        self.local.current = (file_path, asset_mapping)
+        try:
+            if asset_mapping.get("asset_type", "file") in TABLE_ASSET_TYPES:
+                self.uploader._uploadTable(file_path, asset_mapping, match_groupdict)
+            else:
+                self.uploader._uploadAsset(file_path, asset_mapping, match_groupdict, callback)
+        finally:
+            self.local.current = None
+
+    def canDefer(self):
+        if self.current is None or self.uploader.cancelled:
+            return False
+        file_path, asset_mapping = self.current
+        return not (asset_mapping.get(POST_PROCESSORS_KEY) or asset_mapping.get("create_record_before_upload"))
+
+    def uploadTable(self, file_path, asset_mapping, match_groupdict, callback=None):
+        uploader = self.uploader
+        if not self.canDefer() or uploader.getFileSize(file_path) > self.max_file_size:
+            return self.loadTable(file_path, asset_mapping, match_groupdict)
+
+        uploader._initFileMetadata(file_path, asset_mapping, match_groupdict)
+        uploader._execute_processors(file_path, asset_mapping, match_groupdict, processor_list=PRE_PROCESSORS_KEY)
+        try:
+            table = uploader.metadata['target_table']
+            default_columns = asset_mapping.get("default_columns")
+            if not default_columns:
+                default_columns = uploader.catalog.getDefaultColumns({}, table)
+            default_param = ('?defaults=%s' % ','.join(default_columns)) if len(default_columns) > 0 else ''
+            uri = '/entity/%s%s' % (table, default_param)
+            file_ext = uploader.metadata['file_ext'].lower()
+            with open_file(file_path) as fp:
+                content = fp.read()
+            if file_ext == 'csv':
+                # files with the same header are concatenated into a single CSV body
+                header, _, body = content.partition(b"\n")
+                if body and not body.endswith(b"\n"):
+                    body += b"\n"
+                self.add(("csv", uri, header), file_path, body, body.count(b"\n"), len(body))
+            elif file_ext == 'json':
+                rows = json.loads(content.decode("utf-8"))
+                rows = rows if isinstance(rows, list) else [rows]
+                columns = set(tuple(sorted(row.keys())) for row in rows)
+                if len(columns) != 1:
+                    # rows of one request have to share their columns, so this file is loaded on its own
+                    self.request(("insert", uri), [(file_path, rows)])
+                    return
+                self.add(("insert", uri, columns.pop()), file_path, rows, len(rows), len(content))
+            else:
+                raise DerivaUploadCatalogCreateError("Unsupported file type for catalog bulk upload: %s" % file_ext)
+        except DerivaUploadCatalogCreateError:
+            raise
+        except:
+            (etype, value, traceback) = sys.exc_info()
+            raise DerivaUploadCatalogCreateError(format_exception(value))
+
+    def loadTable(self, file_path, asset_mapping, match_groupdict):
+        # DerivaUpload._uploadTable, reading the file with open_file so that a table file can be read from an archive
+        uploader = self.uploader
+        if uploader.cancelled:
+            return None
+
+        uploader._initFileMetadata(file_path, asset_mapping, match_groupdict)
+        uploader._execute_processors(file_path, asset_mapping, match_groupdict, processor_list=PRE_PROCESSORS_KEY)
+        try:
+            default_columns = asset_mapping.get("default_columns")
+            if not default_columns:
+                default_columns = uploader.catalog.getDefaultColumns({}, uploader.metadata['target_table'])
+            default_param = ('?defaults=%s' % ','.join(default_columns)) if len(default_columns) > 0 else ''
+            file_ext = uploader.metadata['file_ext'].lower()
+            if file_ext == 'csv':
+                headers = {'content-type': 'text/csv'}
+            elif file_ext == 'json':
+                headers = {'content-type': 'application/json'}
+            else:
+                raise DerivaUploadCatalogCreateError("Unsupported file type for catalog bulk upload: %s" % file_ext)
+            with open_file(file_path) as fp:
+                return uploader.catalog.post(
+                    '/entity/%s%s' % (uploader.metadata['target_table'], default_param), fp, headers=headers)
+        except:
+            (etype, value, traceback) = sys.exc_info()
+            raise DerivaUploadCatalogCreateError(format_exception(value))
+        finally:
+            uploader._execute_processors(file_path, asset_mapping, match_groupdict, processor_list=POST_PROCESSORS_KEY)
+
+    def catalogRecordCreate(self, catalog_table, row, default_columns=None):
+        uploader = self.uploader
+        # the created row is merged back into the file's metadata, so an insert can only be deferred if the record
+        # does not depend on anything the server assigns
+        column_map = self.current[1].get("column_map", {}) if self.current else {}
+        if not self.canDefer() or \
+                any(value is None for value in uploader.interpolateDict(uploader.metadata, column_map,
+                                                                        allowNone=True).values()):
+            return type(uploader)._catalogRecordCreate(uploader, catalog_table, row, default_columns)
+        try:
+            missing = uploader._validate_catalog_row_columns(row, catalog_table)
+            if missing:
+                raise ValueError(
+                    "Unable to update catalog entry because one or more specified columns do not exist in the "
+                    "target table: [%s]" % ','.join(missing))
+            if not default_columns:
+                default_columns = uploader._get_catalog_default_columns(row, catalog_table)
+            default_param = ('?defaults=%s' % ','.join(default_columns)) if len(default_columns) > 0 else ''
+            uri = '/entity/%s%s' % (catalog_table, default_param)
+        except:
+            (etype, value, traceback) = sys.exc_info()
+            raise DerivaUploadCatalogCreateError(format_exception(value))
+        key = ("insert", uri, tuple(sorted(row.keys())))
+        with self.lock:
+            batch = self.batches.get(key)
+            # a second file mapped to the same record finds it in the batch rather than in the catalog
+            if not (batch and any(row in rows for file_path, rows in batch["items"])):
+                self.add(key, self.current[0], [dict(row)], 1, len(json.dumps(row)))
+        return [dict(row)]
+
+    def catalogRecordUpdate(self, catalog_table, old_row, new_row):
+        uploader = self.uploader
+        if not self.canDefer():
+            return type(uploader)._catalogRecordUpdate(uploader, catalog_table, old_row, new_row)
+        keys = sorted(list(new_row.keys()))
+        old_keys = sorted(list(old_row.keys()))
+        if keys != old_keys:
+            raise DerivaUploadCatalogUpdateError(
+                "Cannot update catalog - new row column list and old row column list do not match: New: %s != Old: %s"
+                % (keys, old_keys))
+        combined_row = {'o%d' % i: old_row[keys[i]] for i in range(len(keys))}
+        combined_row.update({'n%d' % i: new_row[keys[i]] for i in range(len(keys))})
+        uri = '/attributegroup/%s/%s;%s' % (
+            catalog_table,
+            ','.join(["o%d:=%s" % (i, urlquote(keys[i])) for i in range(len(keys))]),
+            ','.join(["n%d:=%s" % (i, urlquote(keys[i])) for i in range(len(keys))]))
+        self.add(("update", uri), self.current[0], [combined_row], 1, len(json.dumps(combined_row)))
+        return None
+
+    def add(self, key, file_path, payload, rows, size):
+        # a full batch is taken out of the queue under the lock, but sent outside of it
+        with self.lock:
+            batch = self.batches.get(key)
+            if batch is None:
+                batch = self.batches[key] = {"key": key, "items": list(), "rows": 0, "bytes": 0, "started": time.time()}
+            batch["items"].append((file_path, payload))
+            batch["rows"] += rows
+            batch["bytes"] += size
+            if batch["rows"] < self.max_rows and batch["bytes"] < self.max_bytes:
+                return
+            del self.batches[key]
+        self.send(batch)
+
+    def flush(self, force=True):
+        now = time.time()
+        with self.lock:
+            batches = [self.batches.pop(key) for key, batch in list(self.batches.items())
+                       if force or now - batch["started"] >= self.max_delay]
+        for batch in batches:
+            self.send(batch)
+
+    def flushPeriodically(self):
+        while not self.stopped.wait(self.max_delay):
+            try:
+                self.flush(force=False)
+            except Exception as e:
+                logging.warning("Catalog batch flush failed: %s" % format_exception(e))
+
+    def send(self, batch):
+        try:
+            self.request(batch["key"], batch["items"])
+            with self.lock:
+                self.rows += batch["rows"]
+            return
+        except Exception as e:
+            if len(batch["items"]) == 1:
+                self.fail(batch["key"], batch["items"][0][0], e)
+                return
+            logging.warning("Batched catalog write of %d row(s) failed, retrying file by file: %s" %
+                            (batch["rows"], format_exception(e)))
+        for item in batch["items"]:
+            try:
+                self.request(batch["key"], [item])
+            except Exception as e:
+                self.fail(batch["key"], item[0], e)
+
+    def request(self, key, items):
+        catalog = self.uploader.catalog
+        kind, uri = key[0], key[1]
+        with self.lock:
+            self.requests += 1
+        logging.debug("Sending batched catalog %s [%s] for %d file(s)" % (kind, uri, len(items)))
+        if kind == "csv":
+            body = key[2] + b"\n" + b"".join(payload for file_path, payload in items)
+            catalog.post(uri, data=body, headers={'content-type': 'text/csv'})
+        elif kind == "insert":
+            catalog.post(uri, json=[row for file_path, rows in items for row in rows])
+        else:
+            catalog.put(uri, json=[row for file_path, rows in items for row in rows])
+
+    def fail(self, key, file_path, error):
+        uploader = self.uploader
+        error = DerivaUploadCatalogUpdateError(format_exception(error)) if key[0] == "update" else \
+            DerivaUploadCatalogCreateError(format_exception(error))
+        logging.error("Catalog write for file [%s] failed: %s" % (file_path, format_exception(error)))
+        self.failed.add(file_path)
+        uploader.file_status[file_path] = FileUploadState(UploadState.Failed, format_exception(error))._asdict()
+        # lets the transfer journal know that the file is not done after all
+        uploader.delTransferState(file_path)
+        # the file may already have been reported as uploaded, so its consumers are told that it has changed
+        if self.status_callback:
+            self.status_callback(file_path=file_path)
@@ -0,0 +1,167 @@
+import os
+import mmap
+import threading
+from contextlib import contextmanager
+from deriva.core import Megabyte
+from deriva.qt.upload_gui.impl.archive_source import is_member_path, get_member_location, get_file_size, open_file
+
+# files at least this large are mapped into memory rather than read into buffers
+DEFAULT_MMAP_THRESHOLD = Megabyte * 1024
+# how long a chunk of a compressed archive member waits for the chunks before it to be read
+DEFAULT_STREAM_WAIT = 60.0
+
+
+# A fixed number of reusable chunk buffers. Buffers are handed out until all are in use, after which a caller waits for
+# one to be returned, so the number of buffers also bounds the memory held by the chunks in flight. The buffers are
+# reallocated when the chunk size changes, which only happens between upload jobs.
+class BufferPool(object):
+
+    def __init__(self, count):
+        self.count = count
+        self.size = 0
+        self.free = list()
+        self.allocated = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            if size != self.size:
+                # buffers of the old size still in use are dropped when they are returned
+                self.size = size
+                self.free = list()
+                self.allocated = 0
+            while not self.free and self.allocated >= self.count:
+                self.condition.wait()
+            if self.free:
+                return self.free.pop()
+            self.allocated += 1
+            return bytearray(size)
+
+    def release(self, buffer):
+        with self.condition:
+            if len(buffer) == self.size:
+                self.free.append(buffer)
+            self.condition.notify()
+
+
+# Reads the chunks of a file as memoryviews, without allocating or copying a new object per chunk: small and medium
+# files are read with readinto (at an offset, so the file can be shared by several threads) into buffers from a pool;
+# large files are memory-mapped and a chunk is a view of the mapping, so it is read straight from the page cache. The
+# same view is hashed and handed to the HTTP layer, which sends memoryviews without copying them. A view is only valid
+# inside the chunk() block. A mapped file that is truncated while it is read faults the process, but so would its
+# upload fail in any case; the mapping is therefore only used for files above a size threshold.
+#
+# A file stored in an archive as it is is read the same way, at its offset in the archive. A file of a compressed
+# archive can only be read by decompressing it from the start, so its chunks are read from a single stream, one after
+# the other and in order (chunks are submitted in order, starting at start_chunk); a chunk that is sent again after a
+# failure is read again by seeking the stream back, which is slow for a compressed tar file.
+class ChunkReader(object):
+
+    def __init__(self, file_path, chunk_size, pool, mmap_threshold=DEFAULT_MMAP_THRESHOLD, start_chunk=0):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.pool = pool
+        self.fp = None
+        self.stream = None
+        self.map = None
+        self.base = 0
+        self.map_base = 0
+        self.next_chunk = start_chunk
+        self.lock = threading.Condition()
+        if not is_member_path(file_path):
+            self.fp = open(file_path, "rb")
+            self.size = os.fstat(self.fp.fileno()).st_size
+        else:
+            location = get_member_location(file_path)
+            if location is None:
+                self.stream = open_file(file_path)
+                self.size = get_file_size(file_path)
+                return
+            archive, self.base, self.size = location
+            self.fp = open(archive, "rb")
+        if mmap_threshold is not None and self.size >= max(mmap_threshold, 1):
+            # mappings start at a multiple of the allocation granularity
+            offset = self.base - self.base % mmap.ALLOCATIONGRANULARITY
+            self.map_base = self.base - offset
+            self.map = mmap.mmap(self.fp.fileno(), self.size + self.map_base, access=mmap.ACCESS_READ, offset=offset)
+            if hasattr(self.map, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # a view is still referenced somewhere (e.g. by a failed request); the mapping goes with it
+                pass
+            self.map = None
+        if self.stream is not None:
+            self.stream.close()
+        if self.fp is not None:
+            self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.close()
+
+    def readinto(self, buffer, offset):
+        if hasattr(os, "preadv"):
+            return os.preadv(self.fp.fileno(), [buffer], self.base + offset)
+        with self.lock:
+            self.fp.seek(self.base + offset)
+            return self.fp.readinto(buffer)
+
+    def read(self, view, index, offset, length):
+        count = 0
+        while count < length:
+            read = self.readinto(view[count:length], offset + count)
+            if not read:
+                break
+            count += read
+        return count
+
+    def readStream(self, view, index, offset, length):
+        with self.lock:
+            while index > self.next_chunk:
+                # the chunks before this one are being read; should one of them not be, this one is read regardless
+                if not self.lock.wait(DEFAULT_STREAM_WAIT):
+                    break
+            try:
+                if self.stream.tell() != offset:
+                    self.stream.seek(offset)
+                count = 0
+                while count < length:
+                    read = self.stream.readinto(view[count:length])
+                    if not read:
+                        break
+                    count += read
+                return count
+            finally:
+                self.next_chunk = max(self.next_chunk, index + 1)
+                self.lock.notify_all()
+
+    @contextmanager
+    def chunk(self, index):
+        offset = index * self.chunk_size
+        length = max(0, min(self.chunk_size, self.size - offset))
+        if self.map is not None:
+            view = memoryview(self.map)[self.map_base + offset:self.map_base + offset + length]
+            try:
+                yield view
+            finally:
+                view.release()
+            return
+        buffer = self.pool.acquire(self.chunk_size)
+        view = memoryview(buffer)
+        try:
+            count = (self.read if self.stream is None else self.readStream)(view, index, offset, length)
+            chunk = view[:count]
+            try:
+                yield chunk
+            finally:
+                chunk.release()
+        finally:
+            view.release()
+            self.pool.release(buffer)
@@ -0,0 +1,366 @@
+import time
+import base64
+import hashlib
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from deriva.core import format_exception, NotModified, DEFAULT_CHUNK_SIZE, MAX_CHUNK_SIZE, \
+    MaxRetryError, Megabyte, HatracJobAborted, HatracJobPaused, HatracJobTimeout
+from deriva.qt.upload_gui.impl.transfer_metrics import format_bytes
+from deriva.qt.upload_gui.impl.chunk_reader import ChunkReader, BufferPool
+from deriva.qt.upload_gui.impl.archive_source import is_member_path, get_file_size, open_file
+from deriva.qt.upload_gui.impl.bandwidth import BandwidthLimiter, ServerBackoff, ServerBusy, get_retry_after, \
+    BACKOFF_STATUS_CODES
+
+# limits of the adaptive controller
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_INITIAL_CONCURRENCY = 2
+DEFAULT_MIN_CHUNK_SIZE = Megabyte * 5
+DEFAULT_CHUNK_STEP = Megabyte * 5
+# chunks held in memory at once are limited to this many bytes, whatever the concurrency
+DEFAULT_BUFFER_LIMIT = Megabyte * 256
+# the controller adjusts once per interval, and aims for chunks that take about this long to send on one connection
+DEFAULT_CONTROL_INTERVAL = 5.0
+DEFAULT_CHUNK_SECONDS = 4.0
+# a window counts as congested if its time per byte is this many times the best seen so far
+DEFAULT_LATENCY_TOLERANCE = 2.0
+# adding a connection has to improve throughput by at least this much for the controller to keep adding them
+DEFAULT_MIN_GAIN = 0.05
+DEFAULT_CHUNK_RETRIES = 3
+# requests the server asked to retry later are retried separately from failed ones, up to this many times
+DEFAULT_BUSY_RETRIES = 20
+
+
+# Adjusts the number of chunk requests in flight, and the chunk size of new upload jobs, from the throughput, time per
+# byte and errors measured over each control interval, AIMD-style: the concurrency is increased by one while doing so
+# keeps improving throughput, and halved on errors or when the time per byte rises well above the best seen (a sign of
+# a congested path). The chunk size follows the throughput per connection, so that a chunk takes a few seconds to send:
+# large chunks on fast links, where the per-request overhead dominates, small ones on slow links, where a failed chunk
+# is expensive to resend; it is halved on errors. Either value can be pinned, in which case it is left alone.
+class TransferController(object):
+
+    def __init__(self,
+                 concurrency=None,
+                 chunk_size=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 min_chunk_size=DEFAULT_MIN_CHUNK_SIZE,
+                 max_chunk_size=MAX_CHUNK_SIZE,
+                 buffer_limit=DEFAULT_BUFFER_LIMIT,
+                 interval=DEFAULT_CONTROL_INTERVAL):
+        self.pinned_concurrency = concurrency is not None
+        self.pinned_chunk_size = chunk_size is not None
+        self.max_concurrency = max(max_concurrency, concurrency or 1)
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.buffer_limit = buffer_limit
+        self.interval = interval
+        self.concurrency = concurrency if concurrency else DEFAULT_INITIAL_CONCURRENCY
+        self.chunk_size = min(chunk_size, MAX_CHUNK_SIZE) if chunk_size else DEFAULT_CHUNK_SIZE
+        self.lock = threading.Lock()
+        self.best_latency = None
+        self.last_throughput = None
+        self.resetWindow()
+
+    def resetWindow(self):
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_time = 0.0
+        self.window_errors = 0
+        self.window_requests = 0
+
+    def getConcurrency(self):
+        with self.lock:
+            if self.pinned_concurrency:
+                return self.concurrency
+            # keeps the chunks held in memory within the buffer limit
+            return max(1, min(self.concurrency, self.buffer_limit // max(self.chunk_size, 1)))
+
+    def getChunkSize(self):
+        with self.lock:
+            return self.chunk_size
+
+    def record(self, nbytes, elapsed, error=False):
+        with self.lock:
+            self.window_requests += 1
+            if error:
+                self.window_errors += 1
+            else:
+                self.window_bytes += nbytes
+                self.window_time += elapsed
+            if time.time() - self.window_start >= self.interval:
+                self.adjust()
+                self.resetWindow()
+
+    def adjust(self):
+        elapsed = time.time() - self.window_start
+        throughput = self.window_bytes / elapsed if elapsed > 0 else 0.0
+        latency = self.window_time / self.window_bytes if self.window_bytes else None
+        if latency is not None and (self.best_latency is None or latency < self.best_latency):
+            self.best_latency = latency
+        concurrency = self.concurrency
+        chunk_size = self.chunk_size
+        if self.window_errors:
+            reason = "%d failed request(s)" % self.window_errors
+            concurrency = max(1, concurrency // 2)
+            chunk_size = max(self.min_chunk_size, chunk_size // 2)
+        elif latency is not None and latency > self.best_latency * DEFAULT_LATENCY_TOLERANCE:
+            reason = "time per byte %.1fx the best seen" % (latency / self.best_latency)
+            concurrency = max(1, concurrency // 2)
+        elif self.last_throughput is None or throughput > self.last_throughput * (1 + DEFAULT_MIN_GAIN):
+            reason = "throughput rising"
+            concurrency = min(self.max_concurrency, concurrency + 1)
+        else:
+            reason = "throughput steady"
+        if not self.window_errors and self.window_bytes:
+            # the size of a chunk that takes about DEFAULT_CHUNK_SECONDS on one connection
+            target = throughput / max(self.concurrency, 1) * DEFAULT_CHUNK_SECONDS
+            if target > chunk_size + DEFAULT_CHUNK_STEP:
+                chunk_size += DEFAULT_CHUNK_STEP
+            elif target < chunk_size / 2:
+                chunk_size //= 2
+        chunk_size = min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+        chunk_size -= chunk_size % Megabyte
+        self.last_throughput = throughput
+        if self.pinned_concurrency:
+            concurrency = self.concurrency
+        if self.pinned_chunk_size:
+            chunk_size = self.chunk_size
+        if (concurrency, chunk_size) != (self.concurrency, self.chunk_size):
+            logging.info("Transfer controller: concurrency %d -> %d, chunk size %s -> %s (%s; %s/s, %d request(s))" %
+                         (self.concurrency, concurrency, format_bytes(self.chunk_size), format_bytes(chunk_size),
+                          reason, format_bytes(throughput), self.window_requests))
+        else:
+            logging.debug("Transfer controller: concurrency %d, chunk size %s (%s; %s/s, %d request(s))" %
+                          (concurrency, format_bytes(chunk_size), reason, format_bytes(throughput),
+                           self.window_requests))
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+
+
+# Uploads chunked objects with several chunk requests in flight at once, at the concurrency and chunk size given by a
+# TransferController, in place of the uploader's sequential upload. Hatrac accepts the chunks of an upload job in any
+# order; the progress reported to the upload callback (and so recorded in the transfer state) is the number of chunks
+# completed without a gap from the start, so that an interrupted upload resumes from a point before which every chunk
+# is known to have been sent. A resumed job keeps the chunk size it was created with. Objects small enough to be sent
+# in one request are left to the uploader. All requests go through a shared bandwidth limiter and server backoff state.
+class ChunkedTransfer(object):
+
+    def __init__(self, uploader, controller=None, concurrency=None, chunk_size=None, bandwidth_schedule=None):
+        self.uploader = uploader
+        self.controller = controller if controller else TransferController(concurrency, chunk_size)
+        self.limiter = BandwidthLimiter(bandwidth_schedule)
+        self.pool = BufferPool(self.controller.max_concurrency)
+        self.backoff = ServerBackoff()
+        self.hatrac_upload = uploader._hatracUpload
+
+    @classmethod
+    def attach(cls, uploader, **kwargs):
+        transfer = cls(uploader, **kwargs)
+        uploader._hatracUpload = transfer.hatracUpload
+        return transfer
+
+    def hatracUpload(self,
+                     uri,
+                     file_path,
+                     md5=None,
+                     sha256=None,
+                     content_type=None,
+                     content_disposition=None,
+                     chunked=True,
+                     create_parents=True,
+                     allow_versioning=True,
+                     callback=None):
+        if not chunked:
+            return self.uploadObject(uri, file_path, md5=md5, sha256=sha256, content_type=content_type,
+                                     content_disposition=content_disposition, chunked=chunked,
+                                     create_parents=create_parents, allow_versioning=allow_versioning,
+                                     callback=callback)
+        uploader = self.uploader
+        store = uploader.store
+
+        # same as the uploader: resume an upload job if the file has not changed since it was created
+        transfer_state = uploader.getTransferState(file_path)
+        if transfer_state and ((transfer_state.get("content-md5") and md5 == transfer_state.get("content-md5")) or
+                               (transfer_state.get("content-sha256") and
+                                sha256 == transfer_state.get("content-sha256"))):
+            logging.info("Resuming upload (%s) of file: [%s] to host %s. Please wait..." % (
+                uploader.getTransferStateStatus(file_path), file_path, transfer_state.get("host")))
+            path = transfer_state["target"]
+            job_id = transfer_state['url'].rsplit("/", 1)[1]
+            if not (transfer_state["total"] == transfer_state["completed"]):
+                self.sendChunks(path, file_path, job_id, transfer_state.get("chunk-length", DEFAULT_CHUNK_SIZE),
+                                transfer_state["completed"], callback)
+            return store.finalize_upload_job(path, job_id)
+
+        logging.info("Uploading file: [%s] to host %s. Please wait..." % (
+            uploader.getFileDisplayName(file_path), uploader.server_url))
+        store.check_path(uri)
+        try:
+            r = store.head(uri)
+            if r.status_code == 200 and (md5 and r.headers.get('Content-MD5') == md5 or
+                                         sha256 and r.headers.get('Content-SHA256') == sha256):
+                # object already has same content so skip upload
+                return r.headers.get('Content-Location')
+            elif not allow_versioning:
+                raise NotModified("The file [%s] cannot be uploaded because content already exists for this object "
+                                  "and multiple versions are not allowed." % file_path)
+        except requests.HTTPError as e:
+            if e.response.status_code != 404:
+                logging.debug("HEAD request failed: %s" % format_exception(e))
+        try:
+            chunk_size = self.controller.getChunkSize()
+            job_id = store.create_upload_job(uri, file_path, md5, sha256,
+                                             content_type=content_type,
+                                             content_disposition=content_disposition,
+                                             create_parents=create_parents,
+                                             chunk_size=chunk_size)
+            self.sendChunks(uri, file_path, job_id, chunk_size, 0, callback)
+            return store.finalize_upload_job(uri, job_id)
+        except (requests.Timeout, MaxRetryError) as e:
+            raise HatracJobTimeout(e)
+
+    def uploadObject(self, uri, file_path, **kwargs):
+        # a single request, sent by the uploader
+        for attempt in range(DEFAULT_BUSY_RETRIES + 1):
+            self.backoff.wait(lambda: self.uploader.cancelled)
+            self.limiter.consume(get_file_size(file_path))
+            try:
+                if is_member_path(file_path):
+                    result = self.uploadMember(uri, file_path, **kwargs)
+                else:
+                    result = self.hatrac_upload(uri, file_path, **kwargs)
+                self.backoff.reset()
+                return result
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code not in BACKOFF_STATUS_CODES or \
+                        attempt == DEFAULT_BUSY_RETRIES or self.uploader.cancelled:
+                    raise
+                self.backoff.trigger(get_retry_after(e.response))
+            except requests.exceptions.RetryError:
+                # the session's own retries of a 503 response ran out
+                if attempt == DEFAULT_BUSY_RETRIES or self.uploader.cancelled:
+                    raise
+                self.backoff.trigger()
+
+    def uploadMember(self, uri, file_path, md5=None, sha256=None, **kwargs):
+        # the uploader would open the path of a file in an archive itself, so the file is handed to the object store
+        # already open instead, as DerivaUpload._hatracUpload would send it otherwise
+        logging.info("Uploading file: [%s] to host %s. Please wait..." % (
+            self.uploader.getFileDisplayName(file_path), self.uploader.server_url))
+        with open_file(file_path) as fp:
+            return self.uploader.store.put_obj(uri, fp, md5=md5, sha256=sha256)
+
+    def putChunk(self, path, reader, job_id, chunk):
+        store = self.uploader.store
+        self.backoff.wait(lambda: self.uploader.cancelled)
+        url = '%s;upload/%s/%d' % (path, job_id, chunk)
+        # the chunk is hashed and sent from the same view, without a copy of it being made
+        with reader.chunk(chunk) as data:
+            length = len(data)
+            headers = {'Content-Type': 'application/octet-stream',
+                       'Content-Length': '%d' % length,
+                       'Content-MD5': base64.b64encode(hashlib.md5(data).digest()).decode()}
+            self.limiter.consume(length)
+            start = time.time()
+            try:
+                r = store.put(url, data=data, headers=headers)
+            except requests.exceptions.RetryError as e:
+                self.backoff.trigger()
+                raise ServerBusy(format_exception(e))
+            elapsed = time.time() - start
+        if r.status_code in BACKOFF_STATUS_CODES:
+            self.backoff.trigger(get_retry_after(r))
+            raise ServerBusy("%d %s" % (r.status_code, r.reason))
+        store._response_raise_for_status(r)
+        self.backoff.reset()
+        return length, elapsed
+
+    def sendChunks(self, path, file_path, job_id, chunk_size, start_chunk, callback):
+        store = self.uploader.store
+        job_info = store.get_upload_job(path, job_id).json()
+        file_size = get_file_size(file_path)
+        chunks = file_size // chunk_size + (1 if file_size % chunk_size else 0)
+        controller = self.controller
+        completed = start_chunk
+        next_chunk = start_chunk
+        done = set()
+        retries = dict()
+        busy = dict()
+        pending = dict()
+        stop = None
+        total_bytes = 0
+        start = time.time()
+        logging.debug("Transferring file %s to %s%s" % (file_path, store._server_uri, path))
+        reader = ChunkReader(file_path, chunk_size, self.pool, start_chunk=start_chunk)
+        executor = ThreadPoolExecutor(max_workers=controller.max_concurrency)
+        try:
+            while pending or (next_chunk < chunks and stop is None):
+                while next_chunk < chunks and stop is None and len(pending) < controller.getConcurrency():
+                    future = executor.submit(self.putChunk, path, reader, job_id, next_chunk)
+                    pending[future] = next_chunk
+                    next_chunk += 1
+                finished, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    chunk = pending.pop(future)
+                    try:
+                        nbytes, elapsed = future.result()
+                    except ServerBusy as e:
+                        # sent again once the backoff, which every worker waits for, has passed
+                        controller.record(0, 0.0, error=True)
+                        busy[chunk] = busy.get(chunk, 0) + 1
+                        if busy[chunk] > DEFAULT_BUSY_RETRIES or stop is not None:
+                            stop = stop if stop is not None else e
+                            continue
+                        pending[executor.submit(self.putChunk, path, reader, job_id, chunk)] = chunk
+                        continue
+                    except Exception as e:
+                        controller.record(0, 0.0, error=True)
+                        retries[chunk] = retries.get(chunk, 0) + 1
+                        if retries[chunk] > DEFAULT_CHUNK_RETRIES or stop is not None:
+                            stop = stop if stop is not None else e
+                            continue
+                        logging.warning("Chunk %d of file [%s] failed, retrying: %s" %
+                                        (chunk, file_path, format_exception(e)))
+                        pending[executor.submit(self.putChunk, path, reader, job_id, chunk)] = chunk
+                        continue
+                    controller.record(nbytes, elapsed)
+                    total_bytes += nbytes
+                    done.add(chunk)
+                while completed in done:
+                    done.discard(completed)
+                    completed += 1
+                if callback and stop is None and finished:
+                    ret = callback(job_info=job_info,
+                                   completed=completed,
+                                   total=chunks,
+                                   file_path=file_path,
+                                   host=store._server_uri)
+                    if ret == 0:
+                        stop = HatracJobAborted("Upload in-progress cancelled by user.")
+                    elif ret == -1:
+                        stop = HatracJobPaused("Upload in-progress paused by user.")
+        finally:
+            executor.shutdown(wait=True)
+            reader.close()
+
+        if isinstance(stop, HatracJobAborted):
+            store.cancel_upload_job(path, job_id)
+            raise stop
+        elif isinstance(stop, HatracJobPaused):
+            raise stop
+        elif stop is not None:
+            if isinstance(stop, (requests.Timeout, MaxRetryError)):
+                raise HatracJobTimeout(stop)
+            try:
+                store.cancel_upload_job(path, job_id)
+            except Exception:
+                pass
+            raise stop
+        elapsed = time.time() - start
+        logging.info("File [%s] upload successful. %s transferred in %.2f seconds (%s/s), up to %d chunk(s) of %s in "
+                     "flight." % (file_path, format_bytes(total_bytes), elapsed,
+                                  format_bytes(total_bytes / elapsed if elapsed > 0 else 0),
+                                  controller.getConcurrency(), format_bytes(chunk_size)))
+        if callback:
+            callback(summary="%s in %.2f seconds" % (format_bytes(total_bytes), elapsed), file_path=file_path)
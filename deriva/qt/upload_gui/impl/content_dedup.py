@@ -0,0 +1,88 @@
+import logging
+import threading
+from collections import defaultdict
+from deriva.qt.upload_gui.impl.archive_source import get_file_size
+from deriva.qt.upload_gui.impl.catalog_batch import TABLE_ASSET_TYPES
+from deriva.qt.upload_gui.impl.transfer_metrics import format_bytes
+
+
+# Uploads each distinct content of an upload job only once. At the start of a job, the asset files are grouped by size:
+# only files that share their size with another file of the job can be duplicates. When such a file is uploaded, its
+# checksums (computed beforehand for the catalog record in any case) are compared with those of the files already
+# uploaded in the job, and on a match the object store URI of the earlier upload is used for the catalog record instead
+# of transferring the bytes again, so that all the records point at the same object. Objects are only shared within the
+# same object store namespace and with the same content type and content disposition, since these are properties of the
+# object that the records of the duplicates would otherwise see differently. Files that are hard links to one another
+# are duplicates too; their checksums are computed only once (see FileHasher).
+class ContentDeduplicator(object):
+
+    def __init__(self, uploader):
+        self.uploader = uploader
+        self.lock = threading.Lock()
+        self.candidates = set()
+        self.uploaded = dict()
+        self.files = 0
+        self.bytes = 0
+
+    @classmethod
+    def attach(cls, uploader):
+        dedup = cls(uploader)
+        dedup.upload_files = uploader.uploadFiles
+        dedup.hatrac_upload = uploader._hatracUpload
+        uploader.uploadFiles = dedup.uploadFiles
+        uploader._hatracUpload = dedup.hatracUpload
+        return dedup
+
+    def uploadFiles(self, status_callback=None, file_callback=None):
+        self.beginJob()
+        try:
+            return self.upload_files(status_callback, file_callback)
+        finally:
+            if self.files:
+                logging.info("Duplicate content: %d file(s) not transferred, %s saved." %
+                             (self.files, format_bytes(self.bytes)))
+
+    def beginJob(self):
+        sizes = defaultdict(list)
+        for assets in self.uploader.file_list.values():
+            for asset_group_num, asset_mapping, groupdict, file_path in assets:
+                if asset_mapping.get("asset_type", "file") in TABLE_ASSET_TYPES:
+                    continue
+                try:
+                    sizes[get_file_size(file_path)].append(file_path)
+                except OSError:
+                    continue
+        with self.lock:
+            self.candidates = set(file_path for paths in sizes.values() if len(paths) > 1 for file_path in paths)
+            self.uploaded.clear()
+            self.files = 0
+            self.bytes = 0
+        if self.candidates:
+            logging.debug("%d file(s) have the same size as another file of the upload job." % len(self.candidates))
+
+    def hatracUpload(self, uri, file_path, md5=None, sha256=None, content_type=None, content_disposition=None,
+                     chunked=True, create_parents=True, allow_versioning=True, callback=None):
+        key = None
+        if file_path in self.candidates and (md5 or sha256):
+            key = (uri.rsplit("/", 1)[0], get_file_size(file_path), md5, sha256, content_type, content_disposition)
+            with self.lock:
+                versioned_uri = self.uploaded.get(key)
+            if versioned_uri:
+                size = key[1]
+                with self.lock:
+                    self.files += 1
+                    self.bytes += size
+                logging.info("File [%s] has the same content as an object already uploaded by this job, using [%s] "
+                             "instead of transferring it again." % (self.uploader.getFileDisplayName(file_path),
+                                                                     versioned_uri))
+                if callback:
+                    callback(file_path=file_path, host=self.uploader.server_url, deduplicated=size)
+                return versioned_uri
+        versioned_uri = self.hatrac_upload(uri, file_path, md5=md5, sha256=sha256, content_type=content_type,
+                                           content_disposition=content_disposition, chunked=chunked,
+                                           create_parents=create_parents, allow_versioning=allow_versioning,
+                                           callback=callback)
+        if key and versioned_uri:
+            with self.lock:
+                self.uploaded.setdefault(key, versioned_uri)
+        return versioned_uri
@@ -0,0 +1,296 @@
+import os
+import mmap
+import time
+import queue
+import base64
+import hashlib
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from deriva.core import Megabyte, format_exception
+from deriva.qt.upload_gui.impl.transfer_metrics import format_bytes
+from deriva.qt.upload_gui.impl.archive_source import is_member_path, get_member_location, get_file_size, \
+    get_file_stat, open_file
+
+DEFAULT_HASH_WORKERS = min(4, os.cpu_count() or 1)
+# smaller files are hashed on the calling thread, as handing them to a worker process costs more than it saves
+DEFAULT_POOL_THRESHOLD = Megabyte * 64
+DEFAULT_HASH_BLOCK_SIZE = Megabyte * 8
+DEFAULT_PROGRESS_BYTES = Megabyte * 256
+DEFAULT_PROGRESS_INTERVAL = 1.0
+
+# set in each worker process, see FileHasher.start
+progress_queue = None
+
+
+def init_worker(queue):
+    global progress_queue
+    progress_queue = queue
+
+
+def hash_file_in_worker(file_path, hashes, location=None):
+    return hash_file(file_path, hashes, progress_queue, location)
+
+
+def hash_file(file_path, hashes, progress=None, location=None):
+    # Returns the same {algorithm: (hex digest, base64 digest)} as deriva.core.utils.hash_utils.compute_file_hashes,
+    # with the file size and the time taken. The file is read through a memory mapping, so the digests are updated
+    # straight from the page cache, and the kernel is told that it is read sequentially, so that it reads ahead further.
+    # A file stored in an archive as it is is mapped at its location in the archive, given as (archive, offset, size);
+    # a file of a compressed archive is read as it is decompressed.
+    hashers = dict()
+    for alg in hashes:
+        try:
+            hashers[alg] = hashlib.new(alg.lower())
+        except ValueError:
+            logging.warning("Unable to validate file contents using unknown hash algorithm: %s", alg)
+    start = time.time()
+    if location is None and is_member_path(file_path):
+        location = get_member_location(file_path)
+        if location is None:
+            with open_file(file_path) as fp:
+                size = hash_stream(fp, hashers, file_path, get_file_size(file_path), progress)
+            return get_digests(hashers), size, time.time() - start
+    path, offset, size = location or (file_path, 0, None)
+    with open(path, "rb") as fp:
+        fd = fp.fileno()
+        if size is None:
+            size = os.fstat(fd).st_size
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, offset, size, os.POSIX_FADV_SEQUENTIAL)
+        if size:
+            # mappings start at a multiple of the allocation granularity
+            base = offset - offset % mmap.ALLOCATIONGRANULARITY
+            with mmap.mmap(fd, size + offset - base, access=mmap.ACCESS_READ, offset=base) as data:
+                if hasattr(data, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                    data.madvise(mmap.MADV_SEQUENTIAL)
+                mapped = memoryview(data)
+                view = mapped[offset - base:]
+                try:
+                    reported = 0
+                    for offset in range(0, size, DEFAULT_HASH_BLOCK_SIZE):
+                        block = view[offset:offset + DEFAULT_HASH_BLOCK_SIZE]
+                        for hasher in hashers.values():
+                            hasher.update(block)
+                        block.release()
+                        done = min(size, offset + DEFAULT_HASH_BLOCK_SIZE)
+                        if progress is not None and done < size and done - reported >= DEFAULT_PROGRESS_BYTES:
+                            progress.put((file_path, done, size))
+                            reported = done
+                finally:
+                    view.release()
+                    mapped.release()
+    return get_digests(hashers), size, time.time() - start
+
+
+def hash_stream(fp, hashers, file_path, total, progress=None):
+    buffer = bytearray(DEFAULT_HASH_BLOCK_SIZE)
+    view = memoryview(buffer)
+    size = reported = 0
+    try:
+        while True:
+            count = fp.readinto(buffer)
+            if not count:
+                break
+            block = view[:count]
+            for hasher in hashers.values():
+                hasher.update(block)
+            block.release()
+            size += count
+            if progress is not None and size < total and size - reported >= DEFAULT_PROGRESS_BYTES:
+                progress.put((file_path, size, total))
+                reported = size
+    finally:
+        view.release()
+    return size
+
+
+def get_digests(hashers):
+    result = dict()
+    for alg, hasher in hashers.items():
+        result[alg] = hasher.hexdigest(), base64.b64encode(hasher.digest()).decode("ascii")
+    return result
+
+
+# Computes the whole-file checksums of an upload job on a pool of worker processes, so that the digests of several
+# large files are computed at once, each on its own core, instead of one file at a time on one core. Files below a size
+# threshold, all files when there is only one worker, and files of compressed archives (which are decompressed from a
+# stream kept open by the calling thread) are hashed on the calling thread. Where worker processes cannot be started,
+# threads are used instead; the digests release the interpreter lock, so they still run in parallel, though with more
+# contention. Progress of the files in the pool is passed to a status callback, at most once a second, and the overall
+# throughput is logged when the hasher is stopped.
+class FileHasher(object):
+
+    def __init__(self, workers=DEFAULT_HASH_WORKERS, pool_threshold=DEFAULT_POOL_THRESHOLD):
+        self.workers = max(1, workers)
+        self.pool_threshold = pool_threshold
+        self.executor = None
+        self.progress = None
+        self.monitor = None
+        self.status_callback = None
+        self.lock = threading.Lock()
+        self.active = dict()
+        self.finished = set()
+        self.inodes = dict()
+        self.linked = 0
+        self.files = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.started = 0.0
+
+    def start(self, status_callback=None):
+        self.status_callback = status_callback
+        self.files = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.started = time.time()
+        self.active.clear()
+        self.finished.clear()
+        self.inodes.clear()
+        self.linked = 0
+        self.progress = queue.Queue()
+        self.executor = None
+        if self.workers > 1:
+            try:
+                # a forked child of a process with running threads (the GUI's, or the upload pipeline's) can deadlock
+                context = multiprocessing.get_context("spawn")
+                progress = context.Queue()
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=context, initializer=init_worker,
+                                                    initargs=(progress,))
+                self.progress = progress
+            except Exception as e:
+                logging.warning("Unable to start checksum worker processes, using threads instead: %s" %
+                                format_exception(e))
+                self.executor = ThreadPoolExecutor(self.workers)
+        self.monitor = threading.Thread(target=self.monitorProgress, name="upload-hash-progress")
+        self.monitor.daemon = True
+        self.monitor.start()
+
+    def stop(self):
+        if self.monitor is None:
+            return
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.progress.put(None)
+        self.monitor.join()
+        self.monitor = None
+        elapsed = time.time() - self.started
+        if self.linked:
+            logging.info("Checksums: %d file(s) were hard links to files already hashed." % self.linked)
+        if self.files and elapsed > 0:
+            logging.info("Checksums: %d file(s), %s in %.1fs (%s/s overall, %s/s per file), %d worker(s)" % (
+                self.files, format_bytes(self.bytes), elapsed, format_bytes(self.bytes / elapsed),
+                format_bytes(self.bytes / self.busy if self.busy else 0), self.workers))
+
+    def submit(self, file_path, hashes):
+        # returns a future of hash_file's result; small files, or all files with a single worker, are hashed here. Hard
+        # links to a file that has already been submitted in this job (with the same checksums) share its result.
+        try:
+            st = get_file_stat(file_path)
+            size = st.st_size
+            inode = (st.st_dev, st.st_ino, st.st_size, st.st_mtime, tuple(sorted(hashes)))
+        except OSError:
+            size = 0
+            inode = None
+        if inode is not None and st.st_ino and not is_member_path(file_path):
+            future = self.inodes.get(inode)
+            if future is not None:
+                logging.debug("File [%s] is a hard link to a file already hashed." % file_path)
+                self.linked += 1
+                return future
+            future = self.inodes[inode] = self.hashFile(file_path, hashes, size)
+            return future
+        return self.hashFile(file_path, hashes, size)
+
+    def hashFile(self, file_path, hashes, size):
+        if size < self.pool_threshold:
+            return self.wrap(file_path, self.hashHere(file_path, hashes))
+        location = None
+        if is_member_path(file_path):
+            try:
+                location = get_member_location(file_path)
+            except Exception:
+                # reported by hashing it here
+                return self.wrap(file_path, self.hashHere(file_path, hashes))
+        with self.lock:
+            self.active[file_path] = (0, size)
+        if self.executor is None or (location is None and is_member_path(file_path)):
+            return self.wrap(file_path, self.hashHere(file_path, hashes, self.progress))
+        if not isinstance(self.executor, ThreadPoolExecutor):
+            try:
+                return self.wrap(file_path, self.executor.submit(hash_file_in_worker, file_path, hashes, location))
+            except BrokenProcessPool as e:
+                # the worker processes are started on demand, so a failure to start them shows up here
+                logging.warning("Checksum worker processes failed, using threads instead: %s" % format_exception(e))
+                self.executor.shutdown(wait=False)
+                self.executor = ThreadPoolExecutor(self.workers)
+        return self.wrap(file_path, self.executor.submit(hash_file, file_path, hashes, self.progress, location))
+
+    def hashHere(self, file_path, hashes, progress=None):
+        future = Future()
+        try:
+            future.set_result(hash_file(file_path, hashes, progress))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def wrap(self, file_path, future):
+        def done(f):
+            with self.lock:
+                self.active.pop(file_path, None)
+                self.finished.add(file_path)
+                if not f.cancelled() and f.exception() is None:
+                    hashes, size, elapsed = f.result()
+                    self.files += 1
+                    self.bytes += size
+                    self.busy += elapsed
+                    if elapsed > 0 and size >= self.pool_threshold:
+                        logging.debug("Computed checksums of file [%s] (%s) in %.1fs: %s/s" %
+                                      (file_path, format_bytes(size), elapsed, format_bytes(size / elapsed)))
+        future.add_done_callback(done)
+        return future
+
+    def monitorProgress(self):
+        last = 0.0
+        while True:
+            try:
+                item = self.progress.get(timeout=DEFAULT_PROGRESS_INTERVAL)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                file_path, done, size = item
+                with self.lock:
+                    # a late report of a file that has already been hashed is dropped
+                    if file_path not in self.finished:
+                        self.active[file_path] = (done, size)
+            now = time.time()
+            if now - last >= DEFAULT_PROGRESS_INTERVAL:
+                last = now
+                self.reportProgress()
+
+    def reportProgress(self):
+        with self.lock:
+            active = dict(self.active)
+            elapsed = time.time() - self.started
+            rate = (self.bytes + sum(done for done, size in active.values())) / elapsed if elapsed > 0 else 0
+        done = sum(done for done, size in active.values())
+        if not done or not self.status_callback:
+            return
+        total = sum(size for done, size in active.values())
+        percent = int(100.0 * done / total) if total else 0
+        if len(active) == 1:
+            status = "Computing checksums of file [%s]: %d%% complete (%s/s)" % (
+                os.path.basename(list(active.keys())[0]), percent, format_bytes(rate))
+        else:
+            status = "Computing checksums of %d files: %d%% complete (%s/s)" % (len(active), percent,
+                                                                                 format_bytes(rate))
+        try:
+            self.status_callback(status=status, hashing={"files": len(active), "percent": percent,
+                                                         "bytes_per_second": round(rate, 1)})
+        except Exception as e:
+            logging.debug("Checksum progress callback failed: %s" % format_exception(e))
@@ -0,0 +1,309 @@
+import sys
+import json
+import time
+import signal
+import threading
+import logging
+import platform
+import urllib.parse
+from PyQt5.QtCore import QObject, QCoreApplication, QTimer, pyqtSlot
+from deriva.core import write_config, stob, format_exception, get_credential, DEFAULT_CHUNK_SIZE
+from deriva.transfer.upload.deriva_upload import UploadState
+from deriva.qt import __version__ as VERSION
+from deriva.qt.upload_gui.impl.upload_tasks import SessionQueryTask, ConfigUpdateTask, ScanDirectoryTask, \
+    PreflightTask, UploadFilesTask, VerifyUploadsTask
+from deriva.qt.upload_gui.impl.transfer_metrics import TransferMetrics, FINISHED_STATES
+from deriva.qt.upload_gui.impl.upload_verifier import VERIFY_OK, VERIFY_MISMATCH, VERIFY_UNVERIFIED
+from deriva.qt.upload_gui.impl.upload_extensions import attach_upload_extensions
+from deriva.qt.upload_gui.impl.upload_order import UPLOAD_ORDER_SCAN
+
+# exit codes
+EXIT_SUCCESS = 0
+EXIT_ERROR = 1
+EXIT_FILES_FAILED = 2
+EXIT_INCOMPLETE = 3
+EXIT_LOGIN_REQUIRED = 4
+
+# progress events for a file in flight are written at most this many seconds apart
+DEFAULT_PROGRESS_INTERVAL = 1.0
+# UploadState is a tuple of state names, each state being its index
+STATE_NAMES = dict(enumerate(UploadState))
+
+
+# Runs the same session check, configuration update, directory scan and upload task sequence as the upload window, on
+# a QCoreApplication without any widget or web engine. Progress is written to stdout as line-delimited JSON, one object
+# per event, while log output goes to stderr. The exit code reflects the outcome of the individual files:
+#   0  every file was uploaded
+#   1  the job could not be run (no server, incompatible version, configuration or scan failure)
+#   2  one or more files failed to upload (or, with verification, do not match the uploaded objects)
+#   3  the job was interrupted, and can be resumed by running it again
+#   4  no valid session could be established with the server; log in with deriva-auth first
+class HeadlessUploadRunner(QObject):
+
+    def __init__(self,
+                 uploader,
+                 directory,
+                 config_file=None,
+                 credential_file=None,
+                 hostname=None,
+                 purge_state=False,
+                 upload_order=UPLOAD_ORDER_SCAN,
+                 transfer_options=None,
+                 verify=False,
+                 output=None,
+                 parent=None):
+        super(HeadlessUploadRunner, self).__init__(parent)
+        self.directory = directory
+        self.purge_state = purge_state
+        self.upload_order = upload_order
+        self.verify = verify
+        self.output = output if output else sys.stdout
+        self.exit_code = EXIT_SUCCESS
+        self.metrics = None
+        self.task = None
+        self.paths = list()
+        self.cursor = 0
+        self.last_progress = dict()
+        self.reported = dict()
+        self.output_lock = threading.Lock()
+
+        server = None
+        if hostname:
+            server = dict()
+            if hostname.startswith("http"):
+                url = urllib.parse.urlparse(hostname)
+                server["protocol"] = url.scheme
+                server["host"] = url.netloc
+            else:
+                server["protocol"] = "https"
+                server["host"] = hostname
+        self.credential_file = credential_file
+        self.uploader = uploader(config_file, credential_file, server)
+        extensions = attach_upload_extensions(self.uploader, transfer_options)
+        self.transfer_journal = extensions.transfer_journal
+        self.upload_verifier = extensions.upload_verifier
+
+        info = "%s v%s [Python %s, %s]" % (
+            self.__class__.__name__, VERSION, platform.python_version(), platform.platform(aliased=True))
+        logging.info("Initializing headless upload: %s" % info)
+
+    def emit(self, event, **kwargs):
+        record = {"event": event, "time": round(time.time(), 3)}
+        record.update(kwargs)
+        # events are written from both the main thread and the upload thread
+        with self.output_lock:
+            self.output.write(json.dumps(record) + "\n")
+            self.output.flush()
+
+    def start(self):
+        if not (self.uploader.server and self.uploader.server.get("host")):
+            self.finish(EXIT_ERROR, "No server configured")
+            return
+        if not self.uploader.isVersionCompatible():
+            self.finish(EXIT_ERROR, "Version incompatibility detected: current version: %s, required version: %s" %
+                        (self.uploader.getVersion(), self.uploader.getVersionCompatibility()))
+            return
+        host = self.uploader.server["host"]
+        self.setCredentials()
+        self.emit("start", host=host, directory=self.directory)
+        self.task = SessionQueryTask(self.uploader)
+        self.task.status_update_signal.connect(self.onSessionResult)
+        self.task.query()
+
+    def setCredentials(self):
+        # without a stored credential the session check fails, which is reported as a login being required
+        host = self.uploader.server["host"]
+        try:
+            credential = get_credential(host, self.credential_file)
+        except (OSError, ValueError) as e:
+            logging.warning("Unable to read stored credential for [%s]: %s" % (host, format_exception(e)))
+            return
+        if credential:
+            self.uploader.setCredentials(credential)
+
+    def cancel(self):
+        # progress is saved, so that running the same job again resumes it
+        if self.uploader.cancelled:
+            return
+        logging.warning("Interrupted, stopping after the current chunk...")
+        self.uploader.cancel()
+        self.upload_verifier.cancel()
+
+    def finish(self, exit_code, error=None):
+        self.exit_code = exit_code
+        if error:
+            logging.error(error)
+            self.emit("error", message=error)
+        self.emit("finish", exit_code=exit_code)
+        QCoreApplication.instance().exit(exit_code)
+
+    @pyqtSlot(bool, str, str, object)
+    def onSessionResult(self, success, status, detail, result):
+        if not success:
+            self.finish(EXIT_LOGIN_REQUIRED, "%s: %s" % (status, detail))
+            return
+        self.emit("session", client=result.get("client", {}).get("id"))
+        self.task = ConfigUpdateTask(self.uploader)
+        self.task.status_update_signal.connect(self.onUpdateConfigResult)
+        self.task.update_config()
+
+    @pyqtSlot(bool, str, str, object)
+    def onUpdateConfigResult(self, success, status, detail, result):
+        if not success:
+            self.finish(EXIT_ERROR, "%s: %s" % (status, detail))
+            return
+        if result:
+            if stob(self.uploader.server.get("confirm_updates", False)):
+                logging.warning("An updated configuration is available, but this server requires updates to be "
+                                "confirmed interactively. Continuing with the existing configuration.")
+            else:
+                write_config(self.uploader.getDeployedConfigFilePath(), result)
+                self.uploader.initialize(cleanup=False)
+                self.setCredentials()
+                if not self.uploader.isVersionCompatible():
+                    self.finish(EXIT_ERROR, "Version incompatibility detected: current version: %s, required "
+                                            "version: %s" % (self.uploader.getVersion(),
+                                                             self.uploader.getVersionCompatibility()))
+                    return
+        self.uploader.reset()
+        self.task = ScanDirectoryTask(self.uploader)
+        self.task.status_update_signal.connect(self.onScanResult)
+        self.task.scan(self.directory, purge_state=self.purge_state)
+
+    @pyqtSlot(bool, str, str, object)
+    def onScanResult(self, success, status, detail, result):
+        if not success:
+            self.finish(EXIT_ERROR, "%s: %s" % (status, detail))
+            return
+        self.paths = [file_path for assets in self.uploader.file_list.values()
+                      for asset_group_num, asset_mapping, groupdict, file_path in assets]
+        self.emit("scan", files=len(self.paths), skipped=len(self.uploader.skipped_files),
+                  resumable=sum(1 for file_path in self.paths
+                                if self.uploader.file_status[file_path]["State"] == UploadState.Paused))
+        if not self.paths:
+            self.finish(EXIT_SUCCESS)
+            return
+        self.task = PreflightTask(self.uploader)
+        self.task.status_update_signal.connect(self.onPreflightResult)
+        self.task.preflight(order=self.upload_order)
+
+    @pyqtSlot(bool, str, str, object)
+    def onPreflightResult(self, success, status, detail, result):
+        if not success:
+            logging.warning("%s: %s" % (status, detail))
+        elif result:
+            self.emit("preflight", **result)
+        remaining = [file_path for assets in self.uploader.file_list.values()
+                     for asset_group_num, asset_mapping, groupdict, file_path in assets]
+        for file_path in set(self.paths).difference(remaining):
+            state = self.uploader.file_status[file_path]
+            self.emit("file", file=file_path, state=STATE_NAMES.get(state["State"]), status=state["Status"])
+        self.paths = remaining
+        self.metrics = TransferMetrics()
+        self.metrics.start(self.uploader)
+        self.transfer_journal.beginJob()
+        self.task = UploadFilesTask(self.uploader)
+        self.task.status_update_signal.connect(self.onUploadResult)
+        self.task.upload(status_callback=self.statusCallback, file_callback=self.uploadCallback)
+
+    def statusCallback(self, **kwargs):
+        # runs on the upload thread; files are uploaded in scan order, so only the file at the cursor can have changed
+        if kwargs.get("hashing"):
+            self.emit("hashing", **kwargs["hashing"])
+            return
+        self.metrics.updateStatus(self.uploader.file_status)
+        while self.cursor < len(self.paths):
+            file_path = self.paths[self.cursor]
+            state = self.uploader.file_status.get(file_path, {})
+            if state.get("State") not in FINISHED_STATES:
+                break
+            self.emit("file", file=file_path, state=STATE_NAMES.get(state["State"]), status=state.get("Status"))
+            self.reported[file_path] = state["State"]
+            self.last_progress.pop(file_path, None)
+            self.cursor += 1
+        # a file reported as uploaded can still fail afterwards, when its batched catalog write fails; it is then
+        # reported again with its new state
+        file_path = kwargs.get("file_path")
+        if file_path:
+            self.metrics.reviseFile(file_path, self.uploader.file_status)
+            state = self.uploader.file_status.get(file_path, {})
+            if file_path in self.reported and state.get("State") != self.reported[file_path]:
+                self.emit("file", file=file_path, state=STATE_NAMES.get(state["State"]), status=state.get("Status"))
+                self.reported[file_path] = state["State"]
+
+    def uploadCallback(self, **kwargs):
+        completed = kwargs.get("completed")
+        total = kwargs.get("total")
+        file_path = kwargs.get("file_path")
+        job_info = kwargs.get("job_info", {})
+        if kwargs.get("deduplicated"):
+            self.metrics.deduplicate(file_path)
+        elif completed and total:
+            job_info.update({"completed": completed, "total": total, "host": kwargs.get("host")})
+            self.uploader.setTransferState(file_path, job_info)
+            completed_bytes = completed * job_info.get("chunk-length", DEFAULT_CHUNK_SIZE)
+            self.metrics.update(file_path, completed_bytes)
+            now = time.time()
+            if now - self.last_progress.get(file_path, 0) >= DEFAULT_PROGRESS_INTERVAL or completed >= total:
+                self.last_progress[file_path] = now
+                percent, rate = self.metrics.fileProgress(file_path)
+                self.emit("progress", file=file_path, percent=percent, bytes_per_second=round(rate, 1),
+                          job=self.metrics.snapshot())
+        if self.uploader.cancelled:
+            return -1
+        return True
+
+    @pyqtSlot(bool, str, str, object)
+    def onUploadResult(self, success, status, detail, result):
+        self.metrics.updateStatus(self.uploader.file_status)
+        self.metrics.finish()
+        self.emit("summary", **self.metrics.summary())
+        states = [value["State"] for value in self.uploader.file_status.values()]
+        if any(state in (UploadState.Failed, UploadState.Aborted) for state in states):
+            exit_code = EXIT_FILES_FAILED
+        elif any(state not in (UploadState.Success,) for state in states):
+            exit_code = EXIT_INCOMPLETE
+        else:
+            exit_code = EXIT_SUCCESS
+            self.transfer_journal.endJob()
+        self.uploader.cleanupTransferState()
+        uploads = self.upload_verifier.takeUploads() if self.verify else None
+        if not uploads:
+            self.finish(exit_code)
+            return
+        self.exit_code = exit_code
+        self.task = VerifyUploadsTask(self.uploader)
+        self.task.status_update_signal.connect(self.onVerifyResult)
+        self.task.verify(self.upload_verifier, uploads, callback=self.verifyCallback)
+
+    def verifyCallback(self, file_path, outcome, message):
+        self.emit("verify", file=file_path, outcome=outcome, message=message)
+
+    @pyqtSlot(bool, str, str, object)
+    def onVerifyResult(self, success, status, detail, result):
+        if not success:
+            self.finish(self.exit_code, "%s: %s" % (status, detail))
+            return
+        outcomes = [outcome for outcome, message in result.values()]
+        self.emit("verification", files=len(outcomes), verified=outcomes.count(VERIFY_OK),
+                  mismatched=outcomes.count(VERIFY_MISMATCH), unverified=outcomes.count(VERIFY_UNVERIFIED))
+        if VERIFY_MISMATCH in outcomes and self.exit_code == EXIT_SUCCESS:
+            self.finish(EXIT_FILES_FAILED)
+        else:
+            self.finish(self.exit_code)
+
+
+def run_headless(uploader, directory, config_file=None, credential_file=None, hostname=None, purge_state=False,
+                 upload_order=UPLOAD_ORDER_SCAN, transfer_options=None, verify=False):
+    # QtCore only: no widget or web engine modules are loaded in this process
+    app = QCoreApplication(sys.argv)
+    runner = HeadlessUploadRunner(uploader, directory, config_file, credential_file, hostname, purge_state,
+                                  upload_order, transfer_options, verify)
+    signal.signal(signal.SIGINT, lambda signum, frame: runner.cancel())
+    # Python signal handlers only run when the interpreter gets control, which it does not while Qt's event loop idles
+    heartbeat = QTimer()
+    heartbeat.timeout.connect(lambda: None)
+    heartbeat.start(500)
+    QTimer.singleShot(0, runner.start)
+    app.exec_()
+    return runner.exit_code
@@ -0,0 +1,143 @@
+import logging
+from collections import OrderedDict
+from deriva.core import urlquote, format_exception
+from deriva.transfer.upload.deriva_upload import UploadState, FileUploadState
+from deriva.qt.upload_gui.impl.catalog_batch import TABLE_ASSET_TYPES
+from deriva.qt.upload_gui.impl.upload_order import order_file_list, UPLOAD_ORDER_SCAN
+
+# checksums looked up per catalog query; each one adds a filter term to the query URL, which is limited in length
+DEFAULT_PREFLIGHT_BATCH_SIZE = 100
+CHECKSUM_TEMPLATES = (("md5", "{md5}"), ("sha256", "{sha256}"))
+URI_TEMPLATES = ("{URI}", "{URI_urlencoded}")
+# what an upload job includes, as selected in the options dialog: "data" means table assets only
+UPLOAD_MODE_ALL = "all"
+UPLOAD_MODE_FILES = "files"
+UPLOAD_MODE_DATA = "data"
+
+
+def get_checksum_columns(asset_mapping):
+    # the catalog columns an asset mapping records the file checksum and the object URL in, if it records them at all
+    column_map = asset_mapping.get("column_map", {})
+    uri_column = next((column for column, template in column_map.items() if template in URI_TEMPLATES), None)
+    for alg, template in CHECKSUM_TEMPLATES:
+        column = next((column for column, template_ in column_map.items() if template_ == template), None)
+        if column:
+            return alg, column, uri_column
+    return None, None, uri_column
+
+
+# Looks up, ahead of the upload, which of the scanned files are already in the catalog, so that a re-run after a
+# partial failure does not send every file through the per-file upload path just to find that it exists. No file is
+# hashed here: only files whose checksums the transfer journal cached in an earlier run (and which have not changed
+# since) are candidates, and they are looked up by checksum in their target tables, in batches of disjunctive filters:
+# one query per batch of files rather than several round trips per file. Everything else is hashed by the upload
+# pipeline's pool. A file counts as present when a row with its checksum has an object URL and agrees with every other
+# mapped column whose value is known before the upload (e.g. file name and size). Present files are marked as skipped
+# and removed from the uploader's file list. Any failure here only means the files are uploaded as usual.
+class UploadPreflight(object):
+
+    def __init__(self, uploader, batch_size=DEFAULT_PREFLIGHT_BATCH_SIZE):
+        self.uploader = uploader
+        self.batch_size = batch_size
+
+    def getScanMetadata(self, file_path, asset_mapping, groupdict, table, hashes):
+        # the subset of the upload metadata that is known without querying the catalog
+        metadata = dict(groupdict)
+        metadata["target_table"] = table
+        metadata["file_name"] = self.uploader.getFileDisplayName(file_path)
+        metadata["file_size"] = self.uploader.getFileSize(file_path)
+        for alg, checksum in hashes.items():
+            metadata[alg.lower()] = checksum[0]
+            metadata[alg.lower() + "_base64"] = checksum[1]
+        return metadata
+
+    def filterUploadMode(self, mode):
+        uploader = self.uploader
+        excluded = 0
+        for group in list(uploader.file_list.keys()):
+            assets = list()
+            for entry in uploader.file_list[group]:
+                is_data = entry[1].get("asset_type", "file") in TABLE_ASSET_TYPES
+                if (mode == UPLOAD_MODE_FILES and is_data) or (mode == UPLOAD_MODE_DATA and not is_data):
+                    uploader.file_status[entry[3]] = \
+                        FileUploadState(UploadState.Cancelled, "Skipped: excluded by upload options")._asdict()
+                    excluded += 1
+                else:
+                    assets.append(entry)
+            if assets:
+                uploader.file_list[group] = assets
+            else:
+                del uploader.file_list[group]
+        return excluded
+
+    def run(self, mode=UPLOAD_MODE_ALL, order=UPLOAD_ORDER_SCAN):
+        uploader = self.uploader
+        excluded = self.filterUploadMode(mode) if mode != UPLOAD_MODE_ALL else 0
+        order_file_list(uploader, order)
+        get_cached_hashes = getattr(uploader, "getCachedFileHashes", None)
+        candidates = OrderedDict()
+        for assets in uploader.file_list.values():
+            for asset_group_num, asset_mapping, groupdict, file_path in assets:
+                if uploader.cancelled:
+                    return None
+                # partially uploaded files are resumed instead
+                if uploader.getTransferState(file_path):
+                    continue
+                alg, column, uri_column = get_checksum_columns(asset_mapping)
+                if not (column and uri_column and get_cached_hashes):
+                    continue
+                try:
+                    hashes = get_cached_hashes(file_path, asset_mapping.get('checksum_types', ['md5', 'sha256']))
+                    if not hashes or alg not in hashes:
+                        continue
+                    table = uploader.getCatalogTable(asset_mapping, groupdict)
+                except Exception as e:
+                    logging.debug("Pre-flight check skipped for file [%s]: %s" % (file_path, format_exception(e)))
+                    continue
+                metadata = self.getScanMetadata(file_path, asset_mapping, groupdict, table, hashes)
+                expected = uploader.interpolateDict(metadata, asset_mapping.get("column_map", {}))
+                expected.pop(uri_column, None)
+                files = candidates.setdefault((table, column, uri_column), OrderedDict())
+                files.setdefault(hashes[alg][0], list()).append((file_path, expected))
+
+        present = list()
+        queries = 0
+        for (table, column, uri_column), files in candidates.items():
+            checksums = list(files.keys())
+            for i in range(0, len(checksums), self.batch_size):
+                if uploader.cancelled:
+                    return None
+                batch = checksums[i:i + self.batch_size]
+                path = "/entity/%s/%s" % (table, ";".join(["%s=%s" % (urlquote(column), urlquote(checksum))
+                                                          for checksum in batch]))
+                try:
+                    rows = uploader.catalog.get(path).json()
+                    queries += 1
+                except Exception as e:
+                    logging.warning("Pre-flight query of table [%s] failed: %s" % (table, format_exception(e)))
+                    continue
+                for row in rows:
+                    if not row.get(uri_column):
+                        continue
+                    for file_path, expected in files.get(row.get(column), []):
+                        if all(str(row.get(key)) == str(value) for key, value in expected.items()):
+                            present.append(file_path)
+
+        skipped = set(present)
+        skipped_bytes = 0
+        for group in list(uploader.file_list.keys()):
+            assets = [entry for entry in uploader.file_list[group] if entry[3] not in skipped]
+            if assets:
+                uploader.file_list[group] = assets
+            else:
+                del uploader.file_list[group]
+        for file_path in skipped:
+            uploader.file_status[file_path] = \
+                FileUploadState(UploadState.Success, "Skipped: already in catalog")._asdict()
+            skipped_bytes += uploader.getFileSize(file_path)
+        candidate_count = sum(len(paths) for files in candidates.values() for paths in files.values())
+        if candidate_count:
+            logging.info("Pre-flight check: %d of %d file(s) are already in the catalog (%d queries)." %
+                         (len(skipped), candidate_count, queries))
+        return {"candidates": candidate_count, "skipped": len(skipped), "skipped_bytes": skipped_bytes,
+                "queries": queries, "excluded": excluded}
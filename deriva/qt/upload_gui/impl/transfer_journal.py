@@ -0,0 +1,421 @@
+import os
+import json
+import time
+import logging
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from requests import HTTPError
+from deriva.core import format_exception
+from deriva.transfer.upload.deriva_upload import UploadState, FileUploadState
+from deriva.qt.upload_gui.impl.archive_source import is_archive, is_file, is_member_path, get_stat_key, \
+    get_state_directory
+from deriva.qt.upload_gui.impl.file_hasher import hash_file
+
+JOURNAL_SUFFIX = ".journal"
+JOB_INDEX_FILE_NAME = "unfinished-uploads.json"
+# the journal is flushed to the OS on every record, so it survives a crash of the application; it is synced to disk at
+# most this many seconds apart, which bounds what can be lost in a crash of the operating system
+DEFAULT_FSYNC_INTERVAL = 2.0
+# the journal is compacted into a single snapshot record once it holds this many records, or four records per live
+# entry, whichever is larger
+DEFAULT_COMPACT_THRESHOLD = 1000
+# number of concurrent requests used to check the server-side state of partial uploads
+DEFAULT_CHECK_MAX_THREADS = 8
+
+
+def get_job_index_path(uploader):
+    return os.path.join(uploader.getDeployedConfigPath(), uploader.server.get("host", ""), JOB_INDEX_FILE_NAME)
+
+
+def read_job_index(uploader):
+    # a per-host list of the directories that have an unfinished upload job, which is how jobs are found at startup
+    path = get_job_index_path(uploader)
+    if not os.path.isfile(path):
+        return OrderedDict()
+    try:
+        with open(path, encoding="utf-8") as jf:
+            return json.load(jf, object_pairs_hook=OrderedDict)
+    except Exception as e:
+        logging.warning("Unable to read unfinished upload index [%s]: %s" % (path, format_exception(e)))
+        return OrderedDict()
+
+
+def update_job_index(uploader, root, entry):
+    index = read_job_index(uploader)
+    if entry is None:
+        if root not in index:
+            return
+        index.pop(root)
+    else:
+        index[root] = entry
+    path = get_job_index_path(uploader)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".unfinished-uploads-", suffix=".tmp", dir=os.path.dirname(path))
+    with os.fdopen(fd, "w", encoding="utf-8") as tf:
+        tf.write(json.dumps(index, indent=2))
+    os.replace(temp_path, path)
+
+
+def get_config_fingerprint(uploader):
+    # the asset mappings a job was scanned with; a job can only be resumed without a rescan if they are unchanged
+    return hashlib.md5(json.dumps(uploader.asset_mappings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# Keeps the uploader's transfer state (the resume information for chunked uploads) in an append-only journal next to
+# the uploader's transfer state file, instead of rewriting that file on every chunk. The journal holds a snapshot
+# followed by incremental records; on load it is replayed on top of the state file, so an interrupted job resumes from
+# its last journaled chunk. Besides the transfer state, the journal records the file list of the current upload job, the
+# files of that job already uploaded, and the checksums computed for each file (keyed by size and mtime), which is what
+# lets an interrupted job be resumed after a restart without rescanning or rehashing anything. Checksums are only kept
+# for the files of the current or unfinished job and for partial uploads, and the journal is removed once nothing is
+# left to resume. The state file itself is only rewritten when the journal is checkpointed, i.e. when the uploader
+# cleans up its transfer state.
+class TransferJournal(object):
+
+    def __init__(self, uploader, fsync_interval=DEFAULT_FSYNC_INTERVAL, compact_threshold=DEFAULT_COMPACT_THRESHOLD):
+        self.uploader = uploader
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+        self.lock = threading.RLock()
+        self.path = None
+        self.fh = None
+        self.records = 0
+        self.last_sync = 0
+        self.root = None
+        self.job = None
+        self.done = OrderedDict()
+        self.hashes = dict()
+
+    @classmethod
+    def attach(cls, uploader, **kwargs):
+        # the uploader calls these from its own code paths (scan, upload, reset), so they are replaced on the instance
+        journal = cls(uploader, **kwargs)
+        uploader.loadTransferState = journal.loadTransferState
+        uploader.setTransferState = journal.setTransferState
+        uploader.delTransferState = journal.delTransferState
+        uploader.cleanupTransferState = journal.cleanupTransferState
+        uploader.getFileHashes = journal.getFileHashes
+        # lets checksums computed elsewhere (e.g. on the upload pipeline's hasher) be looked up in, and added to, the
+        # cache
+        uploader.getCachedFileHashes = journal.getCachedFileHashes
+        uploader.setCachedFileHashes = journal.setCachedFileHashes
+        return journal
+
+    @staticmethod
+    def getJournalPath(uploader, directory):
+        if is_archive(directory):
+            # the transfer state of an archive is kept in the directory it is in, with a journal of its own
+            return os.path.join(os.path.dirname(directory), uploader.getTransferStateFileName()) + "." + \
+                os.path.basename(directory) + JOURNAL_SUFFIX
+        return os.path.join(directory, uploader.getTransferStateFileName()) + JOURNAL_SUFFIX
+
+    @staticmethod
+    def replay(path, state=None):
+        contents = {"state": OrderedDict(state or {}),
+                    "job": None,
+                    "done": OrderedDict(),
+                    "hashes": dict(),
+                    "records": 0}
+        if not os.path.isfile(path):
+            return contents
+        with open(path, encoding="utf-8") as jf:
+            for line in jf:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a record torn by a crash can only be the last one
+                    logging.warning("Ignoring incomplete record at the end of transfer journal: %s" % path)
+                    break
+                op = record.get("op")
+                if op == "snapshot":
+                    contents["state"] = OrderedDict(record.get("state", {}))
+                    contents["job"] = record.get("job")
+                    contents["done"] = OrderedDict.fromkeys(record.get("done", []), True)
+                    contents["hashes"] = record.get("hashes", {})
+                elif op == "set":
+                    contents["state"][record["path"]] = record["state"]
+                elif op == "del":
+                    contents["state"].pop(record["path"], None)
+                elif op == "done":
+                    contents["done"][record["path"]] = True
+                elif op == "undo":
+                    contents["done"].pop(record["path"], None)
+                elif op == "hash":
+                    contents["hashes"][record["path"]] = record["entry"]
+                contents["records"] += 1
+        return contents
+
+    @classmethod
+    def read(cls, uploader, directory):
+        # reads what is recorded for a directory without taking the uploader's lock on it
+        state = dict()
+        try:
+            with open(os.path.join(get_state_directory(directory), uploader.getTransferStateFileName()),
+                      encoding="utf-8") as sf:
+                state = json.load(sf, object_pairs_hook=OrderedDict)
+        except (OSError, ValueError):
+            pass
+        return cls.replay(cls.getJournalPath(uploader, directory), state)
+
+    def loadTransferState(self, directory, purge=False):
+        type(self.uploader).loadTransferState(self.uploader, get_state_directory(directory), purge)
+        with self.lock:
+            self._close()
+            self.root = directory
+            self.path = self.getJournalPath(self.uploader, directory)
+            if purge and os.path.isfile(self.path):
+                os.remove(self.path)
+            contents = self.replay(self.path, self.uploader.transfer_state)
+            if contents["records"]:
+                logging.info("Recovered transfer state for %d file(s) from journal: %s" %
+                             (len(contents["state"]), self.path))
+            self.uploader.transfer_state = contents["state"]
+            self.job = contents["job"]
+            self.done = contents["done"]
+            self.hashes = contents["hashes"]
+            # start every session from a single snapshot record, which keeps recovery time bounded
+            self._compact()
+
+    def setTransferState(self, file_path, transfer_state):
+        with self.lock:
+            self.uploader.transfer_state[file_path] = transfer_state
+            self._append({"op": "set", "path": file_path, "state": transfer_state})
+
+    def delTransferState(self, file_path):
+        # the uploader calls this once it is done with a file, whatever the outcome, and whether it had state or not
+        with self.lock:
+            if self.job is not None:
+                if self.uploader.file_status.get(file_path, {}).get("State") == UploadState.Success:
+                    self.done[file_path] = True
+                    self._append({"op": "done", "path": file_path})
+                elif self.done.pop(file_path, None):
+                    # a file can still fail after its transfer, e.g. when its catalog writes are batched
+                    self._append({"op": "undo", "path": file_path})
+            if self.uploader.transfer_state.pop(file_path, None) is not None:
+                self._append({"op": "del", "path": file_path})
+
+    def cleanupTransferState(self):
+        with self.lock:
+            if self.fh is not None:
+                self.checkpoint()
+            self._close()
+        type(self.uploader).cleanupTransferState(self.uploader)
+
+    def getFileHashes(self, file_path, hashes=frozenset(['md5'])):
+        key = get_stat_key(file_path)
+        if key is None:
+            return self.computeFileHashes(file_path, hashes)
+        result = self.getCachedFileHashes(file_path, hashes, key)
+        if result:
+            return result
+        result = self.computeFileHashes(file_path, hashes)
+        if result:
+            self.setCachedFileHashes(file_path, result, key)
+        return result
+
+    def getCachedFileHashes(self, file_path, hashes, key=None):
+        # the cached checksums of a file, as long as its size and modification time have not changed; None otherwise
+        key = key or get_stat_key(file_path)
+        with self.lock:
+            entry = self.hashes.get(file_path)
+        if key and entry and entry["stat"] == key and set(hashes).issubset(entry["hashes"].keys()):
+            return {alg: tuple(value) for alg, value in entry["hashes"].items() if alg in hashes}
+        return None
+
+    def setCachedFileHashes(self, file_path, result, key):
+        # key is the file's stat key from before it was hashed, so a file changed while it was hashed is hashed again
+        if not (result and key):
+            return
+        with self.lock:
+            entry = {"stat": key, "hashes": {alg: list(value) for alg, value in result.items()}}
+            self.hashes[file_path] = entry
+            self._append({"op": "hash", "path": file_path, "entry": entry})
+
+    def computeFileHashes(self, file_path, hashes):
+        if is_member_path(file_path):
+            return hash_file(file_path, hashes)[0]
+        return type(self.uploader).getFileHashes(file_path, hashes)
+
+    def beginJob(self, resumed=False):
+        # records the scanned file list, so that the job can be resumed after a restart without a rescan
+        with self.lock:
+            if not self.root:
+                return
+            if not (resumed and self.job):
+                files = [[asset_group_num, groupdict, file_path]
+                         for assets in self.uploader.file_list.values()
+                         for asset_group_num, asset_mapping, groupdict, file_path in assets]
+                self.job = {"root": self.root,
+                            "fingerprint": get_config_fingerprint(self.uploader),
+                            "started": time.time(),
+                            "files": files}
+                self.done = OrderedDict()
+            self._compact()
+            root, entry = self.root, {"started": self.job["started"], "files": len(self.job["files"])}
+        self._updateIndex(root, entry)
+
+    def endJob(self):
+        with self.lock:
+            if self.job is None:
+                return
+            root = self.root
+            self.job = None
+            self.done = OrderedDict()
+            self._compact()
+        self._updateIndex(root, None)
+
+    def discardJob(self, root):
+        self._updateIndex(root, None)
+
+    def _updateIndex(self, root, entry):
+        try:
+            update_job_index(self.uploader, root, entry)
+        except Exception as e:
+            logging.warning("Unable to update unfinished upload index: %s" % format_exception(e))
+
+    def checkJob(self, root):
+        # summarizes the unfinished job recorded for a directory, checking the server-side upload jobs of partially
+        # uploaded files concurrently, since a job that has expired on the server cannot be resumed
+        contents = self.read(self.uploader, root)
+        job = contents["job"]
+        if not job:
+            self._updateIndex(root, None)
+            return None
+        files = [file_path for asset_group_num, groupdict, file_path in job["files"]]
+        remaining = [file_path for file_path in files if file_path not in contents["done"]]
+        missing = [file_path for file_path in remaining if not is_file(file_path)]
+        partial = [file_path for file_path in remaining
+                   if file_path in contents["state"] and file_path not in missing]
+        expired = list()
+        if partial:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_CHECK_MAX_THREADS) as executor:
+                results = executor.map(self._checkUploadJob, [contents["state"][file_path] for file_path in partial])
+                expired = [file_path for file_path, valid in zip(partial, results) if not valid]
+        return {"root": root,
+                "files": len(files),
+                "done": len(files) - len(remaining),
+                "remaining": len(remaining),
+                "partial": len(partial) - len(expired),
+                "expired": expired,
+                "missing": missing,
+                "resumable": job.get("fingerprint") == get_config_fingerprint(self.uploader)}
+
+    def _checkUploadJob(self, transfer_state):
+        try:
+            self.uploader.store.get_upload_job(transfer_state["target"], transfer_state["url"].rsplit("/", 1)[1])
+            return True
+        except HTTPError as e:
+            # the upload job has been finalized, cancelled, or has expired on the server
+            if e.response is not None and e.response.status_code in (404, 409):
+                return False
+            logging.warning("Unable to check upload job [%s]: %s" % (transfer_state["url"], format_exception(e)))
+        except Exception as e:
+            logging.warning("Unable to check upload job [%s]: %s" % (transfer_state.get("url"), format_exception(e)))
+        # when in doubt, let the upload itself find out
+        return True
+
+    def resumeJob(self, root, expired=None):
+        # rebuilds the uploader's file list from the journal in place of a directory scan; files already uploaded are
+        # only listed, and partial uploads whose server-side job has expired start over
+        uploader = self.uploader
+        uploader.loadTransferState(root)
+        with self.lock:
+            if not self.job:
+                raise ValueError("No unfinished upload found in directory [%s]" % root)
+            for file_path in expired or []:
+                if uploader.transfer_state.pop(file_path, None) is not None:
+                    self._append({"op": "del", "path": file_path})
+            for asset_group_num, groupdict, file_path in self.job["files"]:
+                if file_path in self.done:
+                    uploader.file_status[file_path] = FileUploadState(UploadState.Success, "Complete")._asdict()
+                    continue
+                if not is_file(file_path):
+                    uploader.file_status[file_path] = FileUploadState(UploadState.Failed, "File not found")._asdict()
+                    continue
+                uploader.file_list.setdefault(asset_group_num, list()).append(
+                    (asset_group_num, uploader.asset_mappings[asset_group_num], groupdict, file_path))
+                status = uploader.getTransferStateStatus(file_path)
+                if status:
+                    uploader.file_status[file_path] = FileUploadState(UploadState.Paused, status)._asdict()
+                else:
+                    uploader.file_status[file_path] = FileUploadState(UploadState.Pending, "Pending")._asdict()
+
+    def checkpoint(self):
+        # fold the journal into the uploader's own state file, so that it is current for anything that does not know
+        # about the journal; the journal is compacted first, so that it stays authoritative if this is interrupted
+        with self.lock:
+            self._compact()
+            state_fh = self.uploader.transfer_state_fh
+            if state_fh is None or state_fh.closed:
+                return
+            type(self.uploader).writeTransferState(self.uploader)
+            try:
+                os.fsync(state_fh.fileno())
+            except (OSError, ValueError) as e:
+                logging.warning("Unable to sync transfer state file, keeping journal: %s" % format_exception(e))
+                return
+            if not (self.uploader.transfer_state or self.job):
+                # nothing left to resume
+                self._close()
+                os.remove(self.path)
+                self.path = None
+
+    def _append(self, record):
+        if self.fh is None:
+            return
+        try:
+            self.fh.write(json.dumps(record) + "\n")
+            self.fh.flush()
+            self.records += 1
+            now = time.time()
+            if now - self.last_sync >= self.fsync_interval:
+                os.fsync(self.fh.fileno())
+                self.last_sync = now
+            live = len(self.uploader.transfer_state) + len(self.done) + len(self.hashes)
+            if self.records >= max(self.compact_threshold, 4 * live):
+                self._compact()
+        except Exception as e:
+            logging.warning("Unable to write transfer journal: %s" % format_exception(e))
+
+    def _pruneHashes(self):
+        keep = set(self.uploader.transfer_state.keys())
+        if self.job:
+            keep.update(file_path for asset_group_num, groupdict, file_path in self.job["files"])
+        # the files just scanned, which become the next job
+        keep.update(file_path for assets in self.uploader.file_list.values()
+                    for asset_group_num, asset_mapping, groupdict, file_path in assets)
+        for file_path in [file_path for file_path in self.hashes.keys() if file_path not in keep]:
+            del self.hashes[file_path]
+
+    def _compact(self):
+        if not self.path:
+            return
+        self._pruneHashes()
+        self._close()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as tf:
+            tf.write(json.dumps({"op": "snapshot",
+                                 "state": self.uploader.transfer_state,
+                                 "job": self.job,
+                                 "done": list(self.done.keys()),
+                                 "hashes": self.hashes}) + "\n")
+            tf.flush()
+            os.fsync(tf.fileno())
+        os.replace(temp_path, self.path)
+        self.fh = open(self.path, "a", encoding="utf-8")
+        self.records = 0
+        self.last_sync = time.time()
+
+    def _close(self):
+        if self.fh is None:
+            return
+        try:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            self.fh.close()
+        except Exception as e:
+            logging.warning("Unable to close transfer journal: %s" % format_exception(e))
+        self.fh = None
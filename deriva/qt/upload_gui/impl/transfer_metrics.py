@@ -0,0 +1,218 @@
+import time
+import threading
+from collections import deque, OrderedDict
+from deriva.transfer.upload.deriva_upload import UploadState
+from deriva.qt.upload_gui.impl.archive_source import get_file_size
+
+# rates are averaged over this many trailing seconds, so that they follow changes in throughput without jittering
+DEFAULT_RATE_WINDOW = 10.0
+FINISHED_STATES = (UploadState.Success, UploadState.Failed, UploadState.Paused, UploadState.Aborted,
+                   UploadState.Cancelled, UploadState.Timeout)
+
+
+def format_bytes(value):
+    value = float(value or 0)
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if abs(value) < 1024.0 or unit == "TB":
+            return ("%d %s" if unit == "B" else "%.1f %s") % (value, unit)
+        value /= 1024.0
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(seconds)
+    return "%02d:%02d:%02d" % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+class RateWindow(object):
+
+    def __init__(self, window=DEFAULT_RATE_WINDOW):
+        self.window = window
+        self.samples = deque()
+
+    def add(self, timestamp, value):
+        # value is a running total; one sample older than the window is kept as the baseline for the oldest interval
+        self.samples.append((timestamp, value))
+        while len(self.samples) > 2 and self.samples[1][0] < timestamp - self.window:
+            self.samples.popleft()
+
+    def rate(self, now=None):
+        if len(self.samples) < 2:
+            return 0.0
+        first_time, first_value = self.samples[0]
+        last_time, last_value = self.samples[-1]
+        # an idle transfer decays towards zero rather than reporting the last rate forever
+        elapsed = max((now or time.time()) - first_time, last_time - first_time)
+        return (last_value - first_value) / elapsed if elapsed > 0 else 0.0
+
+
+# Collects transfer progress for an upload job: sliding-window byte rates for the job and for each file in flight,
+# files per second, and an ETA for the remaining bytes of the scanned files. The upload callbacks run on a worker
+# thread while the window reads the figures from the GUI thread, hence the lock.
+class TransferMetrics(object):
+
+    def __init__(self, window=DEFAULT_RATE_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+        self.cursor = 0
+        self.paths = list()
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.skipped_bytes = 0
+        self.deduplicated = set()
+        self.deduplicated_bytes = 0
+        self.file_bytes = dict()
+        self.file_started = dict()
+        self.file_rates = dict()
+        self.file_durations = list()
+        self.outcomes = dict()
+        self.succeeded = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+        self.peak_rate = 0.0
+        self.byte_rate = RateWindow(window)
+        self.file_rate = RateWindow(window)
+
+    def start(self, uploader):
+        with self.lock:
+            for group, assets in uploader.file_list.items():
+                for asset_group_num, asset_mapping, groupdict, file_path in assets:
+                    try:
+                        self.files[file_path] = get_file_size(file_path)
+                    except OSError:
+                        self.files[file_path] = 0
+            self.paths = list(self.files.keys())
+            self.total_bytes = sum(self.files.values())
+            self.started = time.time()
+            self.byte_rate.add(self.started, 0)
+            self.file_rate.add(self.started, 0)
+
+    def update(self, file_path, completed_bytes):
+        now = time.time()
+        with self.lock:
+            previous = self.file_bytes.get(file_path, 0)
+            completed_bytes = min(completed_bytes, self.files.get(file_path, completed_bytes))
+            if completed_bytes <= previous:
+                return
+            self.file_bytes[file_path] = completed_bytes
+            self.done_bytes += completed_bytes - previous
+            self.byte_rate.add(now, self.done_bytes)
+            self.file_started.setdefault(file_path, now)
+            rate = self.file_rates.get(file_path)
+            if rate is None:
+                rate = self.file_rates[file_path] = RateWindow(self.window)
+                rate.add(self.file_started[file_path], previous)
+            rate.add(now, completed_bytes)
+            self.peak_rate = max(self.peak_rate, self.byte_rate.rate(now))
+
+    def deduplicate(self, file_path):
+        # the file's content was uploaded earlier in the job; its bytes count as done, but not as transferred
+        with self.lock:
+            if file_path not in self.deduplicated:
+                self.deduplicated.add(file_path)
+                self.deduplicated_bytes += self.files.get(file_path, 0)
+
+    def updateStatus(self, file_status):
+        # called whenever the uploader reports a state change; files are uploaded in scan order, so only the file at
+        # the cursor (and any files finished without a callback, e.g. cancelled ones) need to be looked at
+        now = time.time()
+        with self.lock:
+            while self.cursor < len(self.paths):
+                file_path = self.paths[self.cursor]
+                state = file_status.get(file_path, {}).get("State")
+                if state == UploadState.Running:
+                    self.file_started.setdefault(file_path, now)
+                    break
+                if state not in FINISHED_STATES:
+                    break
+                self._finishFile(file_path, state == UploadState.Success, now)
+                self.cursor += 1
+
+    def _finishFile(self, file_path, success, now):
+        size = self.files.get(file_path, 0)
+        transferred = self.file_bytes.pop(file_path, 0)
+        started = self.file_started.pop(file_path, None)
+        self.file_rates.pop(file_path, None)
+        self.outcomes[file_path] = success
+        if success:
+            self.succeeded += 1
+            # whole-file (non-chunked) uploads and table loads report no progress, so they are accounted for here
+            self.done_bytes += size - transferred
+            if started is not None and file_path not in self.deduplicated:
+                self.file_durations.append((size, now - started))
+        else:
+            self.failed += 1
+            self.done_bytes -= transferred
+            self.skipped_bytes += size
+        self.byte_rate.add(now, self.done_bytes)
+        self.file_rate.add(now, self.succeeded + self.failed)
+        self.peak_rate = max(self.peak_rate, self.byte_rate.rate(now))
+
+    def reviseFile(self, file_path, file_status):
+        # a file already counted as succeeded fails afterwards when its batched catalog write fails; its bytes were
+        # transferred all the same, so only the file counts change
+        with self.lock:
+            if not self.outcomes.get(file_path):
+                return
+            if file_status.get(file_path, {}).get("State") in (UploadState.Failed, UploadState.Aborted):
+                self.outcomes[file_path] = False
+                self.succeeded -= 1
+                self.failed += 1
+
+    def finish(self):
+        with self.lock:
+            self.finished = time.time()
+
+    def fileProgress(self, file_path):
+        with self.lock:
+            size = self.files.get(file_path, 0)
+            completed = self.file_bytes.get(file_path, 0)
+            rate = self.file_rates.get(file_path)
+            return (round(completed / size * 100) if size else 0), (rate.rate() if rate else 0.0)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            rate = self.byte_rate.rate(now)
+            remaining = max(0, self.total_bytes - self.done_bytes - self.skipped_bytes)
+            return {"bytes_per_second": rate,
+                    "files_per_second": self.file_rate.rate(now),
+                    "bytes_transferred": self.done_bytes,
+                    "bytes_total": self.total_bytes,
+                    "files_finished": self.succeeded + self.failed,
+                    "files_total": len(self.files),
+                    "eta_seconds": (remaining / rate) if rate > 0 else (0 if not remaining else None)}
+
+    def summary(self):
+        with self.lock:
+            elapsed = ((self.finished or time.time()) - self.started) if self.started else 0
+            file_rates = sorted(size / duration for size, duration in self.file_durations if duration > 0)
+            transferred = self.done_bytes - self.deduplicated_bytes
+            return {"files_total": len(self.files),
+                    "files_succeeded": self.succeeded,
+                    "files_failed": self.failed,
+                    "files_not_attempted": len(self.files) - self.succeeded - self.failed,
+                    "bytes_total": self.total_bytes,
+                    "bytes_transferred": transferred,
+                    "files_deduplicated": len(self.deduplicated),
+                    "bytes_saved": self.deduplicated_bytes,
+                    "elapsed_seconds": round(elapsed, 3),
+                    "bytes_per_second": round(transferred / elapsed, 1) if elapsed else 0.0,
+                    "peak_bytes_per_second": round(self.peak_rate, 1),
+                    "files_per_second": round((self.succeeded + self.failed) / elapsed, 3) if elapsed else 0.0,
+                    "file_bytes_per_second_min": round(file_rates[0], 1) if file_rates else None,
+                    "file_bytes_per_second_median": round(file_rates[len(file_rates) // 2], 1) if file_rates else None}
+
+    def describe(self):
+        snapshot = self.snapshot()
+        text = "%s/s | %s of %s | %d of %d files" % (format_bytes(snapshot["bytes_per_second"]),
+                                                     format_bytes(snapshot["bytes_transferred"]),
+                                                     format_bytes(snapshot["bytes_total"]),
+                                                     snapshot["files_finished"],
+                                                     snapshot["files_total"])
+        if snapshot["files_per_second"] >= 0.1:
+            text += " (%.1f files/s)" % snapshot["files_per_second"]
+        return text + " | ETA %s" % format_duration(snapshot["eta_seconds"])
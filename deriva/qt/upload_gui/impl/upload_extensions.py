@@ -0,0 +1,25 @@
+from collections import namedtuple
+from deriva.qt.upload_gui.impl.transfer_journal import TransferJournal
+from deriva.qt.upload_gui.impl.chunked_transfer import ChunkedTransfer
+from deriva.qt.upload_gui.impl.upload_pipeline import UploadPipeline
+from deriva.qt.upload_gui.impl.catalog_batch import CatalogWriteBatcher
+from deriva.qt.upload_gui.impl.content_dedup import ContentDeduplicator
+from deriva.qt.upload_gui.impl.archive_source import ArchiveSource
+from deriva.qt.upload_gui.impl.upload_verifier import UploadVerifier
+
+UploadExtensions = namedtuple("UploadExtensions", ["transfer_journal", "chunked_transfer", "upload_pipeline",
+                                                   "catalog_batcher", "content_dedup", "archive_source",
+                                                   "upload_verifier"])
+
+
+def attach_upload_extensions(uploader, transfer_options=None):
+    # each extension replaces uploader methods on the instance and chains to the ones in place when it is attached, so
+    # the order matters: uploadFiles runs through the verifier, the archive source, the deduplicator and the batcher
+    # before it reaches the pipeline
+    return UploadExtensions(transfer_journal=TransferJournal.attach(uploader),
+                            chunked_transfer=ChunkedTransfer.attach(uploader, **(transfer_options or dict())),
+                            upload_pipeline=UploadPipeline.attach(uploader),
+                            catalog_batcher=CatalogWriteBatcher.attach(uploader),
+                            content_dedup=ContentDeduplicator.attach(uploader),
+                            archive_source=ArchiveSource.attach(uploader),
+                            upload_verifier=UploadVerifier.attach(uploader))
@@ -0,0 +1,86 @@
+import os
+import logging
+from collections import OrderedDict
+from deriva.qt.upload_gui.impl import archive_source
+
+# upload order policies
+UPLOAD_ORDER_SCAN = "scan"
+UPLOAD_ORDER_LARGEST = "largest"
+UPLOAD_ORDER_SMALLEST = "smallest"
+UPLOAD_ORDER_INTERLEAVED = "interleaved"
+UPLOAD_ORDER_LOCALITY = "locality"
+
+
+def get_file_stat(file_path):
+    try:
+        return archive_source.get_file_stat(file_path)
+    except OSError:
+        return None
+
+
+# The policies take the uploader's file list entries, (asset_group_num, asset_mapping, groupdict, file_path), and a
+# function returning the stat result of a path, or None if it cannot be read.
+def order_by_size(entries, stat=get_file_stat, reverse=False):
+    def size(entry):
+        st = stat(entry[3])
+        return st.st_size if st else 0
+    return sorted(entries, key=size, reverse=reverse)
+
+
+def order_largest_first(entries, stat=get_file_stat):
+    # the long transfers start early, so that the job does not end with a single large file still in flight
+    return order_by_size(entries, stat, reverse=True)
+
+
+def order_smallest_first(entries, stat=get_file_stat):
+    # the most files are done soonest, and their catalog records are available early
+    return order_by_size(entries, stat)
+
+
+def order_interleaved(entries, stat=get_file_stat):
+    # alternates large and small files, so that a small file can be hashed and registered while a large one transfers
+    entries = order_by_size(entries, stat, reverse=True)
+    result = list()
+    head, tail = 0, len(entries) - 1
+    while head <= tail:
+        result.append(entries[head])
+        if head != tail:
+            result.append(entries[tail])
+        head += 1
+        tail -= 1
+    return result
+
+
+def order_locality(entries, stat=get_file_stat):
+    # reads the files of a directory together and, within a directory, in inode order, which on most local file
+    # systems approximates their on-disk order and keeps seeks short on rotating disks. The files of an archive are read
+    # in their order in the archive.
+    def locality(entry):
+        file_path = entry[3]
+        st = stat(file_path)
+        archive, member = archive_source.split_member_path(file_path)
+        return (os.path.dirname(file_path) if member is None else archive, st.st_dev if st else 0,
+                st.st_ino if st else 0)
+    return sorted(entries, key=locality)
+
+
+UPLOAD_ORDER_POLICIES = OrderedDict([
+    (UPLOAD_ORDER_SCAN, ("As scanned", None)),
+    (UPLOAD_ORDER_LARGEST, ("Largest first", order_largest_first)),
+    (UPLOAD_ORDER_SMALLEST, ("Smallest first", order_smallest_first)),
+    (UPLOAD_ORDER_INTERLEAVED, ("Interleaved by size", order_interleaved)),
+    (UPLOAD_ORDER_LOCALITY, ("Directory and disk locality", order_locality)),
+])
+
+
+def order_file_list(uploader, policy=UPLOAD_ORDER_SCAN):
+    # files are only reordered within their asset group: the groups follow the declared order of the asset mappings,
+    # which configurations rely on (e.g. records that later files refer to)
+    label, order = UPLOAD_ORDER_POLICIES.get(policy, (None, None))
+    if label is None:
+        raise ValueError("Unknown upload order: %s" % policy)
+    if not order:
+        return
+    for group in list(uploader.file_list.keys()):
+        uploader.file_list[group] = order(uploader.file_list[group])
+    logging.debug("Upload order: %s" % label)
@@ -0,0 +1,359 @@
+import sys
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from deriva.core import format_exception, stob, HatracJobAborted, HatracJobPaused, HatracJobTimeout
+from deriva.transfer.upload.deriva_upload import UploadState, FileUploadState
+from deriva.transfer.upload.processors.base_processor import POST_PROCESSORS_KEY
+from deriva.qt.upload_gui.impl.catalog_batch import TABLE_ASSET_TYPES
+from deriva.qt.upload_gui.impl.file_hasher import FileHasher, DEFAULT_HASH_WORKERS
+from deriva.qt.upload_gui.impl.archive_source import get_stat_key
+
+# files hashed ahead of the one being transferred, and transferred files waiting for their catalog registration
+DEFAULT_HASH_QUEUE_SIZE = 2
+DEFAULT_REGISTER_QUEUE_SIZE = 8
+# seconds a stage waits on a queue before checking whether the job has been stopped
+DEFAULT_QUEUE_TIMEOUT = 1.0
+
+
+class RegistrationDeferred(Exception):
+    def __init__(self, metadata):
+        super(RegistrationDeferred, self).__init__("Catalog registration deferred")
+        self.metadata = metadata
+
+
+# Runs an upload job as three stages connected by bounded queues, instead of taking each file through checksum,
+# transfer and catalog registration before starting on the next one: while file N is transferred, file N+1 is hashed
+# and file N-1 is registered in the catalog. The hash stage computes the checksums of several files at once on a
+# FileHasher's worker processes, and hands the files to the transfer stage in their upload order. The transfer stage
+# runs the uploader's own per-file code; when it gets to the catalog record of an asset file, the file's metadata is
+# handed to the registration stage, which completes the record (and any update of it) on its own thread. Files whose
+# record is needed before the transfer ("create_record_before_upload") or that have post-processors are processed
+# entirely by the transfer stage, as before. The uploader keeps the metadata of the file being processed on the
+# instance, so the two stages take turns on it under a lock that the transfer stage only gives up for the duration of
+# the byte transfer. The per-file overrides are only installed on the uploader for the duration of a job. Busy and
+# waiting time of each stage are logged at the end of the job, to show which stage is the bottleneck.
+class UploadPipeline(object):
+
+    def __init__(self,
+                 uploader,
+                 hash_queue_size=DEFAULT_HASH_QUEUE_SIZE,
+                 register_queue_size=DEFAULT_REGISTER_QUEUE_SIZE,
+                 hash_workers=DEFAULT_HASH_WORKERS):
+        self.uploader = uploader
+        self.hash_queue_size = hash_queue_size
+        self.register_queue_size = register_queue_size
+        self.hasher = FileHasher(hash_workers)
+        self.lock = threading.Lock()
+        self.callback_lock = threading.Lock()
+        self.local = threading.local()
+        self.stopped = threading.Event()
+        self.hashes = dict()
+        self.busy = dict()
+        self.waiting = dict()
+
+    @classmethod
+    def attach(cls, uploader, **kwargs):
+        pipeline = cls(uploader, **kwargs)
+        uploader.uploadFiles = pipeline.uploadFiles
+        return pipeline
+
+    @contextmanager
+    def attached(self):
+        uploader = self.uploader
+        overrides = {"getFileHashes": self.getFileHashes,
+                     "_uploadAsset": self.uploadAsset,
+                     "_getFileRecord": self.getFileRecord,
+                     "_hatracUpload": self.hatracUpload}
+        # the methods replaced here may already be replaced on the instance (e.g. by the transfer journal)
+        saved = dict((name, uploader.__dict__.get(name)) for name in overrides.keys())
+        self.previous = dict((name, getattr(uploader, name)) for name in overrides.keys())
+        for name, method in overrides.items():
+            setattr(uploader, name, method)
+        try:
+            yield self
+        finally:
+            for name, method in saved.items():
+                if method is None:
+                    delattr(uploader, name)
+                else:
+                    setattr(uploader, name, method)
+            self.hashes.clear()
+
+    def isDeferrable(self, asset_mapping):
+        return not (stob(asset_mapping.get("create_record_before_upload", False)) or
+                    asset_mapping.get(POST_PROCESSORS_KEY))
+
+    def measure(self, counters, stage, start):
+        counters[stage] = counters.get(stage, 0.0) + time.time() - start
+
+    def put(self, item_queue, item):
+        # returns False, with the item dropped, if the queue stays full once the job has been stopped because a stage
+        # has failed
+        while True:
+            try:
+                item_queue.put(item, timeout=DEFAULT_QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                if self.stopped.is_set():
+                    return False
+
+    def get(self, item_queue):
+        # returns None, as at the end of the queue, if the queue is empty once the job has been stopped because a stage
+        # has failed; what is already queued is still processed
+        while True:
+            try:
+                return item_queue.get(timeout=DEFAULT_QUEUE_TIMEOUT)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    return None
+
+    def runStage(self, stage, errors):
+        # a stage that fails stops the others, rather than leaving them waiting on its queue
+        try:
+            stage()
+        except Exception as e:
+            logging.error("Upload pipeline stage [%s] failed: %s" % (threading.current_thread().name,
+                                                                     format_exception(e)))
+            errors.append(e)
+            self.stopped.set()
+
+    def getFileHashes(self, file_path, hashes=frozenset(['md5'])):
+        result = self.hashes.pop(file_path, None)
+        if result and set(hashes).issubset(result.keys()):
+            return result
+        return self.previous["getFileHashes"](file_path, hashes)
+
+    def uploadAsset(self, file_path, asset_mapping, match_groupdict, callback=None):
+        if getattr(self.local, "registering", False):
+            return self.registerAsset(file_path, asset_mapping, match_groupdict)
+        return self.previous["_uploadAsset"](file_path, asset_mapping, match_groupdict, callback)
+
+    def getFileRecord(self, asset_mapping):
+        # reached by the transfer stage once the object has been transferred: the rest is left to the registration stage
+        if getattr(self.local, "transferring", False) and self.isDeferrable(asset_mapping):
+            raise RegistrationDeferred(dict(self.uploader.metadata))
+        return self.previous["_getFileRecord"](asset_mapping)
+
+    def hatracUpload(self, *args, **kwargs):
+        # the byte transfer does not touch the file metadata, so the registration stage can have it in the meantime
+        self.lock.release()
+        try:
+            return self.previous["_hatracUpload"](*args, **kwargs)
+        finally:
+            self.lock.acquire()
+
+    def registerAsset(self, file_path, asset_mapping, match_groupdict):
+        # steps 7 to 9 of DerivaUpload._uploadAsset
+        uploader = self.uploader
+        logging.debug("Registering file [%s] in the catalog" % file_path)
+        record = uploader._getFileRecord(asset_mapping)
+        column_map = asset_mapping.get("column_map", {})
+        updated_record = uploader.interpolateDict(uploader.metadata, column_map)
+        if updated_record != record:
+            logging.info("Updating catalog for file [%s]" % uploader.getFileDisplayName(file_path))
+            uploader._catalogRecordUpdate(uploader.metadata['target_table'], record, updated_record)
+        uploader._execute_processors(file_path, asset_mapping, match_groupdict, processor_list=POST_PROCESSORS_KEY)
+
+    def uploadFiles(self, status_callback=None, file_callback=None):
+        uploader = self.uploader
+        self.busy.clear()
+        self.waiting.clear()
+        hash_queue = queue.Queue(self.hash_queue_size)
+        register_queue = queue.Queue(self.register_queue_size)
+        self.stopped.clear()
+        errors = list()
+
+        def _status_callback(**kwargs):
+            # the transfer and registration stages, and the hasher, all report status changes
+            if status_callback:
+                with self.callback_lock:
+                    status_callback(**kwargs)
+
+        def hash_stage():
+            # as many files are being hashed as there are hash workers; the oldest is passed on when it is done. Files
+            # whose checksums are in the transfer journal's cache (e.g. of a resumed job) are not hashed again, and the
+            # checksums computed here are added to it.
+            pending = deque()
+            get_cached_hashes = getattr(uploader, "getCachedFileHashes", None)
+            set_cached_hashes = getattr(uploader, "setCachedFileHashes", None)
+
+            def pass_on():
+                entry, future, key = pending.popleft()
+                file_path = entry[3]
+                start = time.time()
+                if future is not None:
+                    try:
+                        self.hashes[file_path] = future.result()[0]
+                        if set_cached_hashes:
+                            set_cached_hashes(file_path, self.hashes[file_path], key)
+                    except Exception as e:
+                        # the transfer stage hashes the file again, and reports the error
+                        logging.debug("Unable to hash file [%s] ahead of transfer: %s" %
+                                      (file_path, format_exception(e)))
+                    self.measure(self.busy, "hash", start)
+                    start = time.time()
+                passed = self.put(hash_queue, entry)
+                self.measure(self.waiting, "hash", start)
+                return passed
+
+            for assets in list(uploader.file_list.values()):
+                for entry in assets:
+                    if self.stopped.is_set():
+                        return
+                    asset_group_num, asset_mapping, groupdict, file_path = entry
+                    future = key = None
+                    if not uploader.cancelled and asset_mapping.get("asset_type", "file") not in TABLE_ASSET_TYPES:
+                        start = time.time()
+                        hashes = asset_mapping.get('checksum_types', ['md5', 'sha256'])
+                        cached = get_cached_hashes(file_path, hashes) if get_cached_hashes else None
+                        if cached:
+                            self.hashes[file_path] = cached
+                        else:
+                            # taken before the file is hashed, so that a file changed meanwhile is not cached
+                            key = get_stat_key(file_path)
+                            future = self.hasher.submit(file_path, hashes)
+                        self.measure(self.busy, "hash", start)
+                    pending.append((entry, future, key))
+                    if len(pending) >= self.hasher.workers and not pass_on():
+                        return
+            while pending:
+                if not pass_on():
+                    return
+            self.put(hash_queue, None)
+
+        def register_stage():
+            self.local.registering = True
+            while True:
+                start = time.time()
+                item = self.get(register_queue)
+                self.measure(self.waiting, "register", start)
+                if item is None:
+                    break
+                file_path, asset_mapping, groupdict, metadata = item
+                start = time.time()
+                with self.lock:
+                    saved = uploader.metadata
+                    uploader.metadata = metadata
+                    try:
+                        uploader.uploadFile(file_path, asset_mapping, groupdict)
+                        uploader.file_status[file_path] = FileUploadState(UploadState.Success, "Complete")._asdict()
+                    except:
+                        (etype, value, traceback) = sys.exc_info()
+                        uploader.file_status[file_path] = \
+                            FileUploadState(UploadState.Failed, format_exception(value))._asdict()
+                    finally:
+                        uploader.metadata = saved
+                self.measure(self.busy, "register", start)
+                self.finishFile(file_path, _status_callback)
+
+        started = time.time()
+        self.hasher.start(_status_callback)
+        with self.attached():
+            threads = [threading.Thread(target=self.runStage, args=(hash_stage, errors), name="upload-hash"),
+                       threading.Thread(target=self.runStage, args=(register_stage, errors), name="upload-register")]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            try:
+                self.transferStage(hash_queue, register_queue, _status_callback, file_callback)
+            except:
+                self.stopped.set()
+                raise
+            finally:
+                self.put(register_queue, None)
+                for thread in threads:
+                    thread.join()
+                self.hasher.stop()
+        self.logUtilization(time.time() - started)
+        if errors:
+            raise errors[0]
+
+        failed_uploads = dict()
+        for key, value in uploader.file_status.items():
+            if (value["State"] == UploadState.Failed) or (value["State"] == UploadState.Timeout):
+                failed_uploads[key] = value["Status"]
+
+        if uploader.skipped_files:
+            logging.warning("The following file(s) were skipped because they did not satisfy the matching criteria "
+                            "of the configuration:\n\n%s\n" % '\n'.join(sorted(uploader.skipped_files)))
+
+        if failed_uploads:
+            logging.warning("The following file(s) failed to upload due to errors:\n\n%s\n" %
+                            '\n'.join(["%s -- %s" % (key, failed_uploads[key])
+                                       for key in sorted(failed_uploads.keys())]))
+            raise RuntimeError("One or more file(s) failed to upload due to errors.")
+
+    def transferStage(self, hash_queue, register_queue, status_callback, file_callback):
+        # the same per-file handling as DerivaUpload.uploadFiles, except for files handed to the registration stage
+        uploader = self.uploader
+        self.local.transferring = True
+        try:
+            while True:
+                start = time.time()
+                entry = self.get(hash_queue)
+                self.measure(self.waiting, "transfer", start)
+                if entry is None:
+                    break
+                asset_group_num, asset_mapping, groupdict, file_path = entry
+                if uploader.cancelled:
+                    uploader.file_status[file_path] = \
+                        FileUploadState(UploadState.Cancelled, "Cancelled by user")._asdict()
+                    continue
+                start = time.time()
+                try:
+                    uploader.file_status[file_path] = FileUploadState(UploadState.Running, "In-progress")._asdict()
+                    status_callback()
+                    with self.lock:
+                        uploader.uploadFile(file_path, asset_mapping, groupdict, file_callback)
+                    uploader.file_status[file_path] = FileUploadState(UploadState.Success, "Complete")._asdict()
+                except RegistrationDeferred as deferred:
+                    self.measure(self.busy, "transfer", start)
+                    uploader.file_status[file_path] = FileUploadState(UploadState.Running, "Registering")._asdict()
+                    status_callback()
+                    start = time.time()
+                    self.put(register_queue, (file_path, asset_mapping, groupdict, deferred.metadata))
+                    self.measure(self.waiting, "transfer", start)
+                    continue
+                except HatracJobPaused:
+                    status = uploader.getTransferStateStatus(file_path)
+                    if status:
+                        uploader.file_status[file_path] = FileUploadState(
+                            UploadState.Paused, "Paused: %s" % status)._asdict()
+                    self.measure(self.busy, "transfer", start)
+                    continue
+                except HatracJobTimeout:
+                    status = uploader.getTransferStateStatus(file_path)
+                    if status:
+                        uploader.file_status[file_path] = FileUploadState(UploadState.Timeout, "Timeout")._asdict()
+                    self.measure(self.busy, "transfer", start)
+                    continue
+                except HatracJobAborted:
+                    uploader.file_status[file_path] = FileUploadState(UploadState.Aborted, "Aborted by user")._asdict()
+                except:
+                    (etype, value, traceback) = sys.exc_info()
+                    uploader.file_status[file_path] = \
+                        FileUploadState(UploadState.Failed, format_exception(value))._asdict()
+                self.measure(self.busy, "transfer", start)
+                self.finishFile(file_path, status_callback)
+        finally:
+            self.local.transferring = False
+
+    def finishFile(self, file_path, status_callback):
+        # a failure here must not take the stage down with it, as the other stages would be left waiting on it
+        try:
+            self.uploader.delTransferState(file_path)
+            status_callback()
+        except Exception as e:
+            logging.error("Unable to complete processing of file [%s]: %s" % (file_path, format_exception(e)))
+
+    def logUtilization(self, elapsed):
+        if elapsed <= 0:
+            return
+        logging.info("Upload pipeline stage utilization over %.1fs: %s" % (elapsed, ", ".join(
+            ["%s %.0f%% busy (%.1fs waiting)" % (stage, 100.0 * self.busy.get(stage, 0.0) / elapsed,
+                                                 self.waiting.get(stage, 0.0))
+             for stage in ("hash", "transfer", "register")])))
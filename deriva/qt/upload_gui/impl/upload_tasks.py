@@ -2,6 +2,8 @@ from PyQt5.QtCore import pyqtSignal
 from deriva.core import format_exception
 from deriva.transfer import DerivaUpload
 from deriva.qt import async_execute, AsyncTask
+from deriva.qt.upload_gui.impl.preflight import UploadPreflight, UPLOAD_MODE_ALL
+from deriva.qt.upload_gui.impl.upload_order import UPLOAD_ORDER_SCAN
 
 
 class UploadTask(AsyncTask):
@@ -77,10 +79,10 @@ class ScanDirectoryTask(UploadTask):
             return
         self.status_update_signal.emit(False, "Directory scan failed", format_exception(error), None)
 
-    def scan(self, path):
+    def scan(self, path, purge_state=False):
         self.init_request()
         self.request = async_execute(self.uploader.scanDirectory,
-                                     [path],
+                                     [path, False, purge_state],
                                      self.rid,
                                      self.success_callback,
                                      self.error_callback)
@@ -110,3 +112,105 @@ class UploadFilesTask(UploadTask):
                                      self.rid,
                                      self.success_callback,
                                      self.error_callback)
+
+
+class ResumeCheckTask(UploadTask):
+    status_update_signal = pyqtSignal(bool, str, str, object)
+
+    def __init__(self, parent=None):
+        super(ResumeCheckTask, self).__init__(parent)
+
+    def success_callback(self, rid, result):
+        if rid != self.rid:
+            return
+        self.status_update_signal.emit(True, "Unfinished upload check success", "", result)
+
+    def error_callback(self, rid, error):
+        if rid != self.rid:
+            return
+        self.status_update_signal.emit(False, "Unfinished upload check failed", format_exception(error), None)
+
+    def check(self, journal, path):
+        self.init_request()
+        self.request = async_execute(journal.checkJob,
+                                     [path],
+                                     self.rid,
+                                     self.success_callback,
+                                     self.error_callback)
+
+
+class ResumeJobTask(UploadTask):
+    status_update_signal = pyqtSignal(bool, str, str, object)
+
+    def __init__(self, parent=None):
+        super(ResumeJobTask, self).__init__(parent)
+
+    def success_callback(self, rid, result):
+        if rid != self.rid:
+            return
+        self.status_update_signal.emit(True, "Upload resume success", "", None)
+
+    def error_callback(self, rid, error):
+        if rid != self.rid:
+            return
+        self.status_update_signal.emit(False, "Upload resume failed", format_exception(error), None)
+
+    def resume(self, journal, path, expired=None):
+        self.init_request()
+        self.request = async_execute(journal.resumeJob,
+                                     [path, expired],
+                                     self.rid,
+                                     self.success_callback,
+                                     self.error_callback)
+
+
+class PreflightTask(UploadTask):
+    status_update_signal = pyqtSignal(bool, str, str, object)
+
+    def __init__(self, parent=None):
+        super(PreflightTask, self).__init__(parent)
+
+    def success_callback(self, rid, result):
+        if rid != self.rid:
+            return
+        self.status_update_signal.emit(True, "Pre-flight check success", "", result)
+
+    def error_callback(self, rid, error):
+        if rid != self.rid:
+            return
+        self.status_update_signal.emit(False, "Pre-flight check failed", format_exception(error), None)
+
+    def preflight(self, mode=UPLOAD_MODE_ALL, order=UPLOAD_ORDER_SCAN):
+        self.init_request()
+        self.request = async_execute(UploadPreflight(self.uploader).run,
+                                     [mode, order],
+                                     self.rid,
+                                     self.success_callback,
+                                     self.error_callback)
+
+
+class VerifyUploadsTask(UploadTask):
+    status_update_signal = pyqtSignal(bool, str, str, object)
+
+    def __init__(self, parent=None):
+        super(VerifyUploadsTask, self).__init__(parent)
+
+    def success_callback(self, rid, result):
+        if rid != self.rid:
+            return
+        self.status_update_signal.emit(True, "Verification complete", "", result)
+
+    def error_callback(self, rid, error):
+        if rid != self.rid:
+            return
+        self.status_update_signal.emit(False, "Verification failed", format_exception(error), None)
+
+    def verify(self, verifier, uploads, callback=None, thread_pool=None):
+        # runs on its own thread pool, if given, so that it does not hold up the tasks of the next upload job
+        self.init_request()
+        self.request = async_execute(verifier.verify,
+                                     [uploads, callback],
+                                     self.rid,
+                                     self.success_callback,
+                                     self.error_callback,
+                                     thread_pool)
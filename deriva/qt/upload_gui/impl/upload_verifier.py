@@ -0,0 +1,142 @@
+import time
+import logging
+import threading
+import concurrent.futures
+from collections import OrderedDict
+from requests import HTTPError
+from deriva.core import format_exception
+from deriva.transfer.upload.deriva_upload import UploadState
+from deriva.qt.upload_gui.impl.archive_source import get_file_stat
+from deriva.qt.upload_gui.impl.file_hasher import hash_file
+
+DEFAULT_VERIFY_MAX_THREADS = 8
+# outcomes of the verification of a file
+VERIFY_OK = "verified"
+VERIFY_MISMATCH = "mismatch"
+VERIFY_UNVERIFIED = "unverified"
+
+
+# Checks, after an upload job, that the objects on the server match the local files. The object store URI, size and
+# checksums of every file uploaded by the job are recorded as it is uploaded, with the size and modification time of the
+# file at the time. Verification then asks the server for the size and checksums of all the objects at once, with
+# concurrent HEAD requests, and compares them with the recorded checksums; only files whose size or modification time
+# has changed since they were uploaded are hashed again. It takes no lock on the uploader, so it can run in the
+# background while the next job is scanned and uploaded.
+class UploadVerifier(object):
+
+    def __init__(self, uploader, max_threads=DEFAULT_VERIFY_MAX_THREADS):
+        self.uploader = uploader
+        self.max_threads = max_threads
+        self.lock = threading.Lock()
+        self.uploads = OrderedDict()
+        self.cancelled = False
+
+    @classmethod
+    def attach(cls, uploader, **kwargs):
+        verifier = cls(uploader, **kwargs)
+        verifier.upload_files = uploader.uploadFiles
+        verifier.hatrac_upload = uploader._hatracUpload
+        uploader.uploadFiles = verifier.uploadFiles
+        uploader._hatracUpload = verifier.hatracUpload
+        return verifier
+
+    def uploadFiles(self, status_callback=None, file_callback=None):
+        with self.lock:
+            self.uploads.clear()
+        return self.upload_files(status_callback, file_callback)
+
+    def hatracUpload(self, uri, file_path, md5=None, sha256=None, content_type=None, content_disposition=None,
+                     chunked=True, create_parents=True, allow_versioning=True, callback=None):
+        try:
+            st = get_file_stat(file_path)
+        except OSError:
+            st = None
+        versioned_uri = self.hatrac_upload(uri, file_path, md5=md5, sha256=sha256, content_type=content_type,
+                                           content_disposition=content_disposition, chunked=chunked,
+                                           create_parents=create_parents, allow_versioning=allow_versioning,
+                                           callback=callback)
+        if versioned_uri and st is not None and (md5 or sha256):
+            with self.lock:
+                self.uploads[file_path] = {"uri": versioned_uri,
+                                           "stat": [st.st_size, st.st_mtime_ns],
+                                           "md5": md5,
+                                           "sha256": sha256}
+        return versioned_uri
+
+    def takeUploads(self):
+        # the files of the last job that were uploaded successfully, to be verified
+        with self.lock:
+            uploads = OrderedDict((file_path, upload) for file_path, upload in self.uploads.items()
+                                  if self.uploader.file_status.get(file_path, {}).get("State") == UploadState.Success)
+            self.uploads = OrderedDict()
+        return uploads
+
+    def cancel(self):
+        self.cancelled = True
+
+    def verify(self, uploads, callback=None):
+        # returns {file_path: (outcome, message)}, calling callback(file_path=, outcome=, message=) as each file is done
+        self.cancelled = False
+        start = time.time()
+        results = OrderedDict()
+        rehashed = list()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.max_threads, len(uploads)))) as executor:
+            futures = dict((executor.submit(self.verifyFile, file_path, upload, rehashed), file_path)
+                           for file_path, upload in uploads.items())
+            for future in concurrent.futures.as_completed(futures):
+                file_path = futures[future]
+                try:
+                    outcome, message = future.result()
+                except Exception as e:
+                    outcome, message = VERIFY_UNVERIFIED, "Unable to verify: %s" % format_exception(e)
+                if outcome == VERIFY_MISMATCH:
+                    logging.warning("Verification failed for file [%s]: %s" % (file_path, message))
+                elif outcome == VERIFY_UNVERIFIED:
+                    logging.debug("File [%s] not verified: %s" % (file_path, message))
+                results[file_path] = (outcome, message)
+                if callback:
+                    callback(file_path=file_path, outcome=outcome, message=message)
+        outcomes = [outcome for outcome, message in results.values()]
+        logging.info("Verification: %d file(s) match the server, %d do not, %d could not be verified; %d re-hashed, "
+                     "in %.1fs" % (outcomes.count(VERIFY_OK), outcomes.count(VERIFY_MISMATCH),
+                                   outcomes.count(VERIFY_UNVERIFIED), len(rehashed), time.time() - start))
+        return results
+
+    def verifyFile(self, file_path, upload, rehashed):
+        if self.cancelled:
+            return VERIFY_UNVERIFIED, "Verification cancelled"
+        try:
+            r = self.uploader.store.head(upload["uri"])
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return VERIFY_MISMATCH, "Object not found on server: %s" % upload["uri"]
+            raise
+        remote_size = r.headers.get("Content-Length")
+        remote = {"md5": r.headers.get("Content-MD5"), "sha256": r.headers.get("Content-SHA256")}
+
+        # the checksums recorded at upload time stand for the local file as long as it has not changed since
+        local = {"md5": upload["md5"], "sha256": upload["sha256"]}
+        local_size = upload["stat"][0]
+        changed = ""
+        try:
+            st = get_file_stat(file_path)
+        except OSError:
+            st = None
+        if st is not None and [st.st_size, st.st_mtime_ns] != upload["stat"]:
+            hashes = [alg for alg in ("md5", "sha256") if remote.get(alg)] or ["md5"]
+            result = hash_file(file_path, hashes)[0]
+            local = dict((alg, value[1]) for alg, value in result.items())
+            local_size = st.st_size
+            changed = " (the local file has changed since it was uploaded)"
+            rehashed.append(file_path)
+
+        if remote_size is not None and int(remote_size) != local_size:
+            return VERIFY_MISMATCH, "Size on server (%s) differs from local file (%d)%s" % (remote_size, local_size,
+                                                                                         changed)
+        compared = [alg for alg in ("sha256", "md5") if remote.get(alg) and local.get(alg)]
+        for alg in compared:
+            if remote[alg] != local[alg]:
+                return VERIFY_MISMATCH, "%s checksum on server differs from local file%s" % (alg.upper(), changed)
+        if not compared:
+            return VERIFY_UNVERIFIED, "Server did not report a checksum for %s" % upload["uri"]
+        return VERIFY_OK, "Verified (%s)" % ", ".join(alg.upper() for alg in compared)
@@ -7,6 +7,8 @@ from PyQt5.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit
 from deriva.core import stob
 from deriva.transfer import GenericUploader
 from deriva.qt import JSONEditor
+from deriva.qt.upload_gui.impl.preflight import UPLOAD_MODE_ALL, UPLOAD_MODE_FILES, UPLOAD_MODE_DATA
+from deriva.qt.upload_gui.impl.upload_order import UPLOAD_ORDER_POLICIES
 
 
 def warningMessageBox(parent, text, detail):
@@ -88,12 +90,21 @@ class OptionsDialog(QDialog):
         self.uploadGroupBox = QGroupBox("Upload:", self)
         self.uploadLayout = QHBoxLayout()
         self.uploadAllButton = QRadioButton("Files and Data")
-        self.uploadAllButton.setChecked(True)
+        self.uploadAllButton.setChecked(parent.upload_mode == UPLOAD_MODE_ALL)
         self.uploadLayout.addWidget(self.uploadAllButton)
         self.uploadFilesButton = QRadioButton("Files only")
+        self.uploadFilesButton.setChecked(parent.upload_mode == UPLOAD_MODE_FILES)
         self.uploadLayout.addWidget(self.uploadFilesButton)
         self.uploadDataButton = QRadioButton("Data only")
+        self.uploadDataButton.setChecked(parent.upload_mode == UPLOAD_MODE_DATA)
         self.uploadLayout.addWidget(self.uploadDataButton)
+        self.uploadOrderLabel = QLabel("Order:")
+        self.uploadLayout.addWidget(self.uploadOrderLabel)
+        self.uploadOrderComboBox = QComboBox()
+        for policy, (label, order) in UPLOAD_ORDER_POLICIES.items():
+            self.uploadOrderComboBox.addItem(label, policy)
+        self.uploadOrderComboBox.setCurrentIndex(max(self.uploadOrderComboBox.findData(parent.upload_order), 0))
+        self.uploadLayout.addWidget(self.uploadOrderComboBox)
         self.uploadGroupBox.setLayout(self.uploadLayout)
         layout.addWidget(self.uploadGroupBox)
 
@@ -103,6 +114,11 @@ class OptionsDialog(QDialog):
         self.debugCheckBox = QCheckBox("Debug logging")
         self.debugCheckBox.setChecked(True if logging.getLogger().getEffectiveLevel() == logging.DEBUG else False)
         self.miscLayout.addWidget(self.debugCheckBox)
+        self.verifyCheckBox = QCheckBox("Verify uploads against the server")
+        self.verifyCheckBox.setToolTip("After each upload, check the size and checksums of the uploaded objects in the "
+                                       "background, and mark the files that do not match")
+        self.verifyCheckBox.setChecked(parent.verify_uploads)
+        self.miscLayout.addWidget(self.verifyCheckBox)
         self.miscGroupBox.setLayout(self.miscLayout)
         layout.addWidget(self.miscGroupBox)
 
@@ -238,6 +254,13 @@ class OptionsDialog(QDialog):
             servers.append(self.serverComboBox.itemData(x, Qt.UserRole))
         return servers
 
+    def getUploadMode(self):
+        if self.uploadFilesButton.isChecked():
+            return UPLOAD_MODE_FILES
+        elif self.uploadDataButton.isChecked():
+            return UPLOAD_MODE_DATA
+        return UPLOAD_MODE_ALL
+
     @staticmethod
     def getOptions(parent):
         uploader = parent.uploader
@@ -246,6 +269,9 @@ class OptionsDialog(QDialog):
         if QDialog.Accepted == ret:
             debug = dialog.debugCheckBox.isChecked()
             logging.getLogger().setLevel(logging.DEBUG if debug else logging.INFO)
+            parent.upload_mode = dialog.getUploadMode()
+            parent.upload_order = dialog.uploadOrderComboBox.currentData()
+            parent.verify_uploads = dialog.verifyCheckBox.isChecked()
             setServers = getattr(uploader, "setServers", None)
             if callable(setServers):
                 setServers(dialog.getServers())
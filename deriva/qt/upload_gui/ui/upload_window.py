@@ -1,15 +1,24 @@
+import json
 import logging
 import os
 import urllib.parse
 import webbrowser
 
-from PyQt5.QtCore import Qt, QMetaObject, QThreadPool, pyqtSlot, pyqtSignal
+from PyQt5.QtCore import Qt, QMetaObject, QThreadPool, QTimer, pyqtSlot, pyqtSignal
 from PyQt5.QtWidgets import qApp, QMainWindow, QWidget, QAction, QSizePolicy, QPushButton, QStyle, QSplitter, QLabel, \
     QToolBar, QStatusBar, QVBoxLayout, QHBoxLayout, QTableWidgetItem, QAbstractItemView, QLineEdit, QFileDialog, \
     QMessageBox
-from deriva.core import write_config, stob
-from deriva.qt import EmbeddedAuthWindow, QPlainTextEditLogger, TableWidget, Request
+from deriva.core import write_config, stob, DEFAULT_CHUNK_SIZE
+from deriva.transfer.upload.deriva_upload import UploadState, FileUploadState
+from deriva.qt import EmbeddedAuthWindow, QPlainTextEditLogger, TableWidget, Request, SessionPool
 from deriva.qt.upload_gui.impl.upload_tasks import *
+from deriva.qt.upload_gui.impl.transfer_metrics import TransferMetrics, format_bytes
+from deriva.qt.upload_gui.impl.transfer_journal import read_job_index
+from deriva.qt.upload_gui.impl.archive_source import is_archive, ZIP_EXTENSIONS, TAR_EXTENSIONS
+from deriva.qt.upload_gui.impl.upload_verifier import VERIFY_MISMATCH
+from deriva.qt.upload_gui.impl.preflight import UPLOAD_MODE_ALL
+from deriva.qt.upload_gui.impl.upload_order import UPLOAD_ORDER_SCAN
+from deriva.qt.upload_gui.impl.upload_extensions import attach_upload_extensions
 from deriva.qt.upload_gui.ui.options_window import OptionsDialog
 from deriva.qt.upload_gui.resources import resources
 
@@ -24,6 +33,12 @@ class UploadWindow(QMainWindow):
     current_path = None
     uploading = False
     save_progress_on_cancel = False
+    metrics = None
+    resume_checked = False
+    resuming = False
+    upload_mode = UPLOAD_MODE_ALL
+    upload_order = UPLOAD_ORDER_SCAN
+    verify_uploads = False
     progress_update_signal = pyqtSignal(str)
 
     def __init__(self,
@@ -32,17 +47,25 @@ class UploadWindow(QMainWindow):
                  credential_file=None,
                  hostname=None,
                  window_title=None,
-                 cookie_persistence=True):
+                 cookie_persistence=True,
+                 transfer_options=None):
         super(UploadWindow, self).__init__()
         qApp.aboutToQuit.connect(self.quitEvent)
 
         self.ui = UploadWindowUI(self)
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.setInterval(1000)
+        self.metrics_timer.timeout.connect(self.updateMetrics)
+        # verification runs on a thread of its own, so that the next job does not wait for it
+        self.verify_thread_pool = QThreadPool(self)
+        self.verify_thread_pool.setMaxThreadCount(1)
         self.ui.title = window_title if window_title else "Deriva Upload Utility %s" % uploader.getVersion()
         self.setWindowTitle(self.ui.title)
 
         self.config_file = config_file
         self.credential_file = credential_file
         self.cookie_persistence = cookie_persistence
+        self.transfer_options = transfer_options if transfer_options else dict()
 
         self.show()
         qApp.setOverrideCursor(Qt.WaitCursor)
@@ -68,6 +91,9 @@ class UploadWindow(QMainWindow):
         if self.uploader:
             del self.uploader
         self.uploader = uploader(self.config_file, self.credential_file, server)
+        extensions = attach_upload_extensions(self.uploader, self.transfer_options)
+        self.transfer_journal = extensions.transfer_journal
+        self.upload_verifier = extensions.upload_verifier
         if not self.uploader.server:
             if not self.checkValidServer():
                 return
@@ -103,8 +129,22 @@ class UploadWindow(QMainWindow):
     def onLoginSuccess(self, **kwargs):
         self.auth_window.hide()
         self.uploader.setCredentials(kwargs["credential"])
+        self.adoptPooledSessions()
         self.getSession()
 
+    def adoptPooledSessions(self):
+        # reuse the connections already opened (and warmed up) by the auth widget for this host; a server with its own
+        # session config gets a pooled session of its own, built from that config, whose connections are warmed up here
+        server_url = getattr(self.uploader, "server_url", None)
+        if not server_url:
+            return
+        session_config = (self.uploader.server or {}).get("session")
+        for binding in (self.uploader.catalog, self.uploader.store):
+            if binding is not None:
+                SessionPool.adopt(binding, server_url, session_config)
+        if session_config and SessionPool.getConfig(session_config) != SessionPool.getConfig():
+            SessionPool.warmup(server_url, session_config=session_config)
+
     def enableControls(self):
         self.ui.actionUpload.setEnabled(self.canUpload())
         self.ui.actionRescan.setEnabled(self.current_path is not None and self.auth_window.authenticated())
@@ -114,6 +154,7 @@ class UploadWindow(QMainWindow):
         self.ui.actionLogout.setEnabled(self.auth_window.authenticated())
         self.ui.actionExit.setEnabled(True)
         self.ui.browseButton.setEnabled(True)
+        self.ui.archiveButton.setEnabled(True)
 
     def disableControls(self):
         self.ui.actionUpload.setEnabled(False)
@@ -123,11 +164,14 @@ class UploadWindow(QMainWindow):
         self.ui.actionLogout.setEnabled(False)
         self.ui.actionExit.setEnabled(False)
         self.ui.browseButton.setEnabled(False)
+        self.ui.archiveButton.setEnabled(False)
 
     def closeEvent(self, event=None):
         self.disableControls()
         if self.uploading:
             self.cancelTasks(self.cancelConfirmation())
+        self.upload_verifier.cancel()
+        self.verify_thread_pool.waitForDone()
         if event:
             event.accept()
 
@@ -156,6 +200,7 @@ class UploadWindow(QMainWindow):
         if not self.checkValidServer():
             return
         self.setWindowTitle("%s (%s)" % (self.ui.title, self.uploader.server["host"]))
+        self.resume_checked = False
         self.getNewAuthWindow()
         self.getSession()
 
@@ -182,10 +227,20 @@ class UploadWindow(QMainWindow):
         file_name = os.path.basename(file_path) if file_path else ""
         job_info = kwargs.get("job_info", {})
         job_info.update()
-        if completed and total:
+        if kwargs.get("deduplicated"):
+            if self.metrics:
+                self.metrics.deduplicate(file_path)
+            status = "Uploaded file: [%s] (same content as an earlier file)" % file_name
+        elif completed and total:
             file_name = " [%s]" % file_name
             job_info.update({"completed": completed, "total": total, "host": kwargs.get("host")})
-            status = "Uploading file%s: %d%% complete" % (file_name, round(((completed / total) % 100) * 100))
+            if self.metrics:
+                # completed and total are counted in chunks
+                self.metrics.update(file_path, completed * job_info.get("chunk-length", DEFAULT_CHUNK_SIZE))
+                percent, rate = self.metrics.fileProgress(file_path)
+                status = "Uploading file%s: %d%% complete (%s/s)" % (file_name, percent, format_bytes(rate))
+            else:
+                status = "Uploading file%s: %d%% complete" % (file_name, round(completed / total * 100))
             self.uploader.setTransferState(file_path, job_info)
         else:
             summary = kwargs.get("summary", "")
@@ -203,9 +258,35 @@ class UploadWindow(QMainWindow):
         return True
 
     def statusCallback(self, **kwargs):
+        if self.metrics:
+            self.metrics.updateStatus(self.uploader.file_status)
+            if kwargs.get("file_path"):
+                self.metrics.reviseFile(kwargs["file_path"], self.uploader.file_status)
         status = kwargs.get("status")
         self.progress_update_signal.emit(status)
 
+    def startMetrics(self):
+        self.metrics = TransferMetrics()
+        self.metrics.start(self.uploader)
+        self.ui.metricsLabel.setText("")
+        self.ui.metricsLabel.show()
+        self.metrics_timer.start()
+
+    def finishMetrics(self):
+        if not self.metrics:
+            return
+        self.metrics_timer.stop()
+        self.metrics.updateStatus(self.uploader.file_status)
+        self.metrics.finish()
+        self.updateMetrics()
+        logging.info("Upload summary: %s" % json.dumps(self.metrics.summary()))
+        self.metrics = None
+
+    @pyqtSlot()
+    def updateMetrics(self):
+        if self.metrics:
+            self.ui.metricsLabel.setText(self.metrics.describe())
+
     def displayUploads(self, upload_list):
         keys = ["State",
                 "Status",
@@ -273,6 +354,30 @@ class UploadWindow(QMainWindow):
         configUpdateTask.status_update_signal.connect(self.onUpdateConfigResult)
         configUpdateTask.update_config()
 
+    def checkUnfinishedJobs(self):
+        # offered once per session, and only before a directory has been selected
+        if self.resume_checked or self.current_path or self.uploading:
+            return
+        self.resume_checked = True
+        index = read_job_index(self.uploader)
+        roots = [root for root in index.keys() if os.path.isdir(root) or is_archive(root)]
+        if not roots:
+            return
+        root = max(roots, key=lambda r: index[r].get("started", 0))
+        qApp.setOverrideCursor(Qt.WaitCursor)
+        self.updateStatus("Checking unfinished upload in [%s]..." % root)
+        checkTask = ResumeCheckTask(self.uploader)
+        checkTask.status_update_signal.connect(self.onResumeCheckResult)
+        checkTask.check(self.transfer_journal, root)
+
+    def resumeJob(self, root, expired):
+        qApp.setOverrideCursor(Qt.WaitCursor)
+        self.disableControls()
+        self.uploader.reset()
+        resumeTask = ResumeJobTask(self.uploader)
+        resumeTask.status_update_signal.connect(self.onResumeJobResult)
+        resumeTask.resume(self.transfer_journal, root, expired)
+
     def scanDirectory(self):
         self.uploader.reset()
         scanTask = ScanDirectoryTask(self.uploader)
@@ -325,6 +430,7 @@ class UploadWindow(QMainWindow):
             self.resetUI(status, detail)
             return
         if not result:
+            self.checkUnfinishedJobs()
             return
         confirm_updates = stob(self.uploader.server.get("confirm_updates", False))
         if confirm_updates:
@@ -341,13 +447,51 @@ class UploadWindow(QMainWindow):
             msg.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
             ret = msg.exec_()
             if ret == QMessageBox.No:
+                self.checkUnfinishedJobs()
                 return
 
         write_config(self.uploader.getDeployedConfigFilePath(), result)
         self.uploader.initialize(cleanup=False)
+        self.adoptPooledSessions()
         if not self.checkVersion():
             return
         self.on_actionRescan_triggered()
+        self.checkUnfinishedJobs()
+
+    @pyqtSlot(bool, str, str, object)
+    def onResumeCheckResult(self, success, status, detail, result):
+        qApp.restoreOverrideCursor()
+        if not success:
+            self.resetUI(status, detail, success)
+            return
+        if not result or self.current_path or self.uploading:
+            self.resetUI("Ready...")
+            return
+        root = result["root"]
+        ret = self.resumeConfirmation(result)
+        if ret == QMessageBox.Discard:
+            self.transfer_journal.discardJob(root)
+        if ret != QMessageBox.Yes:
+            self.resetUI("Ready...")
+            return
+        self.current_path = root
+        self.ui.pathTextBox.setText(os.path.normpath(self.current_path))
+        if not result["resumable"]:
+            # the upload configuration has changed since the job was started, so the directory has to be rescanned
+            self.uploading = True
+            self.scanDirectory()
+            return
+        self.resumeJob(root, result["expired"])
+
+    @pyqtSlot(bool, str, str, object)
+    def onResumeJobResult(self, success, status, detail, result):
+        qApp.restoreOverrideCursor()
+        self.displayUploads(self.uploader.getFileStatusAsArray())
+        if not success:
+            self.resetUI(status, detail, success)
+            return
+        self.resuming = True
+        self.on_actionUpload_triggered()
 
     @pyqtSlot()
     def on_actionBrowse_triggered(self):
@@ -362,6 +506,21 @@ class UploadWindow(QMainWindow):
         self.ui.pathTextBox.setText(os.path.normpath(self.current_path))
         self.scanDirectory()
 
+    @pyqtSlot()
+    def on_actionBrowseArchive_triggered(self):
+        # the files of an archive are uploaded as if it had been extracted to a directory, without extracting it
+        dialog = QFileDialog()
+        path, _ = dialog.getOpenFileName(self,
+                                         "Select Archive",
+                                         self.current_path,
+                                         "Archives (%s);;All Files (*)" %
+                                         " ".join("*" + ext for ext in ZIP_EXTENSIONS + TAR_EXTENSIONS))
+        if not path:
+            return
+        self.current_path = path
+        self.ui.pathTextBox.setText(os.path.normpath(self.current_path))
+        self.scanDirectory()
+
     @pyqtSlot()
     def on_actionRescan_triggered(self):
         if not self.current_path:
@@ -394,7 +553,29 @@ class UploadWindow(QMainWindow):
         self.save_progress_on_cancel = False
         qApp.setOverrideCursor(Qt.WaitCursor)
         self.uploading = True
+        self.updateStatus("Checking for files already uploaded...")
+        preflightTask = PreflightTask(self.uploader)
+        preflightTask.status_update_signal.connect(self.onPreflightResult)
+        preflightTask.preflight(self.upload_mode, self.upload_order)
+
+    @pyqtSlot(bool, str, str, object)
+    def onPreflightResult(self, success, status, detail, result):
+        if not self.uploading or self.uploader.cancelled:
+            return
+        if not success:
+            # files are uploaded as usual, the uploader finds existing ones itself
+            self.updateStatus(status, detail, success)
+        elif result and result["skipped"]:
+            self.displayUploads(self.uploader.getFileStatusAsArray())
+            self.updateStatus("Skipping %d file(s) already uploaded (%s)" %
+                              (result["skipped"], format_bytes(result["skipped_bytes"])))
+        self.uploadFiles()
+
+    def uploadFiles(self):
         self.updateStatus("Uploading...")
+        self.startMetrics()
+        self.transfer_journal.beginJob(resumed=self.resuming)
+        self.resuming = False
         self.progress_update_signal.connect(self.updateProgress)
         uploadTask = UploadFilesTask(self.uploader)
         uploadTask.status_update_signal.connect(self.onUploadResult)
@@ -404,16 +585,56 @@ class UploadWindow(QMainWindow):
     def onUploadResult(self, success, status, detail, result):
         qApp.restoreOverrideCursor()
         self.uploading = False
+        self.finishMetrics()
         self.displayUploads(self.uploader.getFileStatusAsArray())
         if success:
+            self.transfer_journal.endJob()
             self.resetUI("Ready.")
         else:
             self.resetUI(status, detail, success)
+        self.verifyUploads()
+
+    def verifyUploads(self):
+        if not self.verify_uploads:
+            return
+        uploads = self.upload_verifier.takeUploads()
+        if not uploads:
+            return
+        self.updateStatus("Verifying %d uploaded file(s) in the background..." % len(uploads))
+        verifyTask = VerifyUploadsTask(self.uploader)
+        verifyTask.status_update_signal.connect(self.onVerifyResult)
+        verifyTask.verify(self.upload_verifier, uploads, thread_pool=self.verify_thread_pool)
+
+    @pyqtSlot(bool, str, str, object)
+    def onVerifyResult(self, success, status, detail, result):
+        if not success:
+            logging.error("%s: %s" % (status, detail))
+            return
+        mismatched = 0
+        for file_path, (outcome, message) in result.items():
+            mismatched += 1 if outcome == VERIFY_MISMATCH else 0
+            file_status = self.uploader.file_status.get(file_path)
+            # the file may have been scanned again, for another job, since it was uploaded
+            if not file_status or file_status.get("State") != UploadState.Success:
+                continue
+            if outcome == VERIFY_MISMATCH:
+                self.uploader.file_status[file_path] = \
+                    FileUploadState(UploadState.Failed, "Verification failed: %s" % message)._asdict()
+            else:
+                file_status["Status"] = "%s; %s" % (file_status["Status"], message)
+        if self.uploading:
+            # the next job is running; the failures have been logged, and the list shows the files of that job
+            return
+        self.displayUploads(self.uploader.getFileStatusAsArray())
+        self.updateStatus("Verification complete: %d of %d file(s) do not match the server." %
+                          (mismatched, len(result)) if mismatched else
+                          "Verification complete: %d file(s) checked." % len(result), success=not mismatched)
 
     @pyqtSlot()
     def on_actionCancel_triggered(self):
         self.cancelTasks(self.cancelConfirmation())
         qApp.restoreOverrideCursor()
+        self.finishMetrics()
         self.displayUploads(self.uploader.getFileStatusAsArray())
         self.resetUI("Ready.")
 
@@ -456,6 +677,31 @@ class UploadWindow(QMainWindow):
             self.auth_window.logout(self.logoutConfirmation())
         qApp.closeAllWindows()
 
+    def resumeConfirmation(self, result):
+        qApp.restoreOverrideCursor()
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Question)
+        msg.setWindowTitle("Unfinished Upload Found")
+        msg.setText("An upload from [%s] did not finish: %d of %d file(s) were uploaded.\n\n"
+                    "Resume uploading the remaining %d file(s)?" %
+                    (os.path.normpath(result["root"]), result["done"], result["files"], result["remaining"]))
+        details = list()
+        if result["partial"]:
+            details.append("%d partially uploaded file(s) will continue where they left off." % result["partial"])
+        if result["expired"]:
+            details.append("%d partially uploaded file(s) will start over, because their upload has expired on the "
+                           "server." % len(result["expired"]))
+        if result["missing"]:
+            details.append("%d file(s) can no longer be found and will be skipped." % len(result["missing"]))
+        if not result["resumable"]:
+            details.append("The upload configuration has changed since this upload was started, so the directory "
+                           "will be scanned again.")
+        details.append("Selecting \"Discard\" will forget this upload; selecting \"No\" will ask again the next time "
+                       "the application is started.")
+        msg.setInformativeText("\n\n".join(details))
+        msg.setStandardButtons(QMessageBox.Yes | QMessageBox.No | QMessageBox.Discard)
+        return msg.exec_()
+
     def logoutConfirmation(self):
         if self.auth_window and (not self.auth_window.authenticated() or not self.auth_window.cookie_persistence):
             return
@@ -518,6 +764,10 @@ class UploadWindowUI(object):
         self.browseButton = QPushButton("Browse", self.centralWidget)
         self.browseButton.clicked.connect(MainWin.on_actionBrowse_triggered)
         self.horizontalLayout.addWidget(self.browseButton)
+        self.archiveButton = QPushButton("Archive", self.centralWidget)
+        self.archiveButton.setToolTip("Upload the files of a zip or tar archive, without extracting it")
+        self.archiveButton.clicked.connect(MainWin.on_actionBrowseArchive_triggered)
+        self.horizontalLayout.addWidget(self.archiveButton)
         self.verticalLayout.addLayout(self.horizontalLayout)
 
         # Splitter for Upload list/Log
@@ -568,6 +818,12 @@ class UploadWindowUI(object):
         self.actionBrowse.setToolTip(MainWin.tr("Set the upload directory"))
         self.actionBrowse.setShortcut(MainWin.tr("Ctrl+B"))
 
+        # Browse archive
+        self.actionBrowseArchive = QAction(MainWin)
+        self.actionBrowseArchive.setObjectName("actionBrowseArchive")
+        self.actionBrowseArchive.setText(MainWin.tr("Archive"))
+        self.actionBrowseArchive.setToolTip(MainWin.tr("Set an archive to upload the files of"))
+
         # Upload
         self.actionUpload = QAction(MainWin)
         self.actionUpload.setObjectName("actionUpload")
@@ -690,6 +946,10 @@ class UploadWindowUI(object):
         self.statusBar.setStatusTip("")
         self.statusBar.setObjectName("statusBar")
         MainWin.setStatusBar(self.statusBar)
+        self.metricsLabel = QLabel(self.statusBar)
+        self.metricsLabel.setObjectName("metricsLabel")
+        self.metricsLabel.hide()
+        self.statusBar.addPermanentWidget(self.metricsLabel)
 
     # configure logging
         self.logTextBrowser.widget.log_update_signal.connect(MainWin.updateLog)
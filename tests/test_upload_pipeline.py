@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from deriva.transfer.upload.deriva_upload import DerivaUpload, UploadState
+from deriva.qt.upload_gui.impl.upload_pipeline import UploadPipeline
+from deriva.qt.upload_gui.impl.catalog_batch import CatalogWriteBatcher
+
+# how long an upload job of a few empty files may take before it counts as hung
+UPLOAD_TIMEOUT = 30
+
+ASSET_MAPPING = {
+    "asset_type": "file",
+    "target_table": ["s", "t"],
+    "checksum_types": ["md5"],
+    "hatrac_templates": {"hatrac_uri": "/hatrac/{file_name}"},
+    "record_query_template": "/entity/s:t/fn={file_name}",
+    "column_map": {"URI": "{URI}", "md5": "{md5}", "fn": "{file_name}"}
+}
+
+
+class StubResponse(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def json(self):
+        return self.value
+
+
+class StubCatalog(object):
+
+    def __init__(self, bad_file_name=None):
+        self.bad_file_name = bad_file_name
+        self.inserted = list()
+
+    def get(self, path):
+        return StubResponse([])
+
+    def post(self, uri, json=None, data=None, headers=None):
+        rows = json or []
+        if any(row.get("fn") == self.bad_file_name for row in rows):
+            raise Exception("409 Conflict")
+        self.inserted.extend(rows)
+        return StubResponse(rows)
+
+    def put(self, uri, json=None):
+        return StubResponse(json)
+
+
+class StubStore(object):
+
+    def put_loc(self, uri, file_path, **kwargs):
+        return uri + ":v1"
+
+
+# A DerivaUpload without a server: the catalog and the object store are stubs, and there is no transfer state file.
+class StubUploader(DerivaUpload):
+
+    def __init__(self, catalog):
+        self.metadata = dict()
+        self.file_status = dict()
+        self.file_list = dict()
+        self.skipped_files = set()
+        self.cancelled = False
+        self.catalog = catalog
+        self.store = StubStore()
+        self.config = dict()
+        self.server_url = "https://example.org"
+        self.transfer_state = dict()
+        self.transfer_state_fh = None
+        self.processor_output = dict()
+        self.catalog_metadata = {"s:t": {"URI", "md5", "fn"}}
+
+    def _get_catalog_table_columns(self, table):
+        return {"URI", "md5", "fn"}
+
+    def _get_catalog_default_columns(self, row, table, **kwargs):
+        return []
+
+    def getTransferState(self, file_path):
+        return None
+
+    def delTransferState(self, file_path):
+        pass
+
+
+class UploadPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = list()
+        for i in range(5):
+            file_path = os.path.join(self.directory, "f%d" % i)
+            with open(file_path, "w") as fp:
+                fp.write("x" * i)
+            self.files.append(file_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def getUploader(self, catalog):
+        uploader = StubUploader(catalog)
+        pipeline = UploadPipeline.attach(uploader)
+        CatalogWriteBatcher.attach(uploader)
+        uploader.file_list = {0: [(0, ASSET_MAPPING, {}, file_path) for file_path in self.files]}
+        return uploader, pipeline
+
+    def runUpload(self, uploader):
+        # returns the exception uploadFiles raised, if any; fails the test if it does not return in time
+        errors = list()
+
+        def upload():
+            try:
+                uploader.uploadFiles(lambda **kwargs: None)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=upload)
+        thread.daemon = True
+        thread.start()
+        thread.join(UPLOAD_TIMEOUT)
+        self.assertFalse(thread.is_alive(), "uploadFiles did not return")
+        return errors[0] if errors else None
+
+    def getStates(self, uploader):
+        return {os.path.basename(file_path): status["State"] for file_path, status in uploader.file_status.items()}
+
+    def test_upload(self):
+        uploader, pipeline = self.getUploader(StubCatalog())
+        self.assertIsNone(self.runUpload(uploader))
+        self.assertEqual(self.getStates(uploader), {"f%d" % i: UploadState.Success for i in range(5)})
+        self.assertEqual(sorted(row["fn"] for row in uploader.catalog.inserted), ["f%d" % i for i in range(5)])
+
+    def test_failing_hash_stage(self):
+        uploader, pipeline = self.getUploader(StubCatalog())
+
+        def submit(file_path, hashes):
+            raise MemoryError("out of memory")
+
+        pipeline.hasher.submit = submit
+        self.assertIsInstance(self.runUpload(uploader), MemoryError)
+        # no file was handed to the transfer stage, so none of them is left in progress or reported as uploaded
+        self.assertFalse([state for state in self.getStates(uploader).values()
+                          if state in (UploadState.Running, UploadState.Success)])
+        self.assertFalse(uploader.catalog.inserted)
+
+    def test_failing_batched_write(self):
+        uploader, pipeline = self.getUploader(StubCatalog(bad_file_name="f2"))
+        error = self.runUpload(uploader)
+        self.assertIsInstance(error, RuntimeError)
+        # the failed batch is sent again file by file, so only the file whose row was rejected fails
+        states = self.getStates(uploader)
+        self.assertEqual(states.pop("f2"), UploadState.Failed)
+        self.assertEqual(states, {"f%d" % i: UploadState.Success for i in (0, 1, 3, 4)})
+        self.assertEqual(sorted(row["fn"] for row in uploader.catalog.inserted), ["f0", "f1", "f3", "f4"])
+
+
+if __name__ == '__main__':
+    unittest.main()